@@ -93,6 +93,13 @@ man_pages = [
         _man_authors,
         1,
     ),
+    (
+        "man/supysonic-cli-cache",
+        "supysonic-cli-cache",
+        "Supysonic cache management commands",
+        _man_authors,
+        1,
+    ),
     (
         "man/supysonic-daemon",
         "supysonic-daemon",
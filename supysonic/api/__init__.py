@@ -20,7 +20,6 @@ _UNSUPPORTED_METHODS = (
     "createShare",
     "updateShare",
     "deleteShare",
-    "hls",
 )
 
 
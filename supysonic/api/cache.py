@@ -0,0 +1,43 @@
+# This file is part of Supysonic.
+# Supysonic is a Python implementation of the Subsonic server API.
+#
+# Copyright (C) 2026 Alban 'spl0k' Féron
+#
+# Distributed under terms of the GNU AGPLv3 license.
+
+from flask import current_app, request
+
+from ._blueprint import api_routing
+from ._helpers import admin_only
+
+
+def cache_stats_dict(name, cache):
+    stats = cache.stats()
+    return {
+        "name": name,
+        "size": stats["size"],
+        "maxSize": stats["max_size"],
+        "entries": stats["entries"],
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "evictions": stats["evictions"],
+        "protectedSkips": stats["protected_skips"],
+        "bytesWritten": stats["bytes_written"],
+        "bytesServed": stats["bytes_served"],
+    }
+
+
+@api_routing("/getCacheStats")
+@admin_only
+def cache_stats():
+    return request.formatter(
+        "cacheStats",
+        {
+            "cache": [
+                cache_stats_dict("cache", current_app.extensions["cache"]),
+                cache_stats_dict(
+                    "transcodes", current_app.extensions["transcode_cache"]
+                ),
+            ]
+        },
+    )
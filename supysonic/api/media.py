@@ -6,23 +6,41 @@
 #
 # Distributed under terms of the GNU AGPLv3 license.
 
+import io
+import itertools
 import logging
 import mimetypes
 import os.path
-import shlex
-import subprocess
 
 import mediafile
-from flask import Response, current_app, request, send_file
+from flask import Response, current_app, request, send_file, url_for
 from PIL import Image
 from zipstream import ZipStream
 
 from ..cache import CacheMiss
-from ..covers import EXTENSIONS
-from ..db import Album, Artist, Folder, Track, now
-from ._blueprint import api_routing
+from ..covers import (
+    EXTENSIONS,
+    cached_cover_id,
+    cover_from_collection,
+    find_cover,
+    make_thumbnail,
+    thumbnail_key,
+)
+from ..db import Album, Artist, Folder, Playlist, SerializationContext, Track, now
+from ..parsers import parse_int
+from ..transcoding import (
+    TranscodersBusy,
+    can_seek,
+    can_segment,
+    get_transcoding_cmdlines,
+    hls_segment_key,
+    transcode,
+    transcoding_cache_key,
+)
+from ._blueprint import api, api_routing
 from ._exceptions import (
     GenericError,
+    InvalidParameter,
     NotFound,
     ServerError,
     UnsupportedParameter,
@@ -35,72 +53,36 @@ logger = logging.getLogger(__name__)
 # lyrics — a loose artist/title match can otherwise touch the whole library.
 MAX_LYRICS_CANDIDATES = 10
 
+# Tracks are streamed over HLS as segments of this length, in one of these
+# formats, as they can be played as is by HLS clients, at most at this bitrate
+# when switching to them
+HLS_SEGMENT_DURATION = 10  # seconds
+HLS_FORMATS = {"mp3": "audio/mpeg", "aac": "audio/aac"}
+HLS_MAX_BITRATE = 320
 
-def prepare_transcoding_cmdline(
-    base_cmdline, res, input_format, output_format, output_bitrate
-):
-    if not base_cmdline:
-        return None
-    ret = shlex.split(base_cmdline)
-    ret = [
-        part.replace("%srcpath", res.path)
-        .replace("%srcfmt", input_format)
-        .replace("%outfmt", output_format)
-        .replace("%outrate", str(output_bitrate))
-        .replace("%title", res.title)
-        .replace("%album", res.album.name)
-        .replace("%artist", res.artist.name)
-        .replace("%tracknumber", str(res.number))
-        .replace("%totaltracks", str(res.album.tracks.count()))
-        .replace("%discnumber", str(res.disc))
-        .replace("%genre", res.genre if res.genre else "")
-        .replace("%year", str(res.year) if res.year else "")
-        for part in ret
-    ]
-    return ret
+# Formats whose decoders resync on the next frame, that can be streamed from
+# any byte. Others, such as FLAC or MP4, can't play without their header.
+BYTE_SEEKABLE_FORMATS = ("aac", "mp3", "oga", "ogg", "opus")
 
 
 @api_routing("/stream")
 def stream_media():
     res = get_entity(Track)
 
-    if "timeOffset" in request.values:
-        raise UnsupportedParameter("timeOffset")
     if "size" in request.values:
         raise UnsupportedParameter("size")
 
     maxBitRate = get_int("maxBitRate", min=0)
+    timeOffset = get_int("timeOffset", 0, min=0)
     estimateContentLength = get_bool("estimateContentLength", False)
     request_format = request.values.get("format")
     if request_format:
         request_format = request_format.lower()
 
     src_suffix = res.suffix()
-    dst_suffix = res.suffix()
-    dst_bitrate = res.bitrate
+    dst_suffix, dst_bitrate = _stream_target(res, request_format, maxBitRate)
     dst_mimetype = res.mimetype
 
-    config = current_app.config["TRANSCODING"]
-    prefs = request.client
-
-    using_default_format = False
-    if request_format:
-        dst_suffix = src_suffix if request_format == "raw" else request_format
-    elif prefs.format:
-        dst_suffix = prefs.format
-    else:
-        using_default_format = True
-        dst_suffix = src_suffix
-
-    if prefs.bitrate and prefs.bitrate < dst_bitrate:
-        dst_bitrate = prefs.bitrate
-
-    if maxBitRate:
-        if dst_bitrate > maxBitRate:
-            dst_bitrate = maxBitRate
-            if using_default_format:
-                dst_suffix = config.get("default_transcode_target") or dst_suffix
-
     # Find new mimetype if we're changing formats
     if dst_suffix != src_suffix:
         dst_mimetype = (
@@ -111,99 +93,46 @@ def stream_media():
     if dst_suffix != src_suffix or dst_bitrate != res.bitrate:
         # Requires transcoding
         cache = current_app.extensions["transcode_cache"]
-        cache_key = f"{res.id}-{dst_bitrate}.{dst_suffix}"
+        cache_key = transcoding_cache_key(res, dst_bitrate, dst_suffix)
 
         try:
-            response = send_file(
-                cache.get(cache_key), mimetype=dst_mimetype, conditional=True
+            response = _send_from_offset(
+                cache.get(cache_key),
+                dst_suffix,
+                res.duration,
+                timeOffset,
+                dst_mimetype,
             )
         except CacheMiss:
-            transcoder = config.get(f"transcoder_{src_suffix}_{dst_suffix}")
-            decoder = config.get("decoder_" + src_suffix) or config.get("decoder")
-            encoder = config.get("encoder_" + dst_suffix) or config.get("encoder")
-            if not transcoder and (not decoder or not encoder):
-                transcoder = config.get("transcoder")
-                if not transcoder:
-                    message = "No way to transcode from {} to {}".format(
-                        src_suffix, dst_suffix
-                    )
-                    logger.info(message)
-                    raise GenericError(message)
-
-            transcoder, decoder, encoder = (
-                prepare_transcoding_cmdline(x, res, src_suffix, dst_suffix, dst_bitrate)
-                for x in (transcoder, decoder, encoder)
-            )
-            try:
-                if transcoder:
-                    dec_proc = None
-                    proc = subprocess.Popen(transcoder, stdout=subprocess.PIPE)
-                else:
-                    dec_proc = subprocess.Popen(decoder, stdout=subprocess.PIPE)
-                    proc = subprocess.Popen(
-                        encoder, stdin=dec_proc.stdout, stdout=subprocess.PIPE
-                    )
-            except OSError:
-                raise ServerError("Error while running the transcoding process")
-
-            if estimateContentLength:
-                estimate = dst_bitrate * 1000 * res.duration // 8
-            else:
-                estimate = None
-
-            def transcode():
-                while True:
-                    data = proc.stdout.read(8192)
-                    if not data:
-                        break
-                    yield data
-
-            def kill_processes():
-                if dec_proc is not None:
-                    dec_proc.kill()
-                proc.kill()
-
-            def handle_transcoding():
-                try:
-                    sent = 0
-                    for data in transcode():
-                        sent += len(data)
-                        yield data
-                except (Exception, SystemExit, KeyboardInterrupt):
-                    # Make sure child processes are always killed
-                    kill_processes()
-                    raise
-                except GeneratorExit:
-                    # Try to transcode/send more data if we're close to the end.
-                    # The calling code have to support this as yielding more data
-                    # after a GeneratorExit would normally raise a RuntimeError.
-                    # Hopefully this generator is only used by the cache which
-                    # handles this.
-                    if estimate and sent >= estimate * 0.95:
-                        yield from transcode()
-                    else:
-                        kill_processes()
-                        raise
-                finally:
-                    if dec_proc is not None:
-                        dec_proc.stdout.close()
-                        dec_proc.wait()
-                    proc.stdout.close()
-                    proc.wait()
-
-            resp_content = cache.set_generated(cache_key, handle_transcoding)
-
-            logger.info(
-                "Transcoding track {0.id} for user {1.id}. Source: {2} at {0.bitrate}kbps. Dest: {3} at {4}kbps".format(
-                    res, request.user, src_suffix, dst_suffix, dst_bitrate
+            response = None
+            if not timeOffset:
+                # A client coming back for the rest of a track still being
+                # transcoded
+                response = _send_generated_range(cache, cache_key, dst_mimetype)
+            if response is None:
+                response = _transcode_response(
+                    res,
+                    dst_suffix,
+                    dst_bitrate,
+                    dst_mimetype,
+                    estimateContentLength,
+                    timeOffset,
                 )
-            )
-            response = Response(resp_content, mimetype=dst_mimetype)
-            if estimate is not None:
-                response.headers.add("Content-Length", estimate)
+
+        if current_app.extensions["pretranscoder"] is not None:
+            _pretranscode_next(res, request_format, maxBitRate)
     else:
-        response = send_file(res.path, mimetype=dst_mimetype, conditional=True)
+        response = _send_from_offset(
+            res.path, src_suffix, res.duration, timeOffset, dst_mimetype
+        )
 
+    if not timeOffset:  # otherwise seeking in a track already being played
+        _record_play(res)
+
+    return response
+
+
+def _record_play(res):
     res.play_count = res.play_count + 1
     res.last_play = now()
     res.save()
@@ -213,9 +142,360 @@ def stream_media():
     user.last_play_date = now()
     user.save()
 
+
+def _send_from_offset(path, suffix, duration, offset, mimetype):
+    """Send a file starting at the byte matching a time offset, estimated from
+    its size and duration. Files of formats that can't be cut are sent whole,
+    clients can still seek in them with range requests."""
+
+    if not offset or suffix not in BYTE_SEEKABLE_FORMATS:
+        return send_file(path, mimetype=mimetype, conditional=True)
+
+    # Opened before anything else can happen to the file, such as it being
+    # evicted from the cache
+    f = open(path, "rb")
+    size = os.fstat(f.fileno()).st_size
+    # Tags aren't part of the audio the position is estimated in
+    tag = min(_id3_size(f.read(10)), size)
+    if duration:
+        start = min(tag + (size - tag) * offset // duration, size)
+    else:
+        start = size
+    f.seek(start)
+
+    def read_file():
+        with f:
+            while data := f.read(8192):
+                yield data
+
+    response = Response(read_file(), mimetype=mimetype)
+    response.headers.add("Content-Length", size - start)
+    return response
+
+
+def _id3_size(header):
+    """Return the size of the ID3v2 tag starting with the given 10 bytes, 0 if
+    there is none"""
+
+    if len(header) < 10 or not header.startswith(b"ID3"):
+        return 0
+
+    # Sync-safe integer, 7 bits per byte
+    size = 0
+    for byte in header[6:10]:
+        size = size << 7 | byte & 0x7F
+    if header[5] & 0x10:  # footer
+        size += 10
+    return size + 10
+
+
+def _send_generated_range(cache, cache_key, mimetype):
+    """Send the requested range of a transcode still in progress, if it was
+    already written. Returns None otherwise."""
+
+    if request.range is None or request.range.units != "bytes":
+        return None
+    if len(request.range.ranges) != 1 or request.range.ranges[0][0] < 0:
+        return None
+
+    start, stop = request.range.ranges[0]
+    try:
+        stop, content = cache.read_generated(cache_key, start, stop)
+    except CacheMiss:
+        return None
+
+    # The total length isn't known yet
+    response = Response(content, 206, mimetype=mimetype)
+    response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/*"
+    response.headers["Content-Length"] = stop - start
+    return response
+
+
+def _stream_target(res, request_format, max_bitrate):
+    """Return the format and bitrate to stream a track at, depending on the
+    request parameters and the client preferences"""
+
+    src_suffix = res.suffix()
+    dst_bitrate = res.bitrate
+
+    config = current_app.config["TRANSCODING"]
+    prefs = request.client
+
+    using_default_format = False
+    if request_format:
+        dst_suffix = src_suffix if request_format == "raw" else request_format
+    elif prefs.format:
+        dst_suffix = prefs.format
+    else:
+        using_default_format = True
+        dst_suffix = src_suffix
+
+    if prefs.bitrate and prefs.bitrate < dst_bitrate:
+        dst_bitrate = prefs.bitrate
+
+    if max_bitrate:
+        if dst_bitrate > max_bitrate:
+            dst_bitrate = max_bitrate
+            if using_default_format:
+                dst_suffix = config.get("default_transcode_target") or dst_suffix
+
+    return dst_suffix, dst_bitrate
+
+
+def _transcode_response(
+    res, dst_suffix, dst_bitrate, dst_mimetype, estimate_length, offset
+):
+    src_suffix = res.suffix()
+    config = current_app.config["TRANSCODING"]
+    cache = current_app.extensions["transcode_cache"]
+    cache_key = transcoding_cache_key(res, dst_bitrate, dst_suffix)
+
+    # Transcoders taking an %offset start right from it, the partial result
+    # isn't cached. Otherwise the whole track is transcoded, and cached, and
+    # the part before the estimated offset isn't sent, unless the format can't
+    # be cut.
+    seek = bool(offset) and can_seek(config, src_suffix, dst_suffix)
+    if seek or dst_suffix in BYTE_SEEKABLE_FORMATS:
+        offset_bytes = dst_bitrate * 1000 * offset // 8
+    else:
+        offset_bytes = 0
+    skip = 0 if seek else offset_bytes
+
+    cmdlines = get_transcoding_cmdlines(
+        config, res, src_suffix, dst_suffix, dst_bitrate, offset if seek else 0
+    )
+    if cmdlines is None:
+        message = "No way to transcode from {} to {}".format(src_suffix, dst_suffix)
+        logger.info(message)
+        raise GenericError(message)
+
+    if estimate_length:
+        estimate = dst_bitrate * 1000 * res.duration // 8
+    else:
+        estimate = None
+
+    # Waits for a slot in the transcoding queue first
+    slot = current_app.extensions["transcoders"].slot(request.user.name)
+    if seek:
+        resp_content = transcode(cmdlines, slot=slot)
+    else:
+        # Only called for the first request of a given cache key, later ones
+        # read from the cache as it gets written
+        resp_content = cache.set_generated(
+            cache_key, lambda: transcode(cmdlines, estimate, slot)
+        )
+    # Start transcoding now to report errors while it's still possible
+    try:
+        first = next(resp_content, b"")
+    except TranscodersBusy as e:
+        raise ServerError(f"{e}, try again later")
+    except OSError:
+        raise ServerError("Error while running the transcoding process")
+
+    def stream_transcoded():
+        to_skip = skip
+        try:
+            for data in itertools.chain((first,), resp_content):
+                if to_skip >= len(data):
+                    to_skip -= len(data)
+                    continue
+                yield data[to_skip:]
+                to_skip = 0
+        finally:
+            resp_content.close()
+
+    logger.info(
+        "Transcoding track {0.id} for user {1.id}. Source: {2} at {0.bitrate}kbps. Dest: {3} at {4}kbps".format(
+            res, request.user, src_suffix, dst_suffix, dst_bitrate
+        )
+    )
+    response = Response(stream_transcoded(), mimetype=dst_mimetype)
+    if estimate is not None:
+        response.headers.add("Content-Length", max(estimate - offset_bytes, 0))
     return response
 
 
+def _next_tracks(res, count):
+    """Guess the tracks to be streamed after res: the ones following it in the
+    last playlist the user looked at if it's there, in its album otherwise"""
+
+    tracks = []
+    playlist_id = current_app.extensions["pretranscoder"].last_playlist(request.user.id)
+    if playlist_id is not None:
+        playlist = Playlist.get_or_none(id=playlist_id)
+        if playlist is not None:
+            tracks = playlist.get_tracks()
+
+    if res not in tracks:
+        tracks = list(res.album.tracks)
+        ctx = SerializationContext(request.user, request.client)
+        ctx.add_tracks(tracks)  # preload FKs before sort_key (reads album.artist)
+        tracks.sort(key=lambda t: t.sort_key())
+
+    index = tracks.index(res) + 1
+    return tracks[index : index + count]
+
+
+def _pretranscode_next(res, request_format, max_bitrate):
+    """Transcode the next tracks in the background, the way they would be if
+    requested with the same parameters"""
+
+    pretranscoder = current_app.extensions["pretranscoder"]
+    config = current_app.config["TRANSCODING"]
+    for track in _next_tracks(res, pretranscoder.count):
+        src_suffix = track.suffix()
+        dst_suffix, dst_bitrate = _stream_target(track, request_format, max_bitrate)
+        if dst_suffix == src_suffix and dst_bitrate == track.bitrate:
+            continue  # streamed as is
+
+        cache_key = transcoding_cache_key(track, dst_bitrate, dst_suffix)
+        if pretranscoder.cache.has(cache_key):
+            continue
+
+        cmdlines = get_transcoding_cmdlines(
+            config, track, src_suffix, dst_suffix, dst_bitrate
+        )
+        if cmdlines is not None:
+            pretranscoder.submit(cache_key, cmdlines, request.user.name)
+
+
+def _hls_target(res, max_bitrate):
+    """Same as _stream_target, for formats suitable for HLS segments"""
+
+    dst_suffix, dst_bitrate = _stream_target(res, None, max_bitrate)
+    if dst_suffix not in HLS_FORMATS:
+        default = current_app.config["TRANSCODING"].get("default_transcode_target")
+        dst_suffix = default if default in HLS_FORMATS else "mp3"
+        # Lossless bitrates aren't valid for these formats
+        dst_bitrate = min(dst_bitrate, HLS_MAX_BITRATE)
+    return dst_suffix, dst_bitrate
+
+
+def _hls_bitrates():
+    # Values may come with a video resolution, as in 1000@480x360
+    bitrates = []
+    for value in request.values.getlist("bitRate"):
+        try:
+            bitrates.append(parse_int(value.partition("@")[0], min=0))
+        except ValueError as e:
+            raise InvalidParameter("bitRate", e) from e
+    return bitrates
+
+
+def _hls_url(endpoint, **kwargs):
+    """URL of another HLS resource, authenticated as the current request"""
+
+    for param in ("u", "p", "c", "v"):
+        if param in request.values:
+            kwargs[param] = request.values[param]
+    return url_for(endpoint, **kwargs)
+
+
+def _m3u8_response(lines):
+    return Response("\n".join(lines) + "\n", mimetype="application/vnd.apple.mpegurl")
+
+
+def _no_segmenting(src_suffix, dst_suffix):
+    message = "No way to transcode parts of tracks from {} to {}".format(
+        src_suffix, dst_suffix
+    )
+    logger.info(message)
+    return GenericError(message)
+
+
+@api_routing("/hls")
+def hls_playlist():
+    res = get_entity(Track)
+
+    if "audioTrack" in request.values:
+        raise UnsupportedParameter("audioTrack")
+
+    bitrates = _hls_bitrates()
+    if len(bitrates) > 1:
+        # One variant per bitrate, each having its own playlist
+        lines = ["#EXTM3U"]
+        for bitrate in bitrates:
+            _, dst_bitrate = _hls_target(res, bitrate)
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={dst_bitrate * 1000}")
+            lines.append(_hls_url(".hls_playlist", id=res.id, bitRate=bitrate))
+        return _m3u8_response(lines)
+
+    bitrate = bitrates[0] if bitrates else None
+    src_suffix = res.suffix()
+    dst_suffix, _ = _hls_target(res, bitrate)
+    if not can_segment(current_app.config["TRANSCODING"], src_suffix, dst_suffix):
+        raise _no_segmenting(src_suffix, dst_suffix)
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{HLS_SEGMENT_DURATION}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    params = {"id": res.id}
+    if bitrate is not None:
+        params["bitRate"] = bitrate
+    for segment, start in enumerate(range(0, res.duration, HLS_SEGMENT_DURATION)):
+        lines.append(f"#EXTINF:{min(HLS_SEGMENT_DURATION, res.duration - start)},")
+        lines.append(_hls_url(".hls_segment", segment=segment, **params))
+    lines.append("#EXT-X-ENDLIST")
+
+    _record_play(res)
+    return _m3u8_response(lines)
+
+
+api.add_url_rule("/hls.m3u8", view_func=hls_playlist, methods=["GET", "POST"])
+
+
+@api_routing("/hlsSegment")
+def hls_segment():
+    res = get_entity(Track)
+    segment = get_int("segment", min=0, required=True)
+    start = segment * HLS_SEGMENT_DURATION
+    if start >= res.duration:
+        raise NotFound("Segment")
+
+    src_suffix = res.suffix()
+    dst_suffix, dst_bitrate = _hls_target(res, get_int("bitRate", min=0))
+    mimetype = HLS_FORMATS[dst_suffix]
+
+    # Each segment is cached on its own, seeking or reconnecting only
+    # requires transcoding the segments not played yet
+    cache = current_app.extensions["transcode_cache"]
+    cache_key = hls_segment_key(res, dst_bitrate, dst_suffix, segment)
+    try:
+        return send_file(cache.get(cache_key), mimetype=mimetype, conditional=True)
+    except CacheMiss:
+        pass
+
+    config = current_app.config["TRANSCODING"]
+    if not can_segment(config, src_suffix, dst_suffix):
+        raise _no_segmenting(src_suffix, dst_suffix)
+
+    # The last segment goes on until the end of the track, whose duration is
+    # rounded down
+    if start + HLS_SEGMENT_DURATION < res.duration:
+        duration = HLS_SEGMENT_DURATION
+    else:
+        duration = res.duration - start + 1
+    cmdlines = get_transcoding_cmdlines(
+        config, res, src_suffix, dst_suffix, dst_bitrate, start, duration
+    )
+
+    slot = current_app.extensions["transcoders"].slot(request.user.name)
+    try:
+        data = b"".join(
+            cache.set_generated(cache_key, lambda: transcode(cmdlines, slot=slot))
+        )
+    except TranscodersBusy as e:
+        raise ServerError(f"{e}, try again later")
+    except OSError:
+        raise ServerError("Error while running the transcoding process")
+
+    return Response(data, mimetype=mimetype)
+
+
 @api_routing("/download")
 def download_media():
     cls, eid = resolve_child_id(request.values["id"])
@@ -256,7 +536,7 @@ def download_media():
             z.add_path(track.path, filename)
             seen.add(filename)
 
-        cover_path = _cover_from_collection(rv, extract=False)
+        cover_path = cover_from_collection(rv, None, extract=False)
         if cover_path:
             z.add_path(cover_path)
 
@@ -269,53 +549,8 @@ def download_media():
     return resp
 
 
-def _cover_from_track(obj):
-    """Extract and return a path to a track's cover art
-
-    Returns None if no cover art is available.
-    """
+def _get_cover(eid):
     cache = current_app.extensions["cache"]
-    cache_key = f"{obj.id}-cover"
-    try:
-        return cache.get(cache_key)
-    except CacheMiss:
-        try:
-            return cache.set(cache_key, mediafile.MediaFile(obj.path).art)
-        except mediafile.UnreadableFileError:
-            return None
-
-
-def _cover_from_collection(obj, extract=True):
-    """Get a path to cover art from a collection (Album, Folder)
-
-    If `extract` is True, will fall back to extracting cover art from tracks
-    Returns None if no cover art is available.
-    """
-    cover_path = None
-
-    if isinstance(obj, Folder) and obj.cover_art:
-        cover_path = os.path.join(obj.path, obj.cover_art)
-
-    elif isinstance(obj, Album):
-        track_with_folder_cover = (
-            obj.tracks.join(Folder, on=Track.folder)
-            .where(Folder.cover_art.is_null(False))
-            .first()
-        )
-        if track_with_folder_cover is not None:
-            cover_path = _cover_from_collection(track_with_folder_cover.folder)
-
-        if not cover_path and extract:
-            track_with_embedded = obj.tracks.where(Track.has_art).first()
-            if track_with_embedded is not None:
-                cover_path = _cover_from_track(track_with_embedded)
-
-    if not cover_path or not os.path.isfile(cover_path):
-        return None
-    return cover_path
-
-
-def _get_cover_path(eid):
     cls, eid = resolve_child_id(eid)
 
     if cls is Folder:
@@ -323,19 +558,25 @@ def _get_cover_path(eid):
         if folder is None:
             raise NotFound("Entity")
 
-        return _cover_from_collection(folder)
+        return find_cover(folder, cache)
 
     # A non-folder child id is ambiguous: it may name either a track or an album.
     # Try both before declaring the entity unknown.
     track = Track.get_or_none(id=eid)
     if track is not None:
-        return _cover_from_track(track)
+        return find_cover(track, cache)
 
     album = Album.get_or_none(id=eid)
     if album is None:
         raise NotFound("Entity")
 
-    return _cover_from_collection(album)
+    return find_cover(album, cache)
+
+
+def _send_thumbnail(data):
+    with Image.open(io.BytesIO(data)) as im:
+        mimetype = f"image/{im.format.lower()}"
+    return send_file(io.BytesIO(data), mimetype=mimetype)
 
 
 @api_routing("/getCoverArt")
@@ -343,12 +584,22 @@ def cover_art():
     cache = current_app.extensions["cache"]
 
     eid = request.values["id"]
-    cover_path = _get_cover_path(eid)
+    size = get_int("size", min=1)
+    if size is not None:
+        # Thumbnails already generated are served straight from the cache,
+        # usually from its memory tier, without looking for the cover again.
+        # Embedded art is shared by all the tracks having the same image.
+        cover_id = cached_cover_id(eid, cache) or eid
+        try:
+            return _send_thumbnail(cache.get_value(thumbnail_key(cover_id, size)))
+        except CacheMiss:
+            pass
+
+    cover_id, cover_path = _get_cover(eid)
 
     if not cover_path:
         raise NotFound("Cover art")
 
-    size = get_int("size", min=1)
     if size is None:
         # If the cover was extracted from a track it won't have an accurate
         # extension for Flask to derive the mimetype from - derive it from the
@@ -359,19 +610,19 @@ def cover_art():
                 mimetype = f"image/{im.format.lower()}"
         return send_file(cover_path, mimetype=mimetype)
 
-    with Image.open(cover_path) as im:
-        mimetype = f"image/{im.format.lower()}"
-        if size > im.width and size > im.height:
-            return send_file(cover_path, mimetype=mimetype)
+    # The cover may have been resized already for another entity sharing it
+    cache_key = thumbnail_key(cover_id, size)
+    try:
+        return _send_thumbnail(cache.get_value(cache_key))
+    except CacheMiss:
+        pass
 
-        cache_key = f"{eid}-cover-{size}"
-        try:
-            return send_file(cache.get(cache_key), mimetype=mimetype)
-        except CacheMiss:
-            im.thumbnail([size, size], Image.Resampling.LANCZOS)
-            with cache.set_fileobj(cache_key) as fp:
-                im.save(fp, im.format)
-            return send_file(cache.get(cache_key), mimetype=mimetype)
+    data, mimetype = make_thumbnail(cover_path, size)
+    if data is None:
+        return send_file(cover_path, mimetype=mimetype)
+
+    cache.set(cache_key, data)
+    return send_file(io.BytesIO(data), mimetype=mimetype)
 
 
 def lyrics_response_for_track(track, lyrics):
@@ -5,7 +5,7 @@
 #
 # Distributed under terms of the GNU AGPLv3 license.
 
-from flask import request
+from flask import current_app, request
 
 from ..db import Playlist, PlaylistTrack, SerializationContext, Track, User, db
 from ..parsers import parse_int
@@ -60,6 +60,11 @@ def show_playlist():
     if res.user != request.user and not res.public and not request.user.admin:
         raise Forbidden()
 
+    # Likely to be played next, see stream_media
+    pretranscoder = current_app.extensions["pretranscoder"]
+    if pretranscoder is not None:
+        pretranscoder.playlist_viewed(request.user.id, res.id)
+
     tracks = res.get_tracks()
     ctx = SerializationContext(request.user, request.client)
     ctx.add_tracks(tracks)
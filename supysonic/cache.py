@@ -8,14 +8,18 @@
 
 import contextlib
 import errno
+import hashlib
 import logging
 import os
 import os.path
+import sqlite3
 import tempfile
 import threading
-from collections import namedtuple
+from collections import Counter, OrderedDict
 from time import time
 
+from .pathutils import is_network_path
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,8 +35,55 @@ class ProtectedError(Exception):
     pass
 
 
-CacheEntry = namedtuple("CacheEntry", ["size", "expires"])
-NULL_ENTRY = CacheEntry(0, 0)
+INDEX_DIR = ".index"
+LAYOUT = "sharded"  # files in two levels of subdirectories, see Cache._filepath
+LOCK_TIMEOUT = 60  # seconds to wait for other processes to release the index
+WAIT_INTERVAL = 1  # seconds between checks of a generation readers wait for
+EVICTION_BATCH = 100  # entries read from the index at once when evicting
+FLUSH_INTERVAL = 10  # seconds between writes of access times to the index
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS index_entries_atime ON entries(atime);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+STATS = (
+    "hits",
+    "misses",
+    "evictions",
+    "protected_skips",
+    "bytes_written",
+    "bytes_served",
+)
+
+
+class _Generation:
+    """Data being generated into the cache by a thread of its own, which
+    readers follow"""
+
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.thread = None
+        self.path = None  # .part file, then the cached file once done
+        self.size = 0  # bytes written and flushed to path
+        self.wanted = -1  # furthest offset a reader is waiting for
+        self.done = False
+        self.error = None  # what the generation failed with
+        self.readers = 0
+        self.left = None  # when the last reader left, waiting for others
+        self.unpaced = False  # the first caller left others, go on for them
+        self.abandoned = False  # nobody came back to read, stop generating
 
 
 class Cache:
@@ -43,7 +94,18 @@ class Cache:
     # keys must be filename-compatible strings (no paths)
     # values must be bytes (not strings)
 
-    def __init__(self, cache_dir, max_size, min_time=300, auto_prune=True):
+    def __init__(
+        self,
+        cache_dir,
+        max_size,
+        min_time=300,
+        auto_prune=True,
+        background_prune=False,
+        low_watermark=0.9,
+        memory_size=0,
+        memory_entry_size=65536,
+        reconnect_time=10,
+    ):
         """Initialize the cache
 
         cache_dir: The folder to store cached files
@@ -52,6 +114,20 @@ class Cache:
                   in seconds (default 300 = 5min)
         auto_prune: If True (default) the cache will automatically be pruned to
                     the max_size when possible.
+        background_prune: If True, auto-pruning is done by a background thread
+                          rather than when adding files. It starts once the
+                          cache grows over max_size and evicts down to
+                          low_watermark * max_size.
+        low_watermark: Fraction of max_size background pruning evicts down to
+                       (default 0.9)
+        memory_size: Size in bytes of the in-memory tier kept in front of the
+                     files, for entries read with get_value (default 0 =
+                     disabled)
+        memory_entry_size: Entries bigger than this aren't kept in memory
+                           (default 64KiB)
+        reconnect_time: How long, in seconds, data being generated is kept
+                        once nobody reads it, for clients reconnecting to it
+                        (default 10)
 
         Note that max_size is not a hard restriction and in some cases will
         temporarily be exceeded, even when auto-pruning is turned on.
@@ -59,8 +135,28 @@ class Cache:
         self._cache_dir = os.path.abspath(cache_dir)
         self.min_time = min_time
         self.max_size = max_size
+        self.low_watermark = low_watermark
+        self.reconnect_time = reconnect_time
         self._auto_prune = auto_prune
         self._lock = threading.RLock()
+        self._generating = {}  # key -> _Generation
+        self._generators = set()  # threads of the generations still running
+        self._pruner = None
+
+        # In-memory state, guarded by its own lock which is never held during
+        # I/O so that reads don't wait on writers or other processes
+        self._memory_lock = threading.Lock()
+        self._stats = Counter()  # not yet saved to the index
+        self._recent = {}  # key -> (size, atime) not yet saved to the index
+        self._last_flush = time()
+
+        # Small, recently used values, served without touching the disk
+        self.memory_size = memory_size
+        self.memory_entry_size = memory_entry_size
+        self.memory_hits = 0
+        self.memory_misses = 0
+        self._memory = OrderedDict()  # key -> bytes, least recently used first
+        self._memory_used = 0
 
         # Create the cache directory
         try:
@@ -69,23 +165,220 @@ class Cache:
             if e.errno != errno.EEXIST:
                 raise
 
-        # Make a key -> CacheEntry(size, expiry) map ordered by mtime. Eviction
-        # walks it front to back, so its order is the LRU order: dicts keep
-        # insertion order, and _freshen_file re-inserts to move an entry last.
-        self._size = 0
-        self._files = {}
-        for mtime, size, key in sorted(
-            [
-                (f.stat().st_mtime, f.stat().st_size, f.name)
-                for f in os.scandir(self._cache_dir)
-                if f.is_file()
-            ]
-        ):
-            self._files[key] = CacheEntry(size, mtime + self.min_time)
-            self._size += size
+        # The key -> (size, access time) index is kept in a database next to
+        # the files rather than rebuilt from the directory each time. Eviction
+        # goes by access time, oldest first.
+        # It is shared by every process using the same directory (such as the
+        # workers of a WSGI server), changes to it and to the files are done
+        # under its write lock so that the size limit and eviction order hold
+        # across all of them.
+        index_dir = os.path.join(self._cache_dir, INDEX_DIR)
+        os.makedirs(index_dir, exist_ok=True)
+        self._index = sqlite3.connect(
+            os.path.join(index_dir, "index.sqlite"),
+            timeout=LOCK_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        # WAL needs memory shared between processes, which network
+        # filesystems don't provide
+        journal = "DELETE" if is_network_path(index_dir) else "WAL"
+        self._index.execute(f"PRAGMA journal_mode={journal}")
+        self._index.executescript(INDEX_SCHEMA)
+
+        # Most things done to the directory without going through the index,
+        # such as files or shards removed by hand, change its mtime. Files
+        # missing from the shards are handled by has().
+        with self._transaction():
+            if (
+                self._get_meta("layout") != LAYOUT
+                or self._get_meta("mtime") != os.stat(self._cache_dir).st_mtime_ns
+            ):
+                self._rebuild_index()
+
+        if auto_prune and background_prune:
+            self._prune_needed = threading.Event()
+            self._closing = False
+            self._pruner = threading.Thread(
+                target=self._prune_in_background, name="cache-pruner", daemon=True
+            )
+            self._pruner.start()
+
+    def close(self):
+        """Close the index. The cache can't be used anymore afterwards."""
+        if self._pruner is not None:
+            self._closing = True
+            self._prune_needed.set()
+            self._pruner.join()
+
+        with self._lock:
+            generations = list(self._generating.values())
+            threads = list(self._generators)
+        for generation in generations:
+            with generation.cond:
+                generation.abandoned = True
+                generation.cond.notify_all()
+        for thread in threads:
+            thread.join()
+
+        self.flush()
+        self._index.close()
+
+    def _prune_in_background(self):
+        while True:
+            self._prune_needed.wait()
+            if self._closing:
+                return
+            self._prune_needed.clear()
+
+            try:
+                self._evict(int(self.max_size * self.low_watermark))
+            except Exception:
+                logger.exception("Background pruning of %s failed", self._cache_dir)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run index changes atomically, along with the filesystem operations
+        done within"""
+
+        with self._lock:
+            if self._index.in_transaction:  # nested, the outer one commits
+                yield self._index
+                return
+
+            # Take the write lock right away, waiting for other processes
+            self._index.execute("BEGIN IMMEDIATE")
+            try:
+                self._save_pending()
+                yield self._index
+                self._set_meta("mtime", os.stat(self._cache_dir).st_mtime_ns)
+            except BaseException:
+                self._index.execute("ROLLBACK")
+                raise
+            self._index.execute("COMMIT")
+
+    def _get_meta(self, name):
+        row = self._index.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, name, value):
+        self._index.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value)
+        )
+
+    def _count(self, **counters):
+        with self._memory_lock:
+            self._stats.update(counters)
+
+    def _save_pending(self):
+        """Write the access times and stats gathered since the last
+        transaction to the index"""
+
+        # Piggybacks on the transactions made anyway, rather than writing to
+        # the index on every read
+        with self._memory_lock:
+            recent, self._recent = self._recent, {}
+            stats, self._stats = self._stats, Counter()
+            self._last_flush = time()
+
+        self._index.executemany(
+            "UPDATE entries SET atime = MAX(atime, ?) WHERE key = ?",
+            ((atime, key) for key, (_, atime) in recent.items()),
+        )
+        self._index.executemany(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            stats.items(),
+        )
+        # The file mtimes are only used if the index has to be rebuilt
+        for key, (_, atime) in recent.items():
+            with contextlib.suppress(OSError):
+                os.utime(self._filepath(key), (atime, atime))
+
+    def flush(self):
+        """Save the access times of the entries read since the last flush, as
+        well as the stats, so that other processes see them. Done
+        periodically while the cache is used and when closing it."""
+
+        with self._transaction():
+            pass
+
+    def _maybe_flush(self):
+        """Flush, unless done recently or the index is busy"""
+
+        if time() - self._last_flush < FLUSH_INTERVAL:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self.flush()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return the usage counters of the cache, for all the processes using
+        it, along with its current size and number of entries"""
+
+        with self._transaction() as index:
+            counters = dict(index.execute("SELECT name, value FROM stats"))
+            (entries,) = index.execute("SELECT COUNT(*) FROM entries").fetchone()
+
+        stats = {name: counters.get(name, 0) for name in STATS}
+        stats.update(size=self.size, max_size=self.max_size, entries=entries)
+        return stats
+
+    def _add_size(self, delta):
+        self._index.execute(
+            "UPDATE meta SET value = value + ? WHERE name = 'size'", (delta,)
+        )
+
+    def _rebuild_index(self):
+        logger.info("Rebuilding the cache index of %s", self._cache_dir)
+
+        entries = []
+        for shard in self._scandir(self._cache_dir):
+            if not shard.is_dir():
+                # Stored flat by older versions, move it in its shard
+                path = self._filepath(shard.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(shard.path, path)
+                st = os.stat(path)
+                entries.append((shard.name, st.st_size, st.st_mtime))
+                continue
+
+            for subshard in self._scandir(shard.path):
+                for f in self._scandir(subshard.path):
+                    st = f.stat()
+                    entries.append((f.name, st.st_size, st.st_mtime))
+
+        self._index.execute("DELETE FROM entries")
+        self._index.executemany(
+            "INSERT INTO entries (key, size, atime) VALUES (?, ?, ?)", entries
+        )
+        self._set_meta("size", sum(size for _, size, _ in entries))
+        self._set_meta("layout", LAYOUT)
+
+    @staticmethod
+    def _scandir(path):
+        with os.scandir(path) as it:
+            for f in it:
+                # Skip the index itself and data being written
+                if not f.name.startswith(".") and not f.name.endswith(".part"):
+                    yield f
+
+    def _entry(self, key):
+        """Return the (size, atime) of an entry, or None"""
+        return self._index.execute(
+            "SELECT size, atime FROM entries WHERE key = ?", (key,)
+        ).fetchone()
 
     def _filepath(self, key):
-        return os.path.join(self._cache_dir, key)
+        # Spread the files in 65536 directories rather than having them all in
+        # a single one
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self._cache_dir, digest[:2], digest[2:4], key)
 
     def _make_space(self, required_space, key=None):
         """Delete files to free up the required space (or close to it)
@@ -94,41 +387,86 @@ class Cache:
         subtracted from the required size.
         """
         target = self.max_size - required_space
-        if key is not None:
-            target += self._files.get(key, NULL_ENTRY).size
 
-        with self._lock:
-            # Delete the oldest file until self._size <= target
-            for k in list(self._files.keys()):
-                if self._size <= target:
+        with self._transaction():
+            if key is not None:
+                entry = self._entry(key)
+                if entry is not None:
+                    target += entry[0]
+
+            self._evict(target)
+
+    def _evict(self, target):
+        """Delete the oldest files until self.size <= target
+
+        Each file is deleted in its own transaction unless already in one, so
+        that writers aren't held up for the whole eviction. The index is read
+        by batches, only as far as needed.
+        """
+
+        last = (-1, "")
+        while self.size > target:
+            with self._lock:
+                batch = self._index.execute(
+                    "SELECT atime, key FROM entries WHERE (atime, key) > (?, ?) "
+                    "ORDER BY atime, key LIMIT ?",
+                    (*last, EVICTION_BATCH),
+                ).fetchall()
+            if not batch:
+                break
+            last = batch[-1]
+
+            for _, k in batch:
+                if self.size <= target:
                     break
                 try:
                     self.delete(k)
+                    self._count(evictions=1)
                 except ProtectedError:
-                    pass
+                    self._count(protected_skips=1)
 
     def _record_file(self, key, size):
         # If the file is being replaced, add only the difference in size
-        self._size += size - self._files.get(key, NULL_ENTRY).size
-        self._files[key] = CacheEntry(size, int(time()) + self.min_time)
-
-    def _freshen_file(self, key):
-        """Touch the file to change modified time and move it to the end of the cache dict"""
-        old = self._files.pop(key)
-        self._files[key] = CacheEntry(old.size, int(time()) + self.min_time)
-        os.utime(self._filepath(key), None)
+        self._memory_forget(key)
+        entry = self._entry(key)
+        self._add_size(size - (entry[0] if entry else 0))
+        self._index.execute(
+            "INSERT OR REPLACE INTO entries (key, size, atime) VALUES (?, ?, ?)",
+            (key, size, time()),
+        )
 
     @property
     def size(self):
         """The current amount of data cached"""
-        return self._size
+        with self._lock:
+            return self._get_meta("size")
 
     def touch(self, key):
         """Mark a cache entry as fresh"""
-        with self._lock:
-            if not self.has(key):
-                raise CacheMiss(key)
-            self._freshen_file(key)
+        self._lookup(key)
+
+    def _lookup(self, key):
+        """Mark a cache entry as recently used and return its size
+
+        Keys already looked up since the last flush are only checked to still
+        have their file, without reading the index. Other processes don't see
+        their access time until it is flushed and may have evicted them in
+        the meantime.
+        """
+
+        entry = self._recent.get(key)
+        if entry is not None and not os.path.exists(self._filepath(key)):
+            entry = None
+        if entry is None:
+            with self._lock:
+                if not self.has(key):
+                    raise CacheMiss(key)
+                entry = self._entry(key)
+
+        with self._memory_lock:
+            self._recent[key] = (entry[0], time())
+        self._maybe_flush()
+        return entry[0]
 
     @contextlib.contextmanager
     def set_fileobj(self, key):
@@ -142,9 +480,13 @@ class Cache:
         >>> with cache.set_fileobj(key) as fp:
         ...     json.dump(some_data, fp)
         """
-        f = tempfile.NamedTemporaryFile(
-            dir=self._cache_dir, suffix=".part", delete=False
-        )
+        shard = os.path.dirname(self._filepath(key))
+        if not os.path.isdir(shard):
+            # Changes the mtime of the cache directory
+            with self._transaction():
+                os.makedirs(shard, exist_ok=True)
+
+        f = tempfile.NamedTemporaryFile(dir=shard, suffix=".part", delete=False)
         try:
             yield f
 
@@ -153,14 +495,18 @@ class Cache:
             size = f.tell()
             f.close()
 
-            with self._lock:
-                if self._auto_prune:
+            with self._transaction():
+                if self._auto_prune and self._pruner is None:
                     self._make_space(size, key=key)
-                os.replace(f.name, self._filepath(key))
                 self._record_file(key, size)
+                self._count(bytes_written=size)
+                os.replace(f.name, self._filepath(key))
+
+            if self._pruner is not None and self.size > self.max_size:
+                self._prune_needed.set()
         except BaseException:
             f.close()
-            with contextlib.suppress(OSError):
+            with contextlib.suppress(OSError), self._transaction():
                 os.remove(f.name)
             raise
 
@@ -168,6 +514,7 @@ class Cache:
         """Set a literal value into the cache and return its path"""
         with self.set_fileobj(key) as f:
             f.write(value)
+        self._remember(key, value)
         return self._filepath(key)
 
     def set_generated(self, key, gen_function):
@@ -177,30 +524,233 @@ class Cache:
         The contents will be set into the cache only if and when the generator
         completes.
 
+        The generator is run by a thread of its own, writing to a file that
+        the caller reads from. It is only iterated as the caller reads, and
+        stopped if nobody reads it for reconnect_time after the caller stops
+        iterating. Until then, what was written can be read again through
+        read_generated.
+
+        If the same key is already being generated, the generator function
+        isn't called. The data is read from the file being written instead, as
+        it grows. The generation then goes on until completion even if the
+        first caller stops iterating, no longer waiting for it.
+
         Ex:
         >>> for x in cache.set_generated(key, generator_function):
         ...     print(x)
         """
-        with self.set_fileobj(key) as f:
-            gen = gen_function()
-            try:
-                for data in gen:
+        with self._lock:
+            generation = self._generating.get(key)
+            following = generation is not None
+            if not following:
+                generation = self._generating[key] = _Generation(key)
+                generation.thread = threading.Thread(
+                    target=self._generate,
+                    args=(generation, gen_function),
+                    name="cache-generation",
+                    daemon=True,
+                )
+                self._generators.add(generation.thread)
+                generation.thread.start()
+            self._attach(generation)
+
+        yield from self._follow(generation, owner=not following)
+
+    def _generate(self, generation, gen_function):
+        """Run the generator of a generation, as long as it is read"""
+
+        key = generation.key
+        try:
+            with self.set_fileobj(key) as f, contextlib.closing(gen_function()) as gen:
+                with generation.cond:
+                    generation.path = f.name
+
+                while True:
+                    if self._wait_wanted(generation):
+                        # Try to stop the generator but check it still wants
+                        # to yield data. If it does allow caching of this data
+                        # without anyone reading it
+                        try:
+                            f.write(gen.throw(GeneratorExit))
+                            for data in gen:
+                                f.write(data)
+                        except StopIteration:
+                            # We stopped just at the end of the generator
+                            pass
+                        break
+
+                    try:
+                        data = next(gen)
+                    except StopIteration:
+                        break
                     f.write(data)
-                    yield data
-            except GeneratorExit:
-                # Try to stop the generator but check it still wants to yield data.
-                # If it does allow caching of this data without forwarding it
+                    f.flush()
+                    with generation.cond:
+                        generation.size += len(data)
+                        generation.cond.notify_all()
+
+            with generation.cond:
+                generation.path = self._filepath(key)
+        except GeneratorExit:
+            pass  # stopped, nothing to store
+        except Exception as e:
+            with generation.cond:
+                generation.error = e
+        finally:
+            with self._lock:
+                if self._generating.get(key) is generation:
+                    del self._generating[key]
+                self._generators.discard(threading.current_thread())
+            with generation.cond:
+                generation.done = True
+                generation.cond.notify_all()
+
+    def _wait_wanted(self, generation):
+        """Wait for readers to want more data. Returns whether the generation
+        was abandoned instead."""
+
+        def wanted():
+            # Ahead of the readers only once the first caller left them
+            return (
+                generation.wanted >= generation.size
+                or generation.unpaced
+                or generation.abandoned
+            )
+
+        while True:
+            with generation.cond:
+                while not wanted():
+                    if generation.left is None:
+                        generation.cond.wait()
+                        continue
+                    remaining = generation.left + self.reconnect_time - time()
+                    if remaining <= 0:
+                        break
+                    generation.cond.wait(remaining)
+                else:
+                    return generation.abandoned
+
+            # Nobody came back in time, unless while not holding the lock
+            with self._lock, generation.cond:
+                left = generation.left
+                if left is not None and time() >= left + self.reconnect_time:
+                    self._abandon(generation)
+                    return True
+
+    def _abandon(self, generation):
+        # Called with self._lock and generation.cond held
+        generation.abandoned = True
+        if self._generating.get(generation.key) is generation:
+            # Not followed by new callers, generated anew
+            del self._generating[generation.key]
+        generation.cond.notify_all()
+
+    def read_generated(self, key, start, stop=None):
+        """Read the part of a key being generated that was already written
+
+        Returns the end of the part that can be read, stop if all of it was
+        written already, and an iterator over the data from start to there.
+        The generation then goes on until completion even if the generator
+        function caller stops iterating. It can also be read once the caller
+        stopped, for up to reconnect_time.
+        Raises CacheMiss if key isn't being generated or if nothing was
+        written from start yet.
+        """
+
+        with self._lock:
+            generation = self._generating.get(key)
+            if generation is None:
+                raise CacheMiss(key)
+            with generation.cond:
+                if generation.size <= start:
+                    raise CacheMiss(key)
+                if stop is None or stop > generation.size:
+                    stop = generation.size
+            self._attach(generation)
+
+        return stop, self._follow(generation, start, stop)
+
+    def _follow(self, generation, start=0, stop=None, owner=False):
+        """Yields the data of a generation, as it gets written, then raises
+        the error the generation failed with, if any"""
+
+        offset = start
+        try:
+            while stop is None or offset < stop:
+                with generation.cond:
+                    while generation.size <= offset and not generation.done:
+                        generation.wanted = max(generation.wanted, offset)
+                        generation.cond.notify_all()
+                        # Not relying on being notified, should the
+                        # generation thread be gone
+                        generation.cond.wait(WAIT_INTERVAL)
+                        if not generation.thread.is_alive():
+                            break
+                    path, size, done = generation.path, generation.size, generation.done
+                    error = generation.error
+
+                if stop is not None:
+                    size = min(size, stop)
+                if offset >= size:
+                    if error is not None:
+                        raise error
+                    return
+
                 try:
-                    f.write(gen.throw(GeneratorExit))
-                    for data in gen:
-                        f.write(data)
-                except StopIteration:
-                    # We stopped just at the end of the generator
-                    pass
+                    with open(path, "rb") as f:
+                        f.seek(offset)
+                        data = f.read(min(size - offset, 65536))
+                except FileNotFoundError:
+                    if done:
+                        # The generation failed, or was already pruned from
+                        # the cache
+                        logger.warning("Cache generation data gone while reading")
+                        return
+
+                    # Being moved to its final place
+                    with generation.cond:
+                        generation.cond.wait(0.1)
+                    continue
+
+                offset += len(data)
+                yield data
+        finally:
+            self._leave(generation, owner)
+
+    def _attach(self, generation):
+        # Called with self._lock held
+        generation.readers += 1
+        with generation.cond:
+            generation.left = None
+
+    def _leave(self, generation, owner):
+        with self._lock, generation.cond:
+            generation.readers -= 1
+            if owner and generation.readers:
+                generation.unpaced = True
+            orphaned = not (generation.readers or generation.done or generation.unpaced)
+            if orphaned and self.reconnect_time > 0:
+                # Kept for a while, for readers coming back
+                generation.left = time()
+                generation.cond.notify_all()
+            elif orphaned:
+                self._abandon(generation)
+            else:
+                generation.cond.notify_all()
+
+        if orphaned and generation.abandoned:
+            # Whatever may still be stored is once this returns, and the
+            # generator was stopped
+            generation.thread.join()
 
     def get(self, key):
         """Return the path to the file where the cached data is stored"""
-        self.touch(key)
+        try:
+            size = self._lookup(key)
+        except CacheMiss:
+            self._count(misses=1)
+            raise
+        self._count(hits=1, bytes_served=size)
         return self._filepath(key)
 
     @contextlib.contextmanager
@@ -211,19 +761,70 @@ class Cache:
 
     def get_value(self, key):
         """Return the cached data"""
+        if self.memory_size:
+            with self._memory_lock:
+                value = self._memory.get(key)
+                if value is not None:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    self._recent[key] = (len(value), time())
+                    self._stats.update(hits=1, bytes_served=len(value))
+                else:
+                    self.memory_misses += 1
+            if value is not None:
+                self._maybe_flush()
+                return value
+
         with self.get_fileobj(key) as f:
-            return f.read()
+            value = f.read()
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key, value):
+        """Keep a value in the memory tier, if it fits"""
+        if len(value) > min(self.memory_entry_size, self.memory_size):
+            return
+
+        with self._memory_lock:
+            self._memory_pop(key)
+            self._memory[key] = value
+            self._memory_used += len(value)
+            while self._memory_used > self.memory_size:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+
+    def _memory_pop(self, key):
+        value = self._memory.pop(key, None)
+        if value is not None:
+            self._memory_used -= len(value)
+
+    def _memory_forget(self, key):
+        """Drop what's known in memory about a key being replaced or deleted"""
+        with self._memory_lock:
+            self._memory_pop(key)
+            self._recent.pop(key, None)
 
     def delete(self, key):
         """Delete a file from the cache"""
-        with self._lock:
+        with self._transaction():
             if not self.has(key):
                 return
-            if time() < self._files[key].expires:
-                raise ProtectedError("File has not expired")
 
-            os.remove(self._filepath(key))
-            self._size -= self._files.pop(key).size
+            # Pending access times were saved when starting the transaction
+            size, atime = self._entry(key)
+            protected = time() < atime + self.min_time
+            if not protected:
+                self._forget(key, size)
+                os.remove(self._filepath(key))
+
+        # Outside of the transaction so that it isn't rolled back
+        if protected:
+            raise ProtectedError("File has not expired")
+
+    def _forget(self, key, size):
+        self._memory_forget(key)
+        self._index.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._add_size(-size)
 
     def prune(self):
         """Prune the cache down to the max size
@@ -241,12 +842,15 @@ class Cache:
 
     def has(self, key):
         """Check if a key is currently cached"""
-        if key not in self._files:
-            return False
+        with self._lock:
+            entry = self._entry(key)
+            if entry is None:
+                return False
 
-        if not os.path.exists(self._filepath(key)):
-            # Underlying file is gone, remove from the cache
-            self._size -= self._files.pop(key).size
-            return False
+            if not os.path.exists(self._filepath(key)):
+                # Underlying file is gone, remove from the cache
+                with self._transaction():
+                    self._forget(key, entry[0])
+                return False
 
-        return True
+            return True
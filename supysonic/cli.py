@@ -14,6 +14,7 @@ from .config import IniConfig
 from .daemon.client import DaemonClient
 from .daemon.exceptions import DaemonUnavailableError
 from .db import Folder, User, init_database, release_database
+from .managers.cache import CacheManager
 from .managers.folder import FolderManager
 from .managers.user import UserManager
 from .parsers import parse_mail
@@ -116,6 +117,11 @@ def folder_delete(name):
     default=False,
     help="Force scan of already known files even if they haven't changed",
 )
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Resume an interrupted scan where it stopped (default) or start it over.",
+)
 @click.option(
     "--background",
     "mode",
@@ -129,7 +135,7 @@ def folder_delete(name):
     help="Scan the folder(s) in the foreground, blocking the processus while the scan is running.",
 )
 @click.pass_obj
-def folder_scan(config, folder, force, mode):
+def folder_scan(config, folder, force, resume, mode):
     """Run a scan on specified folders.
 
     FOLDER is the name of the folder to scan. Multiple can be specified. If ommitted,
@@ -140,10 +146,10 @@ def folder_scan(config, folder, force, mode):
 
     # quick and dirty shorthand calls
     def scan_bg():
-        daemon.scan(folder, force)
+        daemon.scan(folder, force, resume)
 
     def scan_fg():
-        _folder_scan_foreground(config, daemon, folder, force)
+        _folder_scan_foreground(config, daemon, folder, force, resume)
 
     auto = not mode
     if auto:
@@ -165,7 +171,7 @@ def folder_scan(config, folder, force, mode):
         scan_fg()
 
 
-def _folder_scan_foreground(config, daemon, folders, force):
+def _folder_scan_foreground(config, daemon, folders, force, resume):
     try:
         progress = daemon.get_scanning_progress()
         if progress is not None:
@@ -199,6 +205,9 @@ def _folder_scan_foreground(config, daemon, folders, force):
         force=force,
         extensions=extensions,
         follow_symlinks=config.BASE["follow_symlinks"],
+        workers=config.BASE["scanner_workers"],
+        batch_size=config.BASE["scanner_batch_size"],
+        resume=resume,
         progress=TimedProgressDisplay(),
         on_folder_start=unwatch_folder,
         on_folder_end=watch_folder,
@@ -382,6 +391,123 @@ def user_rename(name, newname):
     click.echo(f"User '{name}' renamed to '{newname}'")
 
 
+def _mib(size):
+    return f"{size / 1024**2:.1f} MiB"
+
+
+@cli.group("cache")
+def cache():
+    """Cache management commands"""
+    pass
+
+
+@cache.command("stats")
+@click.pass_obj
+def cache_stats(config):
+    """Shows usage statistics of the caches.
+
+    Counters are shared by all the processes using the caches and kept until
+    the cache directory is removed.
+    """
+
+    for name, c in CacheManager.open_caches(config).items():
+        stats = c.stats()
+        c.close()
+
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = f"{stats['hits'] * 100 / lookups:.1f}%" if lookups else "-"
+        click.echo(name)
+        click.echo(
+            f"  size: {_mib(stats['size'])} / {_mib(stats['max_size'])}"
+            f" ({stats['entries']} entries)"
+        )
+        click.echo(
+            f"  hits: {stats['hits']}, misses: {stats['misses']}"
+            f" (hit rate: {hit_rate})"
+        )
+        click.echo(
+            f"  evictions: {stats['evictions']},"
+            f" protected entries skipped: {stats['protected_skips']}"
+        )
+        click.echo(
+            f"  written: {_mib(stats['bytes_written'])},"
+            f" served: {_mib(stats['bytes_served'])}"
+        )
+
+
+@cache.command("warm")
+@click.option(
+    "-s",
+    "--size",
+    "sizes",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=[300],
+    show_default=True,
+    help="Size of the cover art thumbnails to generate. Can be repeated.",
+)
+@click.option(
+    "-t",
+    "--tracks",
+    type=click.IntRange(min=0),
+    default=100,
+    show_default=True,
+    help="Number of most played tracks to transcode.",
+)
+@click.option(
+    "-f",
+    "--format",
+    "dst_suffix",
+    help="Format to transcode the tracks to. Defaults to the configured default "
+    "transcode target, for tracks over the bitrate only.",
+)
+@click.option(
+    "-b",
+    "--bitrate",
+    type=click.IntRange(min=1),
+    default=128,
+    show_default=True,
+    help="Bitrate to transcode the tracks to, in kbps.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of thumbnails or transcodes generated at once.",
+)
+@click.pass_obj
+def cache_warm(config, sizes, tracks, dst_suffix, bitrate, jobs):
+    """Fills the caches ahead of client requests.
+
+    Generates cover art thumbnails for all the albums and folders, and
+    transcodes the most played tracks. Entries already cached are skipped.
+    """
+
+    caches = CacheManager.open_caches(config)
+    try:
+        done = CacheManager.warm(
+            config,
+            caches,
+            sizes=sizes,
+            tracks=tracks,
+            dst_suffix=dst_suffix,
+            dst_bitrate=bitrate,
+            jobs=jobs,
+        )
+    finally:
+        for c in caches.values():
+            c.close()
+
+    click.echo(
+        f"Generated {done['thumbnails']} thumbnails and {done['transcodes']} "
+        "transcodes"
+    )
+    if done["errors"]:
+        raise ClickException(f"{done['errors']} failed, see the logs for details")
+
+
 def main():
     config = IniConfig.from_common_locations()
     init_database(config.BASE["database_uri"])
@@ -23,10 +23,16 @@ def get_current_config():
 
 
 _VALUE_PARSERS = {
-    "BASE": {"follow_symlinks": parse_bool},
+    "BASE": {
+        "follow_symlinks": parse_bool,
+        "scanner_workers": partial(parse_int, min=1),
+        "scanner_batch_size": partial(parse_int, min=1),
+    },
     "WEBAPP": {
         "cache_size": partial(parse_int, min=0),
         "transcode_cache_size": partial(parse_int, min=0),
+        "cache_background_prune": parse_bool,
+        "cache_memory_size": partial(parse_int, min=0),
         "log_rotate": parse_bool,
         "mount_webui": parse_bool,
         "mount_api": parse_bool,
@@ -36,6 +42,13 @@ _VALUE_PARSERS = {
         "wait_delay": partial(parse_float, min=0),
         "log_rotate": parse_bool,
     },
+    "TRANSCODING": {
+        "max_transcodes": partial(parse_int, min=0),
+        "max_transcodes_per_user": partial(parse_int, min=0),
+        "transcode_queue_size": partial(parse_int, min=0),
+        "transcode_queue_timeout": partial(parse_float, min=0),
+        "pretranscode_tracks": partial(parse_int, min=0),
+    },
 }
 
 
@@ -49,11 +62,15 @@ class DefaultConfig:
         "database_uri": "sqlite:///" + os.path.join(tempdir, "supysonic.db"),
         "scanner_extensions": None,
         "follow_symlinks": False,
+        "scanner_workers": 1,
+        "scanner_batch_size": 500,
     }
     WEBAPP = {
         "cache_dir": tempdir,
         "cache_size": 512,
         "transcode_cache_size": 1024,
+        "cache_background_prune": False,
+        "cache_memory_size": 16,
         "log_file": None,
         "log_level": "WARNING",
         "log_rotate": True,
@@ -76,7 +93,13 @@ class DefaultConfig:
     }
     LASTFM = {"api_key": None, "secret": None}
     LISTENBRAINZ = {"api_url": "https://api.listenbrainz.org"}
-    TRANSCODING = {}
+    TRANSCODING = {
+        "max_transcodes": 0,
+        "max_transcodes_per_user": 0,
+        "transcode_queue_size": 32,
+        "transcode_queue_timeout": 30,
+        "pretranscode_tracks": 0,
+    }
     MIMETYPES = {}
 
     def __init__(self):
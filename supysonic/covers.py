@@ -5,13 +5,19 @@
 #
 # Distributed under terms of the GNU AGPLv3 license.
 
+import hashlib
+import io
 import os.path
 import re
 import warnings
 from os import scandir
 
+import mediafile
 from PIL import Image
 
+from .cache import CacheMiss
+from .db import Album, Folder, Track
+
 EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
 NAMING_SCORE_RULES = (
     ("cover", 5),
@@ -82,3 +88,117 @@ def find_cover_in_folder(path, album_name=None):
         return candidates[0]
 
     return sorted(candidates, key=lambda c: c.score, reverse=True)[0]
+
+
+def _art_ref_key(track_id):
+    return f"{track_id}-art"
+
+
+def cached_cover_id(track_id, cache):
+    """Return the cover id of a track's embedded art if it was already
+    extracted into cache, None otherwise"""
+
+    try:
+        return cache.get_value(_art_ref_key(track_id)).decode()
+    except CacheMiss:
+        return None
+
+
+def extract_cover(track, cache):
+    """Extract a track's embedded cover art into cache
+
+    Each distinct image is stored once, under a cover id derived from its
+    contents, and tracks only keep a reference to it. Returns the cover id and
+    the path to the image, or (None, None) if the track has no art.
+    """
+
+    cover_id = cached_cover_id(track.id, cache)
+    if cover_id is not None:
+        try:
+            return cover_id, cache.get(cover_id)
+        except CacheMiss:
+            pass  # evicted before the reference, extract it again
+
+    try:
+        art = mediafile.MediaFile(track.path).art
+    except mediafile.UnreadableFileError:
+        return None, None
+    if not art:
+        return None, None
+
+    cover_id = "art-" + hashlib.sha1(art).hexdigest()
+    try:
+        path = cache.get(cover_id)
+    except CacheMiss:
+        path = cache.set(cover_id, art)
+    cache.set(_art_ref_key(track.id), cover_id.encode())
+    return cover_id, path
+
+
+def find_cover(obj, cache, extract=True):
+    """Get the cover art of a Folder, Album or Track
+
+    Returns the cover id, shared by all the entities having the same cover,
+    and the path to the cover, or (None, None) if no cover art is available.
+    If `extract` is True, will fall back to extracting cover art from tracks,
+    into cache.
+    """
+
+    cover_id, cover_path = None, None
+
+    if isinstance(obj, Folder) and obj.cover_art:
+        cover_id, cover_path = str(obj.id), os.path.join(obj.path, obj.cover_art)
+
+    elif isinstance(obj, Track) and extract:
+        cover_id, cover_path = extract_cover(obj, cache)
+
+    elif isinstance(obj, Album):
+        track_with_folder_cover = (
+            obj.tracks.join(Folder, on=Track.folder)
+            .where(Folder.cover_art.is_null(False))
+            .first()
+        )
+        if track_with_folder_cover is not None:
+            cover_id, cover_path = find_cover(track_with_folder_cover.folder, cache)
+
+        if not cover_path and extract:
+            track_with_embedded = obj.tracks.where(Track.has_art).first()
+            if track_with_embedded is not None:
+                cover_id, cover_path = extract_cover(track_with_embedded, cache)
+
+    if not cover_path or not os.path.isfile(cover_path):
+        return None, None
+    return cover_id, cover_path
+
+
+def cover_from_collection(obj, cache, extract=True):
+    """Get a path to cover art from a collection (Album, Folder)
+
+    If `extract` is True, will fall back to extracting cover art from tracks,
+    into cache.
+    Returns None if no cover art is available.
+    """
+
+    return find_cover(obj, cache, extract)[1]
+
+
+def thumbnail_key(cover_id, size):
+    return f"{cover_id}-cover-{size}"
+
+
+def make_thumbnail(path, size):
+    """Resize the image at path to fit in a size x size square
+
+    Returns the resized image data and the mimetype of the image. The data is
+    None if the image is already smaller than that.
+    """
+
+    with Image.open(path) as im:
+        mimetype = f"image/{im.format.lower()}"
+        if size > im.width and size > im.height:
+            return None, mimetype
+
+        im.thumbnail([size, size], Image.Resampling.LANCZOS)
+        with io.BytesIO() as fp:
+            im.save(fp, im.format)
+            return fp.getvalue(), mimetype
@@ -56,11 +56,11 @@ class DaemonClient:
     def get_scanning_progress(self):
         return self._send(ScannerProgressCommand(), True).scanned
 
-    def scan(self, folders=None, force=False):
+    def scan(self, folders=None, force=False, resume=True):
         if folders is None:
             folders = []
         ensure_list(folders)
-        self._send(ScannerStartCommand(folders, force))
+        self._send(ScannerStartCommand(folders, force, resume))
 
     def jukebox_control(self, action, *args):
         ensure_str(action)
@@ -70,6 +70,7 @@ class ScannerStartCommand(ScannerCommand):
 
     folders: list[str] = field(default_factory=list)
     force: bool = False
+    resume: bool = True
 
 
 @dataclass
@@ -86,7 +86,7 @@ class Daemon:
 
     @__handle.register
     def _(self, cmd: ScannerStartCommand, connection):
-        self.start_scan(cmd.folders, cmd.force)
+        self.start_scan(cmd.folders, cmd.force, cmd.resume)
 
     @__handle.register
     def _(self, cmd: JukeboxCommand, connection):
@@ -174,7 +174,7 @@ class Daemon:
 
         self.__listener.close()
 
-    def start_scan(self, folders=None, force=False):
+    def start_scan(self, folders=None, force=False, resume=True):
         if not folders:
             open_connection()
             folders = [
@@ -195,6 +195,9 @@ class Daemon:
             force=force,
             extensions=extensions,
             follow_symlinks=self.__config.BASE["follow_symlinks"],
+            workers=self.__config.BASE["scanner_workers"],
+            batch_size=self.__config.BASE["scanner_batch_size"],
+            resume=resume,
             on_folder_start=self.__unwatch,
             on_folder_end=self.__watch,
         )
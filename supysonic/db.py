@@ -33,13 +33,14 @@ from peewee import (
     Model,
     MySQLDatabase,
     UUIDField,
+    chunked,
     fn,
 )
 from playhouse.db_url import parseresult_to_dict, schemes
 
 from .pathutils import subpath_expr
 
-SCHEMA_VERSION = "20260808"
+SCHEMA_VERSION = "20261019"
 
 
 def now():
@@ -98,6 +99,9 @@ class Folder(PathMixin, _Model):
     created = DateTimeField(default=now)
     cover_art = CharField(null=True)
     last_scan = IntegerField(default=0)
+    # mtime of the directory when its listing was last scanned, 0 if it has to
+    # be listed again on the next scan
+    last_modification = IntegerField(default=0)
 
     parent = ForeignKeyField("self", null=True, backref="children")
 
@@ -162,21 +166,79 @@ class Folder(PathMixin, _Model):
 
     @classmethod
     @db.atomic()
-    def prune(cls):
+    def prune(cls, ids=None):
+        """Delete the folders without any track in their hierarchy
+
+        If ids is given, only these folders and their ancestors are considered.
+        Returns the number of deleted folders.
+        """
+
+        if ids is None and not isinstance(db.obj, MySQLDatabase):
+            return cls.__prune_all()
+
+        # One level at a time, starting with the folders without tracks nor
+        # children, then their parents that might have been left empty.
         alias = cls.alias()
-        query = cls.select(cls.id).where(
+        query = cls.select(cls.id, cls.parent).where(
             ~cls.root,
-            Track.select(fn.count("*")).where(Track.folder == cls.id) == 0,
-            alias.select(fn.count("*")).where(alias.parent == cls.id) == 0,
+            ~fn.EXISTS(Track.select(Track.id).where(Track.folder == cls.id)),
+            ~fn.EXISTS(alias.select(alias.id).where(alias.parent == cls.id)),
+        )
+        total = 0
+        while ids is None or ids:
+            if ids is None:
+                rows = list(query.tuples())
+            else:
+                rows = [
+                    row
+                    for chunk in chunked(ids, 500)
+                    for row in query.where(cls.id.in_(chunk)).tuples()
+                ]
+            if not rows:
+                break
+
+            ids = {parent_id for _, parent_id in rows}
+            total += cls.__delete_pruned(rows)
+
+        return total
+
+    @classmethod
+    def __prune_all(cls):
+        # Folders holding tracks and all their ancestors
+        base = cls.select(cls.id, cls.parent).where(
+            cls.id.in_(Track.select(Track.folder))
+        )
+        cte = base.cte("nonempty", recursive=True, columns=("id", "parent_id"))
+        alias = cls.alias()
+        cte = cte.union(
+            alias.select(alias.id, alias.parent).join(
+                cte, on=(alias.id == cte.c.parent_id)
+            )
         )
+
+        # Children first, so that no row ever references an already deleted one
+        query = (
+            cls.select(cls.id, cls.parent)
+            .where(~cls.root, cls.id.not_in(cte.select_from(cte.c.id)))
+            .order_by(cls.path.desc())
+            .with_cte(cte)
+        )
+        return cls.__delete_pruned(list(query.tuples()))
+
+    @classmethod
+    def __delete_pruned(cls, rows):
+        # The parents' listing no longer has a matching row for these folders,
+        # don't let the scanner skip them
+        parents = {parent_id for _, parent_id in rows}
+        for chunk in chunked(parents, 500):
+            cls.update(last_modification=0).where(cls.id.in_(chunk)).execute()
+
         total = 0
-        while True:
-            clone = query.clone()  # peewee caches the results, clone to force a refetch
-            for f in clone:
-                f.delete_instance(recursive=True)
-                total += 1
-            if not len(clone):
-                return total
+        for chunk in chunked([folder_id for folder_id, _ in rows], 500):
+            RatingFolder.delete().where(RatingFolder.rated.in_(chunk)).execute()
+            StarredFolder.delete().where(StarredFolder.starred.in_(chunk)).execute()
+            total += cls.delete().where(cls.id.in_(chunk)).execute()
+        return total
 
     def delete_hierarchy(self):
         if self.root:
@@ -199,6 +261,7 @@ class Folder(PathMixin, _Model):
         folders = Folder.select(Folder.id).where(path_cond)
         RatingFolder.delete().where(RatingFolder.rated.in_(folders)).execute()
         StarredFolder.delete().where(StarredFolder.starred.in_(folders)).execute()
+        ScanCheckpoint.delete().where(ScanCheckpoint.root_folder.in_(folders)).execute()
 
         deleted_tracks = Track.delete().where(cond).execute()
 
@@ -230,21 +293,34 @@ class Artist(_Model):
         return info
 
     @classmethod
-    def prune(cls):
+    def prune(cls, ids=None):
+        """Delete the artists without albums nor tracks
+
+        If ids is given, only these artists are considered. Returns the number
+        of deleted artists.
+        """
+
         album_artists = Album.select(Album.artist)
         track_artists = Track.select(Track.artist)
 
-        StarredArtist.delete().where(
-            StarredArtist.starred.not_in(album_artists),
-            StarredArtist.starred.not_in(track_artists),
-        ).execute()
+        if ids is None:
+            return cls.__prune(album_artists, track_artists)
+
+        return sum(
+            cls.__prune(album_artists, track_artists, cls.id.in_(chunk))
+            for chunk in chunked(ids, 500)
+        )
+
+    @classmethod
+    def __prune(cls, album_artists, track_artists, *scope):
+        orphans = cls.select(cls.id).where(
+            cls.id.not_in(album_artists), cls.id.not_in(track_artists), *scope
+        )
 
+        StarredArtist.delete().where(StarredArtist.starred.in_(orphans)).execute()
         return (
             cls.delete()
-            .where(
-                cls.id.not_in(album_artists),
-                cls.id.not_in(track_artists),
-            )
+            .where(cls.id.not_in(album_artists), cls.id.not_in(track_artists), *scope)
             .execute()
         )
 
@@ -285,10 +361,27 @@ class Album(_Model):
         return info
 
     @classmethod
-    def prune(cls):
+    def prune(cls, ids=None):
+        """Delete the albums without tracks
+
+        If ids is given, only these albums are considered. Returns the number of
+        deleted albums.
+        """
+
         albums = Track.select(Track.album)
-        StarredAlbum.delete().where(StarredAlbum.starred.not_in(albums)).execute()
-        return cls.delete().where(cls.id.not_in(albums)).execute()
+        if ids is None:
+            StarredAlbum.delete().where(StarredAlbum.starred.not_in(albums)).execute()
+            return cls.delete().where(cls.id.not_in(albums)).execute()
+
+        total = 0
+        for chunk in chunked(ids, 500):
+            StarredAlbum.delete().where(
+                StarredAlbum.starred.in_(chunk), StarredAlbum.starred.not_in(albums)
+            ).execute()
+            total += (
+                cls.delete().where(cls.id.in_(chunk), cls.id.not_in(albums)).execute()
+            )
+        return total
 
 
 class Track(PathMixin, _Model):
@@ -391,6 +484,23 @@ class Track(PathMixin, _Model):
     def suffix(self):
         return os.path.splitext(self.path)[1][1:].lower()
 
+    @classmethod
+    def delete_many(cls, ids):
+        """Delete the tracks with the given ids and what references them
+
+        Returns the number of deleted tracks.
+        """
+
+        total = 0
+        for chunk in chunked(ids, 500):
+            with db.atomic():
+                User.update(last_play=None).where(User.last_play.in_(chunk)).execute()
+                RatingTrack.delete().where(RatingTrack.rated.in_(chunk)).execute()
+                StarredTrack.delete().where(StarredTrack.starred.in_(chunk)).execute()
+                PlaylistTrack.delete().where(PlaylistTrack.track.in_(chunk)).execute()
+                total += cls.delete().where(cls.id.in_(chunk)).execute()
+        return total
+
     def sort_key(self):
         return f"{self.album.artist.name}{self.album.name}{self.disc:02}{self.number:02}{self.title}".lower()
 
@@ -840,6 +950,18 @@ class RadioStation(_Model):
         return info
 
 
+class ScanCheckpoint(_Model):
+    """A directory whose tracks were all saved by a scan that didn't complete
+    yet. Used to resume that scan."""
+
+    root_folder = ForeignKeyField(Folder, backref="+")
+    path_hash = BlobField()
+    forced = BooleanField(default=False)  # scanned regardless of mtimes
+
+    class Meta:
+        primary_key = CompositeKey("root_folder", "path_hash")
+
+
 def get_resource_text(respath):
     return importlib.resources.files(__package__).joinpath(respath).read_text("utf-8")
 
@@ -0,0 +1,206 @@
+# This file is part of Supysonic.
+# Supysonic is a Python implementation of the Subsonic server API.
+#
+# Copyright (C) 2026 Alban 'spl0k' Féron
+#
+# Distributed under terms of the GNU AGPLv3 license.
+
+import logging
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from ..cache import Cache
+from ..covers import cached_cover_id, find_cover, make_thumbnail, thumbnail_key
+from ..db import Folder, Track
+from ..transcoding import (
+    TranscoderPool,
+    get_transcoding_cmdlines,
+    transcode,
+    transcoding_cache_key,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CacheManager:
+    @staticmethod
+    def open_caches(config):
+        """The caches of the web app, as name -> Cache"""
+
+        cache_dir = config.WEBAPP["cache_dir"]
+        return {
+            "cache": Cache(
+                os.path.join(cache_dir, "cache"),
+                config.WEBAPP["cache_size"] * 1024**2,
+            ),
+            "transcodes": Cache(
+                os.path.join(cache_dir, "transcodes"),
+                config.WEBAPP["transcode_cache_size"] * 1024**2,
+            ),
+        }
+
+    @staticmethod
+    def __open_transcoders(config):
+        # Shares the limit on concurrent transcodes with the web app, but
+        # waits for as long as needed
+
+        return TranscoderPool(
+            os.path.join(config.WEBAPP["cache_dir"], "transcoding.sqlite"),
+            config.TRANSCODING["max_transcodes"],
+            max_per_user=config.TRANSCODING["max_transcodes_per_user"],
+            queue_size=None,
+            timeout=None,
+        )
+
+    @staticmethod
+    def covers():
+        """Yield the (cover id, entity) of the cover arts advertised for albums
+        and folders, the entity being either a Folder or a Track"""
+
+        for folder in Folder.select().where(Folder.cover_art.is_null(False)):
+            yield str(folder.id), folder
+
+        # Collections without a folder cover use the embedded art of their
+        # first track having some
+        covered_albums = (
+            Track.select(Track.album)
+            .join(Folder, on=Track.folder)
+            .where(Folder.cover_art.is_null(False))
+        )
+        by_album = {}
+        for aid, tid in (
+            Track.select(Track.album, Track.id)
+            .where(Track.has_art, Track.album.not_in(covered_albums))
+            .tuples()
+        ):
+            by_album.setdefault(aid, tid)
+        by_folder = {}
+        for fid, tid in (
+            Track.select(Track.folder, Track.id)
+            .join(Folder, on=Track.folder)
+            .where(Track.has_art, Folder.cover_art.is_null())
+            .tuples()
+        ):
+            by_folder.setdefault(fid, tid)
+
+        ids = set(by_album.values()) | set(by_folder.values())
+        for track in Track.select().where(Track.id.in_(list(ids))):
+            yield str(track.id), track
+
+    @staticmethod
+    def __missing_thumbnails(cache, cover_id, sizes):
+        return [
+            (size, thumbnail_key(cover_id, size))
+            for size in sizes
+            if not cache.has(thumbnail_key(cover_id, size))
+        ]
+
+    @staticmethod
+    def warm(
+        config, caches, sizes=(), tracks=0, dst_suffix=None, dst_bitrate=128, jobs=4
+    ):
+        """Fill the caches ahead of client requests
+
+        Generates the thumbnails of all album and folder covers at the given
+        sizes, and transcodes the most played tracks to dst_suffix at
+        dst_bitrate, as the stream endpoint would for clients requesting this
+        format and maximum bitrate. Without dst_suffix, as it would for clients
+        only limiting the bitrate: to the configured default transcode target,
+        for tracks over dst_bitrate. Entries already cached are left untouched.
+        Up to jobs thumbnails or transcodes are generated concurrently, the
+        transcodes also waiting for a slot among the ones allowed by the
+        configuration.
+
+        Returns the number of thumbnails and transcodes generated and the
+        number of failures.
+        """
+
+        cache = caches["cache"]
+        transcode_cache = caches["transcodes"]
+        done = {"thumbnails": 0, "transcodes": 0, "errors": 0}
+
+        def make_thumbnails(cover_path, keys):
+            made = 0
+            for size, key in keys:
+                data, _ = make_thumbnail(cover_path, size)
+                if data is not None:  # otherwise served as is
+                    cache.set(key, data)
+                    made += 1
+            return "thumbnails", made
+
+        def make_transcode(key, cmdlines):
+            slot = transcoders.slot("")
+            for _ in transcode_cache.set_generated(
+                key, lambda: transcode(cmdlines, slot=slot)
+            ):
+                pass
+            return "transcodes", 1
+
+        # Database accesses and cover extraction are done here, only the
+        # resizing and transcoding happen in the workers
+        futures = []
+        transcoders = CacheManager.__open_transcoders(config)
+        with closing(transcoders), ThreadPoolExecutor(max_workers=jobs) as executor:
+            queued = set()
+            for cover_id, entity in CacheManager.covers() if sizes else ():
+                if isinstance(entity, Track):
+                    # Embedded art is identified by its contents, which is
+                    # only known once extracted
+                    cover_id = cached_cover_id(entity.id, cache)
+                if cover_id is not None:
+                    keys = CacheManager.__missing_thumbnails(cache, cover_id, sizes)
+                    if not keys or cover_id in queued:
+                        continue
+
+                cover_id, cover_path = find_cover(entity, cache)
+                if cover_path is None or cover_id in queued:
+                    continue
+                keys = CacheManager.__missing_thumbnails(cache, cover_id, sizes)
+                if keys:
+                    queued.add(cover_id)
+                    futures.append(executor.submit(make_thumbnails, cover_path, keys))
+
+            default_format = not dst_suffix
+            if default_format:
+                dst_suffix = config.TRANSCODING.get("default_transcode_target")
+            if tracks and not dst_suffix:
+                logger.warning("No transcoding target, not transcoding any track")
+                tracks = 0
+
+            query = (
+                Track.select()
+                .where(Track.play_count > 0)
+                .order_by(Track.play_count.desc())
+                .limit(tracks)
+            )
+            for track in query if tracks else ():
+                if track.bitrate <= dst_bitrate and (
+                    default_format or track.suffix() == dst_suffix
+                ):
+                    continue  # streamed as is
+
+                bitrate = min(track.bitrate, dst_bitrate)
+                key = transcoding_cache_key(track, bitrate, dst_suffix)
+                if transcode_cache.has(key):
+                    continue
+
+                cmdlines = get_transcoding_cmdlines(
+                    config.TRANSCODING, track, track.suffix(), dst_suffix, bitrate
+                )
+                if cmdlines is None:
+                    logger.warning(
+                        "No way to transcode from %s to %s", track.suffix(), dst_suffix
+                    )
+                    continue
+                futures.append(executor.submit(make_transcode, key, cmdlines))
+
+            for future in futures:
+                try:
+                    kind, count = future.result()
+                    done[kind] += count
+                except Exception:
+                    logger.exception("Error while warming the cache")
+                    done["errors"] += 1
+
+        return done
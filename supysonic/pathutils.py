@@ -6,9 +6,26 @@
 # Distributed under terms of the GNU AGPLv3 license.
 
 import os
+import re
 
 _SEPARATORS = os.sep + (os.altsep or "")
 
+# Types of the network filesystems, as listed in /proc/self/mounts
+_NETWORK_FILESYSTEMS = {
+    "9p",
+    "afs",
+    "ceph",
+    "cifs",
+    "fuse.sshfs",
+    "glusterfs",
+    "lustre",
+    "ncpfs",
+    "nfs",
+    "nfs4",
+    "smb3",
+    "smbfs",
+}
+
 
 def _dir_prefix(path):
     """Return `path` with exactly one trailing separator, the prefix shared by
@@ -38,3 +55,26 @@ def subpath_expr(field, parent):
     whose `field` holds `parent` itself or a path below it."""
 
     return (field == parent) | field.startswith(_dir_prefix(parent))
+
+
+def is_network_path(path, mounts="/proc/self/mounts"):
+    """Tell whether `path` lies on a network filesystem, according to the
+    mounts table. Only available on Linux, paths are assumed to be local
+    elsewhere."""
+
+    path = os.path.realpath(path)
+    try:
+        with open(mounts, encoding="utf-8", errors="surrogateescape") as f:
+            entries = [line.split() for line in f]
+    except OSError:
+        return False
+
+    mountpoint, fstype = "", None
+    for entry in entries:
+        if len(entry) < 3:
+            continue
+        # Spaces and such are escaped as octal
+        point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), entry[1])
+        if is_subpath(path, point) and len(point) >= len(mountpoint):
+            mountpoint, fstype = point, entry[2]
+    return fstype in _NETWORK_FILESYSTEMS
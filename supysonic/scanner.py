@@ -6,23 +6,106 @@
 # Distributed under terms of the GNU AGPLv3 license.
 
 import logging
+import multiprocessing
 import os
 import os.path
 import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from hashlib import sha1
 from queue import Empty as QueueEmpty
 from queue import Queue
 from threading import Event, Thread
 
 import mediafile
+from peewee import chunked
 
 from .covers import CoverFile, find_cover_in_folder
-from .db import Album, Artist, Folder, Track, close_connection, db, open_connection
+from .db import (
+    Album,
+    Artist,
+    Folder,
+    ScanCheckpoint,
+    Track,
+    close_connection,
+    db,
+    open_connection,
+)
 from .parsers import ensure_list, ensure_str
-from .pathutils import is_subpath
+from .pathutils import is_subpath, subpath_expr
 
 logger = logging.getLogger(__name__)
 
+# Track fields a rescan of a file can change
+UPDATED_FIELDS = [
+    Track.disc,
+    Track.number,
+    Track.title,
+    Track.year,
+    Track.genre,
+    Track.duration,
+    Track.has_art,
+    Track.bitrate,
+    Track.size,
+    Track.last_modification,
+    Track.album,
+    Track.artist,
+]
+
+# How many files are handed to the tag reading workers at once, per worker
+TAGS_CHUNK_SIZE = 16
+
+Tags = namedtuple(
+    "Tags",
+    [
+        "artist",
+        "album",
+        "albumartist",
+        "disc",
+        "track",
+        "title",
+        "year",
+        "genre",
+        "length",
+        "has_art",
+        "bitrate",
+    ],
+)
+
+
+def read_tags(path):
+    """Read the tags the scanner needs from an audio file
+
+    Returns None if the file can't be read. This might run in a worker process,
+    hence the picklable return value instead of a MediaFile.
+    """
+
+    try:
+        tag = mediafile.MediaFile(path)
+    except mediafile.UnreadableFileError:
+        return None
+
+    return Tags(
+        tag.artist,
+        tag.album,
+        tag.albumartist,
+        tag.disc,
+        tag.track,
+        tag.title,
+        tag.year,
+        tag.genre,
+        tag.length,
+        bool(tag.images),
+        tag.bitrate,
+    )
+
+
+def _hash_directory(path):
+    # Unlike the paths stored in the database, directories being walked might
+    # not have a valid UTF-8 name
+    return sha1(os.fsencode(path)).digest()
+
 
 class StatsDetails:
     def __init__(self):
@@ -59,6 +142,9 @@ class Scanner(Thread):
         force=False,
         extensions=None,
         follow_symlinks=False,
+        workers=1,
+        batch_size=500,
+        resume=True,
         progress=None,
         on_folder_start=None,
         on_folder_end=None,
@@ -72,6 +158,10 @@ class Scanner(Thread):
         self.__force = force
         self.__extensions = extensions
         self.__follow_symlinks = follow_symlinks
+        self.__workers = workers
+        self.__pool = None
+        self.__batch_size = batch_size
+        self.__resume = resume
 
         self.__progress = progress
         self.__on_folder_start = on_folder_start
@@ -82,6 +172,24 @@ class Scanner(Thread):
         self.__queue = ScanQueue()
         self.__stats = Stats()
         self.__root_folders = None
+        self.__known_tracks = None
+        self.__new_tracks = []
+        self.__updated_tracks = []
+        # Directories whose tracks are all in the buffers above, recorded as
+        # done along with them
+        self.__checkpoint_root = None
+        self.__checkpoint = []
+
+        # Artists, albums and folders found or created during this scan, to
+        # spare a few queries for every track. Pruning clears them.
+        self.__artists = {}
+        self.__albums = {}
+        self.__folders = {}
+
+        # Albums, artists and folders that might have been left empty by the
+        # operations on single files, to only prune these. None when a whole
+        # folder was scanned.
+        self.__touched = (set(), set(), set())
 
     scanned = property(lambda self: self.__stats.scanned)
 
@@ -102,18 +210,30 @@ class Scanner(Thread):
     def run(self):
         opened = open_connection(True)
 
-        while not self.__stopped.is_set():
-            try:
-                folder_name = self.__queue.get(False)
-            except QueueEmpty:
-                break
+        if self.__workers > 1:
+            # Not forking, this might be running in a thread of a multithreaded
+            # process (the daemon)
+            self.__pool = ProcessPoolExecutor(
+                self.__workers, mp_context=multiprocessing.get_context("spawn")
+            )
 
-            try:
-                folder = Folder.get(name=folder_name, root=True)
-            except Folder.DoesNotExist:
-                continue
+        try:
+            while not self.__stopped.is_set():
+                try:
+                    folder_name = self.__queue.get(False)
+                except QueueEmpty:
+                    break
+
+                try:
+                    folder = Folder.get(name=folder_name, root=True)
+                except Folder.DoesNotExist:
+                    continue
 
-            self.__scan_folder(folder)
+                self.__scan_folder(folder)
+        finally:
+            if self.__pool is not None:
+                self.__pool.shutdown(cancel_futures=True)
+                self.__pool = None
 
         self.prune()
 
@@ -132,66 +252,223 @@ class Scanner(Thread):
         if self.__on_folder_start is not None:
             self.__on_folder_start(folder)
 
-        # Scan new/updated files
-        to_scan = [folder.path]
+        self.__touched = None
+
+        # What's already known of this folder's tracks, to decide which files
+        # need to be read again without querying the database for each of them.
+        # Tracks are removed from it as their file is found during the walk.
+        self.__known_tracks = {
+            bytes(path_hash): (mtime, size, track_id, folder_id)
+            for path_hash, mtime, size, track_id, folder_id in Track.select(
+                Track._path_hash,
+                Track.last_modification,
+                Track.size,
+                Track.id,
+                Track.folder,
+            )
+            .where(Track.root_folder == folder)
+            .tuples()
+        }
+
+        # Directories already done by a previous scan of this folder that
+        # didn't complete. A forced scan doesn't resume a non-forced one, which
+        # skipped files that looked unchanged.
+        checkpoint = ScanCheckpoint.select(
+            ScanCheckpoint.path_hash, ScanCheckpoint.forced
+        ).where(ScanCheckpoint.root_folder == folder)
+        done = {bytes(path_hash): forced for path_hash, forced in checkpoint.tuples()}
+        if self.__resume and (not self.__force or all(done.values())):
+            done = set(done)
+        else:
+            done = set()
+            ScanCheckpoint.delete().where(
+                ScanCheckpoint.root_folder == folder
+            ).execute()
+        self.__checkpoint_root = folder
+
+        known_folders = {}
+        children = defaultdict(list)
+        for f in Folder.select().where(subpath_expr(Folder.path, folder.path)):
+            known_folders[f.path] = (f.id, f.last_modification)
+            children[f.parent_id].append(f.path)
+            self.__folders[f.path] = f
+
+        # Scan new/updated files. Files needing their tags to be read are
+        # gathered in chunks so that the workers (if any) can parse them in
+        # parallel, the database is only ever touched from this thread.
+        to_scan = [(folder.path, None)]
+        walked = []
+        listed = []
+        covers = []
+        listed_ids = set()
+        missing_folders = []
+        to_read = []
+        chunk_size = TAGS_CHUNK_SIZE * self.__workers
         scanned = 0
         while not self.__stopped.is_set() and to_scan:
-            path = to_scan.pop()
+            path, mtime = to_scan.pop()
+            if mtime is None:
+                try:
+                    mtime = int(os.stat(path).st_mtime)
+                except FileNotFoundError:
+                    continue
+
+            folder_id, known_mtime = known_folders.get(path, (None, None))
+            if not self.__force and known_mtime == mtime:
+                # Nothing was added, removed or renamed in there since the last
+                # scan. Files modified in place will only be noticed by the
+                # watcher or a forced scan.
+                to_scan.extend((p, None) for p in children[folder_id])
+                continue
+
+            # A directory modified during the same second it is listed could
+            # see further changes going unnoticed, don't rely on its mtime.
+            if mtime >= int(time.time()):
+                mtime = 0
+
+            # Files of a directory done before the scan was interrupted are
+            # left alone, but its subdirectories still have to be walked. Its
+            # listing isn't saved as tracks deleted since weren't looked for.
+            resumed = _hash_directory(path) in done
+
+            subdirs = []
             for entry in os.scandir(path):
                 if entry.name.startswith("."):
                     continue
                 if entry.is_symlink() and not self.__follow_symlinks:
                     continue
                 elif entry.is_dir():
-                    to_scan.append(entry.path)
+                    subdirs.append(entry.path)
+                    to_scan.append((entry.path, int(entry.stat().st_mtime)))
+                elif resumed:
+                    continue
                 elif entry.is_file() and self.__check_extension(entry.path):
-                    self.scan_file(entry)
+                    pending = self.__check_file(entry)
+                    if pending is not None:
+                        to_read.append(pending)
                     self.__stats.scanned += 1
                     scanned += 1
 
                     self.__report_progress(folder.name, scanned)
 
-        # Remove deleted/moved folders
-        folders = [folder]
-        while not self.__stopped.is_set() and folders:
-            f = folders.pop()
-
-            if not f.root and not os.path.isdir(f.path):
-                self.__stats.deleted.tracks += f.delete_hierarchy()
+            # Only directories which had to be listed might have a different
+            # cover than last time
+            covers.append(path)
+            if resumed:
                 continue
 
-            folders += f.children[:]
+            walked.append(path)
+            listed.append((path, mtime, subdirs))
+            if folder_id is not None:
+                listed_ids.add(folder_id)
+                missing_folders += [
+                    (known_folders[p][0], p)
+                    for p in children[folder_id]
+                    if p not in subdirs
+                ]
+
+            if len(to_read) >= chunk_size:
+                self.__read_and_save(to_read)
+                to_read = []
+                self.__checkpoint += walked
+                walked = []
+
+        if not self.__stopped.is_set():
+            self.__read_and_save(to_read)
+        self.__flush()
+        missing_tracks, self.__known_tracks = self.__known_tracks, None
 
-        # Remove files that have been deleted
-        # Could be more efficient if done when walking on the files
         if not self.__stopped.is_set():
-            for track in Track.select().where(Track.root_folder == folder):
-                if not os.path.exists(track.path) or not self.__check_extension(
-                    track.path
-                ):
-                    self.remove_file(track.path)
+            self.__save_listings(folder, listed)
+
+            # Remove deleted/moved folders, found missing from their parent's
+            # listing
+            for folder_id, path in missing_folders:
+                f = Folder(id=folder_id, path=path, root=False)
+                self.__stats.deleted.tracks += f.delete_hierarchy()
+            if missing_folders:
+                self.__folders.clear()
+
+            # Remove files that have been deleted (or no longer match the
+            # extensions), those from listed folders that weren't found
+            self.__stats.deleted.tracks += Track.delete_many(
+                [
+                    track_id
+                    for _, _, track_id, folder_id in missing_tracks.values()
+                    if folder_id in listed_ids
+                ]
+            )
 
         # Update cover art info
-        folders = [folder]
-        while not self.__stopped.is_set() and folders:
-            f = folders.pop()
-            self.find_cover(f.path)
-            folders += f.children[:]
+        for path in covers:
+            if self.__stopped.is_set():
+                break
+
+            try:
+                path.encode("utf-8")  # Badly encoded paths can't have tracks
+            except UnicodeError:
+                continue
+
+            self.find_cover(path)
 
         if not self.__stopped.is_set():
             folder.last_scan = int(time.time())
-            folder.save()
+            folder.save(only=[Folder.last_scan])
+            ScanCheckpoint.delete().where(
+                ScanCheckpoint.root_folder == folder
+            ).execute()
+        self.__checkpoint_root = None
 
         if self.__on_folder_end is not None:
             self.__on_folder_end(folder)
 
+    def __save_listings(self, root, listed):
+        """Record the mtime of the directories that have been listed, so they
+        can be skipped by the next scan if they're left untouched"""
+
+        folders = dict(
+            Folder.select(Folder.path, Folder.id)
+            .where(subpath_expr(Folder.path, root.path))
+            .tuples()
+        )
+
+        updated = []
+        for path, mtime, subdirs in listed:
+            if path not in folders:
+                continue
+
+            # A subdirectory without any track has no folder, and thus wouldn't
+            # be visited if this directory was skipped. Have it listed each time.
+            if not all(s in folders for s in subdirs):
+                mtime = 0
+            updated.append(Folder(id=folders[path], last_modification=mtime))
+
+        with db.atomic():
+            Folder.bulk_update(
+                updated, fields=[Folder.last_modification], batch_size=100
+            )
+
     def prune(self):
         if self.__stopped.is_set():
             return
 
-        self.__stats.deleted.albums += Album.prune()
-        self.__stats.deleted.artists += Artist.prune()
-        Folder.prune()
+        if self.__touched is None:
+            albums = artists = folders = None
+        else:
+            albums, artists, folders = self.__touched
+            # Deleting an album might leave its artist without anything else
+            for chunk in chunked(albums, 500):
+                query = Album.select(Album.artist).where(Album.id.in_(chunk))
+                artists.update(artist_id for artist_id, in query.tuples())
+        self.__touched = (set(), set(), set())
+
+        self.__stats.deleted.albums += Album.prune(albums)
+        self.__stats.deleted.artists += Artist.prune(artists)
+        Folder.prune(folders)
+
+        self.__artists.clear()
+        self.__albums.clear()
+        self.__folders.clear()
 
     def __check_extension(self, path):
         if not self.__extensions:
@@ -199,11 +476,23 @@ class Scanner(Thread):
         return os.path.splitext(path)[1][1:].lower() in self.__extensions
 
     def scan_file(self, path_or_direntry):
+        pending = self.__check_file(path_or_direntry)
+        if pending is not None:
+            self.__read_and_save([pending])
+            self.__flush()
+
+    def __check_file(self, path_or_direntry):
+        """Check if a file needs its tags to be (re)read
+
+        Returns a (path, basename, stat, track_id) tuple if it does, None
+        otherwise. track_id is None for files not yet in the database.
+        """
+
         if isinstance(path_or_direntry, str):
             path = path_or_direntry
 
             if not os.path.exists(path):
-                return
+                return None
 
             basename = os.path.basename(path)
             stat = os.stat(path)
@@ -216,32 +505,69 @@ class Scanner(Thread):
             path.encode("utf-8")  # Test for badly encoded paths
         except UnicodeError:
             self.__stats.errors.append(path)
+            return None
+
+        known = self.__get_known_track(path)
+        if known is None:
+            return path, basename, stat, None
+
+        mtime, size, track_id, _ = known
+        if not self.__force and not int(stat.st_mtime) > mtime:
+            # Tracks migrated from a schema older than 20260808 have no size
+            # yet, and the serializer doesn't fall back to the filesystem.
+            # Backfill it here so a regular scan is enough to fix them up.
+            if size != stat.st_size:
+                Track.update(size=stat.st_size).where(Track.id == track_id).execute()
+            return None
+
+        return path, basename, stat, track_id
+
+    def __get_known_track(self, path):
+        """Return the (last_modification, size, id, folder_id) of the track at
+        path, or None if there isn't any"""
+
+        path_hash = Track._hash_path(path)
+        if self.__known_tracks is not None:
+            return self.__known_tracks.pop(path_hash, None)
+
+        return (
+            Track.select(Track.last_modification, Track.size, Track.id, Track.folder)
+            .where(Track._path_hash == path_hash)
+            .tuples()
+            .first()
+        )
+
+    def __read_and_save(self, pending):
+        if not pending:
             return
 
-        mtime = int(stat.st_mtime)
+        paths = [p[0] for p in pending]
+        if self.__pool is not None and len(pending) > 1:
+            chunksize = max(1, len(paths) // (self.__workers * 4))
+            tags = self.__pool.map(read_tags, paths, chunksize=chunksize)
+        else:
+            tags = map(read_tags, paths)
+
+        for (path, basename, stat, track_id), tag in zip(pending, tags):
+            self.__save_file(path, basename, stat, track_id, tag)
 
-        tr = Track.get_or_none(path=path)
-        if tr is not None:
-            if not self.__force and not mtime > tr.last_modification:
-                # Tracks migrated from a schema older than 20260808 have no size
-                # yet, and the serializer doesn't fall back to the filesystem.
-                # Backfill it here so a regular scan is enough to fix them up.
-                if tr.size != stat.st_size:
-                    tr.size = stat.st_size
-                    tr.save()
-                return
-
-            tag = self.__try_load_tag(path)
-            if tag is None:
+    def __save_file(self, path, basename, stat, track_id, tag):
+        if tag is None:
+            if track_id is not None:
                 self.remove_file(path)
-                return
-            trdict = {}
-        else:
-            tag = self.__try_load_tag(path)
-            if tag is None:
-                return
+            return
 
-            trdict = {"path": path}
+        if track_id is not None and self.__touched is not None:
+            # Its album and artist might change
+            self.__touch(
+                *Track.select(Track.album, Track.artist, Track.folder)
+                .where(Track.id == track_id)
+                .tuples()
+                .get()
+            )
+
+        mtime = int(stat.st_mtime)
+        trdict = {}
 
         artist = (self.__sanitize_str(tag.artist) or "[unknown]")[:255]
         album = (self.__sanitize_str(tag.album) or "[non-album tracks]")[:255]
@@ -253,51 +579,101 @@ class Scanner(Thread):
         trdict["year"] = tag.year
         trdict["genre"] = tag.genre
         trdict["duration"] = int(tag.length)
-        trdict["has_art"] = bool(tag.images)
+        trdict["has_art"] = tag.has_art
 
         trdict["bitrate"] = tag.bitrate // 1000
         trdict["size"] = stat.st_size
         trdict["last_modification"] = mtime
 
-        tralbum = self.__find_album(albumartist, album)
-        trartist = self.__find_artist(artist)
+        trdict["album"] = self.__find_album(albumartist, album)
+        trdict["artist"] = self.__find_artist(artist)
 
-        if tr is None:
+        if track_id is None:
+            trdict["path"] = path
+            trdict["_path_hash"] = Track._hash_path(path)
             trdict["root_folder"] = self.__find_root_folder(path)
             trdict["folder"] = self.__find_folder(path)
-            trdict["album"] = tralbum
-            trdict["artist"] = trartist
             trdict["created"] = datetime.fromtimestamp(mtime)
-
-            try:
-                Track.create(**trdict)
-                self.__stats.added.tracks += 1
-            except ValueError:
-                # Field validation error
-                self.__stats.errors.append(path)
+            self.__new_tracks.append(trdict)
         else:
-            if tr.album.id != tralbum.id:
-                trdict["album"] = tralbum
+            self.__updated_tracks.append((path, Track(id=track_id, **trdict)))
 
-            if tr.artist.id != trartist.id:
-                trdict["artist"] = trartist
+        if len(self.__new_tracks) + len(self.__updated_tracks) >= self.__batch_size:
+            self.__flush()
 
-            try:
-                for attr, value in trdict.items():
-                    setattr(tr, attr, value)
-                tr.save()
-            except ValueError:
-                # Field validation error
-                self.__stats.errors.append(path)
+    def __flush(self):
+        """Write the buffered new and updated tracks to the database"""
+
+        new, self.__new_tracks = self.__new_tracks, []
+        updated, self.__updated_tracks = self.__updated_tracks, []
+        done, self.__checkpoint = self.__checkpoint, []
+        if not new and not updated and not done:
+            return
+
+        try:
+            with db.atomic():
+                self.__write_tracks(new, updated)
+                self.__write_checkpoint(done)
+        except ValueError:
+            # Field validation error. Find out which track(s) it came from by
+            # writing them one at a time.
+            for trdict in new:
+                try:
+                    with db.atomic():
+                        self.__write_tracks([trdict], [])
+                except ValueError:
+                    self.__stats.errors.append(trdict["path"])
+            for path, tr in updated:
+                try:
+                    with db.atomic():
+                        self.__write_tracks([], [(path, tr)])
+                except ValueError:
+                    self.__stats.errors.append(path)
+            self.__write_checkpoint(done)
+
+    def __write_tracks(self, new, updated):
+        # Stay below the bound parameters limit of older SQLite versions
+        for rows in chunked(new, 40):
+            Track.insert_many(rows).execute()
+        self.__stats.added.tracks += len(new)
+
+        if updated:
+            Track.bulk_update(
+                [tr for _, tr in updated], fields=UPDATED_FIELDS, batch_size=40
+            )
+
+    def __write_checkpoint(self, paths):
+        rows = [
+            {
+                ScanCheckpoint.root_folder: self.__checkpoint_root,
+                ScanCheckpoint.path_hash: _hash_directory(path),
+                ScanCheckpoint.forced: self.__force,
+            }
+            for path in paths
+        ]
+        for chunk in chunked(rows, 100):
+            ScanCheckpoint.insert_many(chunk).on_conflict_ignore().execute()
 
     def remove_file(self, path):
         ensure_str(path)
 
         try:
-            Track.get(path=path).delete_instance(recursive=True)
-            self.__stats.deleted.tracks += 1
+            tr = Track.get(path=path)
         except Track.DoesNotExist:
-            pass
+            return
+
+        self.__touch(tr.album_id, tr.artist_id, tr.folder_id)
+        tr.delete_instance(recursive=True)
+        self.__stats.deleted.tracks += 1
+
+    def __touch(self, album_id, artist_id, folder_id):
+        if self.__touched is None:
+            return
+
+        albums, artists, folders = self.__touched
+        albums.add(album_id)
+        artists.add(artist_id)
+        folders.add(folder_id)
 
     def move_file(self, src_path, dst_path):
         ensure_str(src_path)
@@ -311,6 +687,7 @@ class Scanner(Thread):
         except Track.DoesNotExist:
             return
 
+        self.__touch(tr.album_id, tr.artist_id, tr.folder_id)
         with db.atomic():
             try:
                 tr_dst = Track.get(path=dst_path)
@@ -373,19 +750,32 @@ class Scanner(Thread):
 
     def __find_album(self, artist, album):
         ar = self.__find_artist(artist)
-        al = ar.albums.where(Album.name == album).first()
-        if al:
+        key = (ar.id, album)
+        al = self.__albums.get(key)
+        if al is not None:
             return al
 
-        self.__stats.added.albums += 1
-        return Album.create(name=album, artist=ar)
+        al = ar.albums.where(Album.name == album).first()
+        if al is None:
+            self.__stats.added.albums += 1
+            al = Album.create(name=album, artist=ar)
+
+        self.__albums[key] = al
+        return al
 
     def __find_artist(self, artist):
+        ar = self.__artists.get(artist)
+        if ar is not None:
+            return ar
+
         try:
-            return Artist.get(name=artist)
+            ar = Artist.get(name=artist)
         except Artist.DoesNotExist:
             self.__stats.added.artists += 1
-            return Artist.create(name=artist)
+            ar = Artist.create(name=artist)
+
+        self.__artists[artist] = ar
+        return ar
 
     def __find_root_folder(self, path):
         path = os.path.dirname(path)
@@ -409,8 +799,12 @@ class Scanner(Thread):
         folder = None
 
         while path not in (drive, "/"):
+            folder = self.__folders.get(path)
+            if folder is not None:
+                break
+
             try:
-                folder = Folder.get(path=path)
+                folder = self.__folders[path] = Folder.get(path=path)
                 break
             except Folder.DoesNotExist:
                 pass
@@ -431,15 +825,10 @@ class Scanner(Thread):
 
         while children:
             folder = Folder.create(parent=folder, **children.pop())
+            self.__folders[folder.path] = folder
 
         return folder
 
-    def __try_load_tag(self, path):
-        try:
-            return mediafile.MediaFile(path)
-        except mediafile.UnreadableFileError:
-            return None
-
     def __sanitize_str(self, value):
         if value is None:
             return None
@@ -0,0 +1 @@
+ALTER TABLE folder ADD last_modification INTEGER NOT NULL DEFAULT 0;
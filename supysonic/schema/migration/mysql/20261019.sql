@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS scan_checkpoint (
+    root_folder_id INTEGER NOT NULL REFERENCES folder(id),
+    path_hash BINARY(20) NOT NULL,
+    forced BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (root_folder_id, path_hash)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
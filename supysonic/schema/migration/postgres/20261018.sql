@@ -0,0 +1 @@
+ALTER TABLE folder ADD COLUMN last_modification INTEGER NOT NULL DEFAULT 0;
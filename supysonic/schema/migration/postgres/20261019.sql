@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS scan_checkpoint (
+    root_folder_id INTEGER NOT NULL REFERENCES folder,
+    path_hash BYTEA NOT NULL,
+    forced BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (root_folder_id, path_hash)
+);
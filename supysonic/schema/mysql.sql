@@ -7,6 +7,7 @@ CREATE TABLE IF NOT EXISTS folder (
     created DATETIME NOT NULL,
     cover_art VARCHAR(256),
     last_scan INTEGER NOT NULL,
+    last_modification INTEGER NOT NULL DEFAULT 0,
     parent_id INTEGER REFERENCES folder(id)
 ) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 CREATE INDEX index_folder_parent_id_fk ON folder(parent_id);
@@ -169,3 +170,10 @@ CREATE TABLE IF NOT EXISTS radio_station (
     homepage_url VARCHAR(256),
     created DATETIME NOT NULL
 ) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS scan_checkpoint (
+    root_folder_id INTEGER NOT NULL REFERENCES folder(id),
+    path_hash BINARY(20) NOT NULL,
+    forced BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (root_folder_id, path_hash)
+) DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
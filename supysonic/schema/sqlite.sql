@@ -7,6 +7,7 @@ CREATE TABLE IF NOT EXISTS folder (
     created DATETIME NOT NULL,
     cover_art VARCHAR(256),
     last_scan INTEGER NOT NULL,
+    last_modification INTEGER NOT NULL DEFAULT 0,
     parent_id INTEGER REFERENCES folder
 );
 CREATE INDEX IF NOT EXISTS index_folder_parent_id_fk ON folder(parent_id);
@@ -171,3 +172,10 @@ CREATE TABLE IF NOT EXISTS radio_station (
     homepage_url VARCHAR(256),
     created DATETIME NOT NULL
 );
+
+CREATE TABLE IF NOT EXISTS scan_checkpoint (
+    root_folder_id INTEGER NOT NULL REFERENCES folder,
+    path_hash BLOB NOT NULL,
+    forced BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (root_folder_id, path_hash)
+);
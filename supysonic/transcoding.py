@@ -0,0 +1,406 @@
+# This file is part of Supysonic.
+# Supysonic is a Python implementation of the Subsonic server API.
+#
+# Copyright (C) 2013-2026 Alban 'spl0k' Féron
+#               2018-2019 Carey 'pR0Ps' Metcalfe
+#
+# Distributed under terms of the GNU AGPLv3 license.
+
+import contextlib
+import logging
+import os
+import shlex
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .pathutils import is_network_path
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 60  # seconds to wait for other processes to release the queue
+POLL_INTERVAL = 0.25  # seconds between checks for a free slot
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transcodes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    running INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class TranscodersBusy(Exception):
+    """Raised when a transcode can't be started because too many are running
+    or waiting already"""
+
+
+def prepare_transcoding_cmdline(
+    base_cmdline,
+    res,
+    input_format,
+    output_format,
+    output_bitrate,
+    offset=0,
+    duration=None,
+):
+    if not base_cmdline:
+        return None
+    if duration is None:
+        # The rest of the track, whose duration is rounded down
+        duration = res.duration - offset + 1
+    ret = shlex.split(base_cmdline)
+    ret = [
+        part.replace("%srcpath", res.path)
+        .replace("%srcfmt", input_format)
+        .replace("%outfmt", output_format)
+        .replace("%outrate", str(output_bitrate))
+        .replace("%offset", str(offset))
+        .replace("%duration", str(duration))
+        .replace("%title", res.title)
+        .replace("%album", res.album.name)
+        .replace("%artist", res.artist.name)
+        .replace("%tracknumber", str(res.number))
+        .replace("%totaltracks", str(res.album.tracks.count()))
+        .replace("%discnumber", str(res.disc))
+        .replace("%genre", res.genre if res.genre else "")
+        .replace("%year", str(res.year) if res.year else "")
+        for part in ret
+    ]
+    return ret
+
+
+def _select_cmdlines(config, src_suffix, dst_suffix):
+    transcoder = config.get(f"transcoder_{src_suffix}_{dst_suffix}")
+    decoder = config.get("decoder_" + src_suffix) or config.get("decoder")
+    encoder = config.get("encoder_" + dst_suffix) or config.get("encoder")
+    if not transcoder and (not decoder or not encoder):
+        transcoder = config.get("transcoder")
+        if not transcoder:
+            return None
+
+    return transcoder, decoder, encoder
+
+
+def get_transcoding_cmdlines(
+    config, res, src_suffix, dst_suffix, dst_bitrate, offset=0, duration=None
+):
+    """Return the (transcoder, decoder, encoder) command lines to transcode a
+    track, only one of transcoder or decoder and encoder being set
+
+    config is the TRANSCODING section of the configuration. Returns None if
+    there is no way to transcode between the two formats.
+    """
+
+    cmdlines = _select_cmdlines(config, src_suffix, dst_suffix)
+    if cmdlines is None:
+        return None
+
+    return tuple(
+        prepare_transcoding_cmdline(
+            x, res, src_suffix, dst_suffix, dst_bitrate, offset, duration
+        )
+        for x in cmdlines
+    )
+
+
+def _uses_fields(config, src_suffix, dst_suffix, *fields):
+    cmdlines = _select_cmdlines(config, src_suffix, dst_suffix)
+    if cmdlines is None:
+        return False
+
+    transcoder, decoder, encoder = cmdlines
+    used = (transcoder,) if transcoder else (decoder, encoder)
+    return all(any(field in x for x in used) for field in fields)
+
+
+def can_seek(config, src_suffix, dst_suffix):
+    """Whether the command lines transcoding between the two formats can start
+    from a time offset, through the %offset field"""
+
+    return _uses_fields(config, src_suffix, dst_suffix, "%offset")
+
+
+def can_segment(config, src_suffix, dst_suffix):
+    """Whether the command lines transcoding between the two formats can
+    transcode only a part of a track, through the %offset and %duration
+    fields"""
+
+    return _uses_fields(config, src_suffix, dst_suffix, "%offset", "%duration")
+
+
+def transcoding_cache_key(res, dst_bitrate, dst_suffix):
+    return f"{res.id}-{dst_bitrate}.{dst_suffix}"
+
+
+def hls_segment_key(res, dst_bitrate, dst_suffix, segment):
+    return f"{res.id}-{dst_bitrate}-{segment}.{dst_suffix}"
+
+
+def _pid_alive(pid):
+    if sys.platform == "win32":  # pragma: nocover
+        return True  # os.kill would terminate it
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TranscoderPool:
+    """Limits the number of transcodes running at once
+
+    The limit is shared by every process using the same queue file, such as
+    the workers of a WSGI server. Transcodes over the limit wait for a slot in
+    a first come, first served queue. A user already running max_per_user
+    transcodes doesn't hold back the ones queued after theirs.
+
+    A max_transcodes of 0 disables the limit, a max_per_user of 0 disables the
+    per-user one. No more than queue_size transcodes wait at once, each at
+    most timeout seconds. Either can be None for no limit.
+    """
+
+    def __init__(self, path, max_transcodes, max_per_user=0, queue_size=0, timeout=0):
+        self.max_transcodes = max_transcodes
+        self.max_per_user = max_per_user
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._queue = None
+        if not max_transcodes:
+            return
+
+        self._queue = sqlite3.connect(
+            path, timeout=LOCK_TIMEOUT, check_same_thread=False, isolation_level=None
+        )
+        # Like the cache index, see Cache
+        journal = "DELETE" if is_network_path(os.path.dirname(path)) else "WAL"
+        self._queue.execute(f"PRAGMA journal_mode={journal}")
+        self._queue.executescript(QUEUE_SCHEMA)
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Called with self._lock held
+        self._queue.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._queue
+        except BaseException:
+            self._queue.execute("ROLLBACK")
+            raise
+        self._queue.execute("COMMIT")
+
+    @contextlib.contextmanager
+    def slot(self, user):
+        """Wait for a transcode slot for user and hold it within the context
+
+        Raises TranscodersBusy if the queue is full or if no slot got free in
+        time.
+        """
+
+        if self._queue is None:
+            yield
+            return
+
+        ticket = self._enqueue(user)
+        try:
+            self._wait(ticket)
+            yield
+        finally:
+            with self._lock:
+                with self._transaction() as queue:
+                    queue.execute("DELETE FROM transcodes WHERE id = ?", (ticket,))
+                self._released.notify_all()
+
+    def _enqueue(self, user):
+        with self._lock, self._transaction() as queue:
+            # Forget about the transcodes of processes that went away
+            for (pid,) in queue.execute(
+                "SELECT DISTINCT pid FROM transcodes"
+            ).fetchall():
+                if not _pid_alive(pid):
+                    queue.execute("DELETE FROM transcodes WHERE pid = ?", (pid,))
+
+            (waiting,) = queue.execute(
+                "SELECT COUNT(*) FROM transcodes WHERE NOT running"
+            ).fetchone()
+            ticket = queue.execute(
+                "INSERT INTO transcodes (pid, user) VALUES (?, ?)", (os.getpid(), user)
+            ).lastrowid
+            if (
+                self.queue_size is not None
+                and waiting >= self.queue_size
+                and self._next(queue) != (True, ticket)
+            ):
+                raise TranscodersBusy("Transcoding queue is full")  # rolled back
+            return ticket
+
+    def _next(self, queue):
+        """Whether a new transcode can start, and the id of the queued one that
+        should start first, if any"""
+
+        running = dict(
+            queue.execute(
+                "SELECT user, COUNT(*) FROM transcodes WHERE running GROUP BY user"
+            ).fetchall()
+        )
+        if sum(running.values()) >= self.max_transcodes:
+            return False, None
+
+        for ticket, user in queue.execute(
+            "SELECT id, user FROM transcodes WHERE NOT running ORDER BY id"
+        ).fetchall():
+            if not self.max_per_user or running.get(user, 0) < self.max_per_user:
+                return True, ticket
+        return True, None
+
+    def _wait(self, ticket):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._lock:
+            while True:
+                with self._transaction() as queue:
+                    if self._next(queue) == (True, ticket):
+                        queue.execute(
+                            "UPDATE transcodes SET running = 1 WHERE id = ?", (ticket,)
+                        )
+                        return
+
+                wait = POLL_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        logger.warning("Timed out waiting for a transcoding slot")
+                        raise TranscodersBusy(
+                            "Timed out waiting for a transcoding slot"
+                        )
+                    wait = min(remaining, wait)
+                # Woken up early by slots released by this process, others are
+                # polled for
+                self._released.wait(wait)
+
+
+class Pretranscoder:
+    """Transcodes tracks into the transcode cache ahead of their requests, in
+    a background thread
+
+    Also remembers the last playlist each user looked at, to guess what they
+    are listening to.
+    """
+
+    def __init__(self, cache, transcoders, count):
+        self.cache = cache
+        self.transcoders = transcoders
+        self.count = count  # tracks to transcode after the one being streamed
+
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._playlists = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="pretranscoder"
+        )
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def playlist_viewed(self, user_id, playlist_id):
+        with self._lock:
+            self._playlists[user_id] = playlist_id
+
+    def last_playlist(self, user_id):
+        with self._lock:
+            return self._playlists.get(user_id)
+
+    def submit(self, key, cmdlines, user):
+        """Transcode into key unless it is already being or has been done"""
+
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+        self._executor.submit(self._run, key, cmdlines, user)
+
+    def _run(self, key, cmdlines, user):
+        try:
+            if self.cache.has(key):
+                return
+
+            slot = self.transcoders.slot(user)
+            for _ in self.cache.set_generated(
+                key, lambda: transcode(cmdlines, slot=slot)
+            ):
+                pass
+        except Exception:
+            logger.warning("Failed to pretranscode %s", key, exc_info=True)
+        finally:
+            with self._lock:
+                self._queued.discard(key)
+
+
+def transcode(cmdlines, estimate=None, slot=None):
+    """Run the transcoding processes and yield their output
+
+    If given, the slot context manager is entered before starting the
+    processes and held until they are done. Raises OSError if the processes
+    can't be started. If closed once at least 95% of the estimated size was
+    yielded, the remaining data is yielded anyway.
+    """
+
+    with slot if slot is not None else contextlib.nullcontext():
+        transcoder, decoder, encoder = cmdlines
+        if transcoder:
+            dec_proc = None
+            proc = subprocess.Popen(transcoder, stdout=subprocess.PIPE)
+        else:
+            dec_proc = subprocess.Popen(decoder, stdout=subprocess.PIPE)
+            proc = subprocess.Popen(
+                encoder, stdin=dec_proc.stdout, stdout=subprocess.PIPE
+            )
+
+        def read_output():
+            while True:
+                data = proc.stdout.read(8192)
+                if not data:
+                    break
+                yield data
+
+        def kill_processes():
+            if dec_proc is not None:
+                dec_proc.kill()
+            proc.kill()
+
+        try:
+            sent = 0
+            for data in read_output():
+                sent += len(data)
+                yield data
+        except (Exception, SystemExit, KeyboardInterrupt):
+            # Make sure child processes are always killed
+            kill_processes()
+            raise
+        except GeneratorExit:
+            # Try to transcode/send more data if we're close to the end.
+            # The calling code have to support this as yielding more data
+            # after a GeneratorExit would normally raise a RuntimeError.
+            # Hopefully this generator is only used by the cache which
+            # handles this.
+            if estimate and sent >= estimate * 0.95:
+                yield from read_output()
+            else:
+                kill_processes()
+                raise
+        finally:
+            if dec_proc is not None:
+                dec_proc.stdout.close()
+                dec_proc.wait()
+            proc.stdout.close()
+            proc.wait()
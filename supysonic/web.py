@@ -18,6 +18,7 @@ from flask_wtf import CSRFProtect
 from .cache import Cache
 from .config import IniConfig
 from .db import close_connection, get_secret_key, init_database, open_connection
+from .transcoding import Pretranscoder, TranscoderPool
 
 logger = logging.getLogger(__package__)
 
@@ -70,10 +71,32 @@ def create_application(config=None):
     # Max size is MB in the config file but Cache expects bytes
     max_size_cache = app.config["WEBAPP"]["cache_size"] * 1024**2
     max_size_transcodes = app.config["WEBAPP"]["transcode_cache_size"] * 1024**2
-    app.extensions["cache"] = Cache(path.join(cache_path, "cache"), max_size_cache)
+    background_prune = app.config["WEBAPP"]["cache_background_prune"]
+    app.extensions["cache"] = Cache(
+        path.join(cache_path, "cache"),
+        max_size_cache,
+        background_prune=background_prune,
+        memory_size=app.config["WEBAPP"]["cache_memory_size"] * 1024**2,
+    )
     app.extensions["transcode_cache"] = Cache(
-        path.join(cache_path, "transcodes"), max_size_transcodes
+        path.join(cache_path, "transcodes"),
+        max_size_transcodes,
+        background_prune=background_prune,
+    )
+    app.extensions["transcoders"] = TranscoderPool(
+        path.join(cache_path, "transcoding.sqlite"),
+        app.config["TRANSCODING"]["max_transcodes"],
+        max_per_user=app.config["TRANSCODING"]["max_transcodes_per_user"],
+        queue_size=app.config["TRANSCODING"]["transcode_queue_size"],
+        timeout=app.config["TRANSCODING"]["transcode_queue_timeout"],
     )
+    app.extensions["pretranscoder"] = None
+    if app.config["TRANSCODING"]["pretranscode_tracks"]:
+        app.extensions["pretranscoder"] = Pretranscoder(
+            app.extensions["transcode_cache"],
+            app.extensions["transcoders"],
+            app.config["TRANSCODING"]["pretranscode_tracks"],
+        )
 
     # Read or create secret key
     app.secret_key = get_secret_key("cookies_secret")
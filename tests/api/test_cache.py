@@ -0,0 +1,49 @@
+# This file is part of Supysonic.
+# Supysonic is a Python implementation of the Subsonic server API.
+#
+# Copyright (C) 2026 Alban 'spl0k' Féron
+#
+# Distributed under terms of the GNU AGPLv3 license.
+
+from flask import current_app
+
+from .apitestbase import ApiTestBase
+
+
+class CacheTestCase(ApiTestBase):
+    def test_unauthorized(self):
+        self._make_request("getCacheStats", args={"u": "bob", "p": "B0b"}, error=50)
+
+    def test_get_cache_stats(self):
+        with self.app_context():
+            cache = current_app.extensions["cache"]
+            cache.set("key", b"0123456789")
+            cache.get("key")
+            self.assertRaises(KeyError, cache.get, "nope")
+
+        # Not part of the Subsonic API, thus not in its XML schema
+        rv = self.client.get(
+            "/rest/getCacheStats.view",
+            query_string={
+                "u": "alice",
+                "p": "Alic3",
+                "c": "tests",
+                "v": self.apiVersion,
+                "f": "json",
+            },
+        )
+        resp = rv.json["subsonic-response"]
+        self.assertEqual(resp["status"], "ok")
+
+        stats = {c["name"]: c for c in resp["cacheStats"]["cache"]}
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats["cache"]["hits"], 1)
+        self.assertEqual(stats["cache"]["misses"], 1)
+        self.assertEqual(stats["cache"]["entries"], 1)
+        self.assertEqual(stats["cache"]["bytesWritten"], 10)
+        self.assertEqual(stats["cache"]["bytesServed"], 10)
+        self.assertEqual(stats["transcodes"]["hits"], 0)
+        self.assertEqual(
+            stats["transcodes"]["maxSize"],
+            self.config.WEBAPP["transcode_cache_size"] * 1024**2,
+        )
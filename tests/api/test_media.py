@@ -13,9 +13,12 @@ import unittest
 import uuid
 from contextlib import closing
 from io import BytesIO
+from unittest.mock import patch
 
+from flask import current_app
 from PIL import Image
 
+from supysonic.covers import cached_cover_id
 from supysonic.db import Album, Artist, ClientPrefs, Folder, Track, User
 
 from .apitestbase import ApiTestBase
@@ -88,7 +91,7 @@ class MediaTestCase(ApiTestBase):
             error=0,
         )
         self._make_request(
-            "stream", {"id": str(self.trackid), "timeOffset": 2}, error=0
+            "stream", {"id": str(self.trackid), "timeOffset": -1}, error=0
         )
         self._make_request(
             "stream", {"id": str(self.trackid), "size": "640x480"}, error=0
@@ -109,6 +112,43 @@ class MediaTestCase(ApiTestBase):
             self.assertEqual(len(rv.data), 23)
         self.assertEqual(Track[self.trackid].play_count, 1)
 
+    def _stream_offset(self, trackid, offset):
+        return closing(
+            self.client.get(
+                "/rest/stream.view",
+                query_string={
+                    "u": "alice",
+                    "p": "Alic3",
+                    "c": "tests",
+                    "id": str(trackid),
+                    "timeOffset": offset,
+                },
+            )
+        )
+
+    def test_stream_time_offset(self):
+        # Starting from the position estimated from the size and duration,
+        # after the tags
+        with self._stream_offset(self.formats[0], 1) as rv:
+            self.assertEqual(rv.status_code, 200)
+            with open(SILENCE_MP3, "rb") as f:
+                data = f.read()
+            tag = 8122
+            self.assertEqual(rv.data, data[tag + (len(data) - tag) // 2 :])
+
+        # Formats that can't be cut are sent whole
+        with self._stream_offset(self.formats[1], 1) as rv:
+            self.assertEqual(rv.status_code, 200)
+            with open("tests/assets/formats/silence.flac", "rb") as f:
+                self.assertEqual(rv.data, f.read())
+        with self._stream_offset(self.trackid, 1) as rv:
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(len(rv.data), 23)
+
+        # Seeking isn't playing
+        self.assertEqual(Track[self.formats[0]].play_count, 0)
+        self.assertEqual(Track[self.trackid].play_count, 0)
+
     def test_download(self):
         self._make_request("download", error=10)
         self._make_request("download", {"id": "string"}, error=0)
@@ -197,6 +237,19 @@ class MediaTestCase(ApiTestBase):
             self.assertEqual(rv.mimetype, "image/jpeg")
             self.__assert_image_data(rv, "JPEG", 120)
 
+        # and once more, served from memory without looking for the cover
+        with self.app_context():
+            cache = current_app.extensions["cache"]
+        hits = cache.memory_hits
+        with (
+            patch("supysonic.api.media._get_cover", side_effect=AssertionError),
+            closing(self.client.get("/rest/getCoverArt.view", query_string=args)) as rv,
+        ):
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.mimetype, "image/jpeg")
+            self.__assert_image_data(rv, "JPEG", 120)
+        self.assertEqual(cache.memory_hits, hits + 1)
+
         # TODO test non square covers
 
         # Test extracting cover art from embeded media
@@ -208,6 +261,33 @@ class MediaTestCase(ApiTestBase):
                 self.assertEqual(rv.mimetype, "image/png")
                 self.__assert_image_data(rv, "PNG", 120)
 
+    def test_cover_art_shared(self):
+        # silence.mp3 and silence.ogg embed the same image
+        mp3, _, ogg, _ = self.formats
+        args = {"u": "alice", "p": "Alic3", "c": "tests", "size": 120}
+        with closing(
+            self.client.get("/rest/getCoverArt.view", query_string=args | {"id": mp3})
+        ) as rv:
+            self.assertEqual(rv.status_code, 200)
+
+        with self.app_context():
+            cache = current_app.extensions["cache"]
+        self.assertIsNotNone(cached_cover_id(mp3, cache))
+        self.assertIsNone(cached_cover_id(ogg, cache))
+
+        # It is extracted for the other track but only resized once
+        with (
+            patch("supysonic.api.media.make_thumbnail", side_effect=AssertionError),
+            closing(
+                self.client.get(
+                    "/rest/getCoverArt.view", query_string=args | {"id": ogg}
+                )
+            ) as rv,
+        ):
+            self.assertEqual(rv.status_code, 200)
+            self.__assert_image_data(rv, "PNG", 120)
+        self.assertEqual(cached_cover_id(mp3, cache), cached_cover_id(ogg, cache))
+
     def test_stream_client_prefs(self):
         # Client preferences drive the destination format/bitrate when the
         # request doesn't specify them. A lower preferred bitrate forces
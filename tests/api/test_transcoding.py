@@ -6,14 +6,21 @@
 # Distributed under terms of the GNU AGPLv3 license.
 
 import os
+import shutil
+import subprocess
+import tempfile
+import time
 import unittest
+from unittest.mock import patch
 
 from flask import current_app
 
-from supysonic.db import Track
+from supysonic.db import Playlist, Track, User
 from supysonic.managers.folder import FolderManager
 from supysonic.scanner import Scanner
+from supysonic.transcoding import Pretranscoder, TranscoderPool
 
+from ..testbase import _tool_cmd
 from .apitestbase import ApiTestBase
 
 
@@ -28,17 +35,22 @@ class TranscodingTestCase(ApiTestBase):
 
         self.trackid = Track.get().id
 
-    def _stream(self, **kwargs):
+    def _stream(self, headers=None, **kwargs):
         kwargs.update(
             {"u": "alice", "p": "Alic3", "c": "tests", "v": "1.9.0", "id": self.trackid}
         )
 
-        rv = self.client.get("/rest/stream.view", query_string=kwargs)
-        self.assertEqual(rv.status_code, 200)
+        rv = self.client.get("/rest/stream.view", query_string=kwargs, headers=headers)
+        self.assertIn(rv.status_code, (200, 206))
         self.assertFalse(rv.mimetype.startswith("text/"))
 
         return rv
 
+    def _no_reconnect(self):
+        # Transcodes stopped as soon as the client leaves
+        with self.app_context():
+            current_app.extensions["transcode_cache"].reconnect_time = 0
+
     def test_no_transcoding_available(self):
         self._make_request("stream", {"id": self.trackid, "format": "wat"}, error=0)
 
@@ -57,6 +69,7 @@ class TranscodingTestCase(ApiTestBase):
         self.assertTrue(rv.data.startswith(b"dbb16c0847e5d8c3b1867604828cb50b"))
 
     def test_mostly_transcoded_cached(self):
+        self._no_reconnect()
         # See https://github.com/spl0k/supysonic/issues/202
 
         rv = self._stream(maxBitRate=96, estimateContentLength="true", format="rnd")
@@ -76,6 +89,7 @@ class TranscodingTestCase(ApiTestBase):
             self.assertEqual(cache.size, 52000)
 
     def test_partly_transcoded_cached(self):
+        self._no_reconnect()
         rv = self._stream(maxBitRate=96, estimateContentLength="true", format="rnd")
 
         # read one check of data then close the connection
@@ -90,6 +104,7 @@ class TranscodingTestCase(ApiTestBase):
             self.assertEqual(cache.size, 0)
 
     def test_last_chunk_close_transcoded_cached(self):
+        self._no_reconnect()
         rv = self._stream(maxBitRate=96, estimateContentLength="true", format="rnd")
 
         read = 0
@@ -106,6 +121,360 @@ class TranscodingTestCase(ApiTestBase):
             self.assertTrue(cache.has(key))
             self.assertEqual(cache.size, 52000)
 
+    def test_transcoder_not_found(self):
+        with self.app_context():
+            current_app.config["TRANSCODING"]["transcoder_mp3_nope"] = "nope-nope"
+        self._make_request("stream", {"id": self.trackid, "format": "nope"}, error=0)
+
+    def test_concurrent_transcodes_shared(self):
+        with patch("subprocess.Popen", wraps=subprocess.Popen) as popen:
+            rv1 = self._stream(maxBitRate=96, format="rnd")
+            rv2 = self._stream(maxBitRate=96, format="rnd")
+
+            # Random data, only the same if it comes from the same process
+            data1 = rv1.data
+            self.assertEqual(len(data1), 52000)
+            self.assertEqual(rv2.data, data1)
+            rv1.close()
+            rv2.close()
+
+        popen.assert_called_once()
+
+    def test_follower_keeps_transcoding_alive(self):
+        rv1 = self._stream(maxBitRate=96, estimateContentLength="true", format="rnd")
+        next(iter(rv1.response))
+        rv2 = self._stream(maxBitRate=96, estimateContentLength="true", format="rnd")
+
+        # The first client leaving doesn't abort what the second one reads
+        rv1.response.close()
+        rv1.close()
+        self.assertEqual(len(rv2.data), 52000)
+        rv2.close()
+
+        key = f"{self.trackid}-96.rnd"
+        with self.app_context():
+            cache = current_app.extensions["transcode_cache"]
+            self.assertTrue(cache.has(key))
+            self.assertEqual(cache.size, 52000)
+
+    def test_transcodes_limited(self):
+        # Unlimited by default
+        with self.app_context():
+            current_app.extensions["transcoders"] = transcoders = TranscoderPool(
+                os.path.join(self.config.WEBAPP["cache_dir"], "transcoding.sqlite"), 1
+            )
+        self.addCleanup(transcoders.close)
+        self._no_reconnect()
+
+        rv1 = self._stream(maxBitRate=96, estimateContentLength="true", format="rnd")
+        next(iter(rv1.response))
+        rv = self._make_request(
+            "stream", {"id": self.trackid, "format": "cat"}, error=0
+        )
+        self.assertIn(b"try again later", rv.data)
+
+        # The slot is released along with the response
+        rv1.response.close()
+        rv1.close()
+        rv = self._stream(format="cat")
+        self.assertEqual(rv.data, b"Pushing out some mp3 data...")
+
+    def test_time_offset_seeking_transcoder(self):
+        with self.app_context():
+            current_app.config["TRANSCODING"]["transcoder_mp3_seek"] = _tool_cmd(
+                "echo", "%srcpath", "%offset"
+            )
+
+        rv = self._stream(format="seek", timeOffset=3)
+        self.assertTrue(rv.data.endswith(b" 3"))
+        rv.close()
+
+        # Partial transcodes aren't cached, nor counted as plays
+        with self.app_context():
+            cache = current_app.extensions["transcode_cache"]
+            self.assertEqual(cache.size, 0)
+        self.assertEqual(Track[self.trackid].play_count, 0)
+
+        rv = self._stream(format="seek")
+        self.assertTrue(rv.data.endswith(b" 0"))
+        rv.close()
+        self.assertEqual(Track[self.trackid].play_count, 1)
+
+    def test_time_offset(self):
+        with self.app_context():
+            current_app.config["TRANSCODING"]["transcoder_mp3_ogg"] = _tool_cmd(
+                "urandom", "52000"
+            )
+
+        # Skips the estimated 2s at 96kbps
+        rv = self._stream(
+            maxBitRate=96, estimateContentLength="true", format="ogg", timeOffset=2
+        )
+        self.assertEqual(rv.content_length, 24000)
+        self.assertEqual(len(rv.data), 28000)
+        rv.close()
+
+        # The whole track got transcoded, later seeks read from the cache
+        key = f"{self.trackid}-96.ogg"
+        with self.app_context():
+            cache = current_app.extensions["transcode_cache"]
+            self.assertTrue(cache.has(key))
+            data = cache.get_value(key)
+
+        with patch("subprocess.Popen", side_effect=AssertionError):
+            rv = self._stream(maxBitRate=96, format="ogg", timeOffset=3)
+        self.assertEqual(rv.content_length, 13000)
+        self.assertEqual(rv.data, data[-13000:])
+        rv.close()
+
+        rv = self._stream(maxBitRate=96, format="ogg", timeOffset=10)
+        self.assertEqual(rv.data, b"")
+        rv.close()
+
+    def test_time_offset_whole(self):
+        # Formats that can't be cut are sent whole, from the transcoder
+        rv = self._stream(
+            maxBitRate=96, estimateContentLength="true", format="rnd", timeOffset=2
+        )
+        self.assertEqual(rv.content_length, 48000)
+        data = rv.data
+        self.assertEqual(len(data), 52000)
+        rv.close()
+
+        # and from the cache
+        with patch("subprocess.Popen", side_effect=AssertionError):
+            rv = self._stream(maxBitRate=96, format="rnd", timeOffset=3)
+        self.assertEqual(rv.data, data)
+        rv.close()
+
+    def test_range_in_progress(self):
+        rv1 = self._stream(maxBitRate=96, format="rnd")
+        # Ranges not transcoded yet aren't honored
+        self.assertNotIn("Accept-Ranges", rv1.headers)
+        it = iter(rv1.response)
+        first = next(it)
+
+        # Served from what was transcoded already
+        rv = self._stream(maxBitRate=96, format="rnd", headers={"Range": "bytes=10-19"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.headers["Content-Range"], "bytes 10-19/*")
+        self.assertEqual(rv.data, first[10:20])
+        rv.close()
+
+        rv = self._stream(maxBitRate=96, format="rnd", headers={"Range": "bytes=10-"})
+        self.assertEqual(rv.status_code, 206)
+        self.assertTrue(first[10:].startswith(rv.data))
+        rv.close()
+
+        # Not there yet, streamed from the start along with the first request
+        rv = self._stream(
+            maxBitRate=96, format="rnd", headers={"Range": "bytes=60000-"}
+        )
+        rv1.response.close()
+        rv1.close()
+        self.assertEqual(rv.status_code, 200)
+        data = rv.data
+        self.assertEqual(len(data), 52000)
+        self.assertEqual(data[: len(first)], first)
+        rv.close()
+
+        # Exact ranges once done
+        rv = self._stream(
+            maxBitRate=96, format="rnd", headers={"Range": "bytes=100-199"}
+        )
+        self.assertEqual(rv.status_code, 206)
+        self.assertEqual(rv.headers["Content-Range"], "bytes 100-199/52000")
+        self.assertEqual(rv.data, data[100:200])
+        rv.close()
+
+    def test_reconnect(self):
+        rv1 = self._stream(maxBitRate=96, format="rnd")
+        first = next(iter(rv1.response))
+        rv1.response.close()
+        rv1.close()
+
+        # The connection dropped, the client comes back where it was
+        rv = self._stream(maxBitRate=96, format="rnd", headers={"Range": "bytes=100-"})
+        self.assertEqual(rv.status_code, 206)
+        data = rv.data
+        self.assertTrue(data)
+        self.assertEqual(data[: len(first) - 100], first[100:])
+        rv.close()
+
+    def _hls(self, endpoint="hls.m3u8", **kwargs):
+        kwargs.update(
+            {"u": "alice", "p": "Alic3", "c": "tests", "v": "1.9.0", "id": self.trackid}
+        )
+        return self.client.get(f"/rest/{endpoint}", query_string=kwargs)
+
+    def test_hls(self):
+        with self.app_context():
+            current_app.config["TRANSCODING"]["transcoder_mp3_mp3"] = _tool_cmd(
+                "echo", "%srcpath", "%offset", "%duration"
+            )
+        Track.update(duration=25).where(Track.id == self.trackid).execute()
+
+        rv = self._hls()
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, "application/vnd.apple.mpegurl")
+        lines = rv.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], "#EXTM3U")
+        self.assertEqual(lines[-1], "#EXT-X-ENDLIST")
+        self.assertEqual(
+            [line for line in lines if line.startswith("#EXTINF")],
+            ["#EXTINF:10,", "#EXTINF:10,", "#EXTINF:5,"],
+        )
+        urls = [line for line in lines if not line.startswith("#")]
+        self.assertEqual(len(urls), 3)
+        self.assertIn("u=alice", urls[2])
+        self.assertIn("segment=2", urls[2])
+        self.assertEqual(Track[self.trackid].play_count, 1)
+
+        rv = self.client.get(urls[1])
+        self.assertTrue(rv.data.endswith(b" 10 10"))
+        rv.close()
+
+        rv = self.client.get(urls[2])
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, "audio/mpeg")
+        self.assertTrue(rv.data.endswith(b" 20 6"))  # until the end of the track
+        data = rv.data
+        rv.close()
+
+        # Segments are cached individually
+        with self.app_context():
+            cache = current_app.extensions["transcode_cache"]
+            key = f"{self.trackid}-{Track[self.trackid].bitrate}-2.mp3"
+            self.assertEqual(cache.get_value(key), data)
+        with patch("subprocess.Popen", side_effect=AssertionError):
+            rv = self.client.get(urls[2])
+        self.assertEqual(rv.data, data)
+        rv.close()
+
+        self._make_request("hlsSegment", {"id": self.trackid, "segment": 3}, error=70)
+
+    def test_hls_variants(self):
+        with self.app_context():
+            current_app.config["TRANSCODING"]["transcoder_mp3_mp3"] = _tool_cmd(
+                "echo", "%srcpath", "%offset", "%duration"
+            )
+
+        rv = self._hls(bitRate=[32, "64@480x360"])
+        lines = rv.get_data(as_text=True).splitlines()
+        self.assertEqual(
+            [line for line in lines if line.startswith("#EXT-X-STREAM-INF")],
+            ["#EXT-X-STREAM-INF:BANDWIDTH=32000", "#EXT-X-STREAM-INF:BANDWIDTH=64000"],
+        )
+        self.assertIn("bitRate=64", lines[-1])
+        self.assertEqual(Track[self.trackid].play_count, 0)
+
+        rv = self.client.get(lines[-1])
+        self.assertIn("#EXT-X-ENDLIST", rv.get_data(as_text=True))
+
+        self._make_request("hls", {"id": self.trackid, "bitRate": "wat"}, error=0)
+
+    def test_hls_lossless(self):
+        with self.app_context():
+            current_app.config["TRANSCODING"]["transcoder_flac_mp3"] = _tool_cmd(
+                "echo", "%srcpath", "%outrate", "%offset", "%duration"
+            )
+        Track.update(
+            path=os.path.abspath("tests/assets/formats/silence.flac"), bitrate=1000
+        ).where(Track.id == self.trackid).execute()
+
+        # Switched to MP3 at a bitrate it supports
+        rv = self._hls()
+        lines = rv.get_data(as_text=True).splitlines()
+        rv = self.client.get(lines[-2])
+        self.assertEqual(rv.mimetype, "audio/mpeg")
+        self.assertIn(b" 320 ", rv.data)
+        rv.close()
+
+    def test_hls_not_segmenting(self):
+        self._make_request("hls", {"id": self.trackid}, error=0)
+        self._make_request("hlsSegment", {"id": self.trackid, "segment": 0}, error=0)
+
+        # Starting from an offset isn't enough, segments have to end on time
+        with self.app_context():
+            current_app.config["TRANSCODING"]["transcoder_mp3_mp3"] = _tool_cmd(
+                "echo", "%srcpath", "%offset"
+            )
+        self._make_request("hls", {"id": self.trackid}, error=0)
+        self._make_request("hlsSegment", {"id": self.trackid, "segment": 0}, error=0)
+
+    def _pretranscoding(self, count):
+        with self.app_context():
+            pretranscoder = Pretranscoder(
+                current_app.extensions["transcode_cache"],
+                current_app.extensions["transcoders"],
+                count,
+            )
+            current_app.extensions["pretranscoder"] = pretranscoder
+        self.addCleanup(pretranscoder.close)
+
+        track = Track[self.trackid]
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        tracks = []
+        for number in range(1, 4):
+            path = os.path.join(tmp, f"{number}.mp3")
+            shutil.copyfile(track.path, path)
+            tracks.append(
+                Track.create(
+                    title=f"Track {number}",
+                    number=number,
+                    disc=1,
+                    artist=track.artist,
+                    album=track.album,
+                    path=path,
+                    root_folder=track.root_folder,
+                    folder=track.folder,
+                    duration=4,
+                    bitrate=track.bitrate,
+                    last_modification=0,
+                ).id
+            )
+        return tracks
+
+    def _wait_cached(self, key):
+        with self.app_context():
+            cache = current_app.extensions["transcode_cache"]
+        for _ in range(100):
+            if cache.has(key):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_pretranscode_album(self):
+        tracks = self._pretranscoding(2)
+
+        # Streamed as is, nothing to prepare
+        with self.app_context():
+            pretranscoder = current_app.extensions["pretranscoder"]
+        with patch.object(pretranscoder, "submit") as submit:
+            self._stream().close()
+        submit.assert_not_called()
+
+        self._stream(maxBitRate=96, format="rnd").close()
+        self.assertTrue(self._wait_cached(f"{tracks[0]}-96.rnd"))
+        self.assertTrue(self._wait_cached(f"{tracks[1]}-96.rnd"))
+        with self.app_context():
+            cache = current_app.extensions["transcode_cache"]
+            self.assertFalse(cache.has(f"{tracks[2]}-96.rnd"))
+
+    def test_pretranscode_playlist(self):
+        tracks = self._pretranscoding(2)
+        playlist = Playlist.create(user=User.get(name="alice"), name="list")
+        playlist.add(self.trackid)
+        playlist.add(tracks[2])
+        self._make_request("getPlaylist", {"id": str(playlist.id)}, tag="playlist")
+
+        self._stream(maxBitRate=96, format="rnd").close()
+        self.assertTrue(self._wait_cached(f"{tracks[2]}-96.rnd"))
+        with self.app_context():
+            cache = current_app.extensions["transcode_cache"]
+            self.assertFalse(cache.has(f"{tracks[0]}-96.rnd"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -10,11 +10,12 @@ import errno
 import os
 import shutil
 import tempfile
+import threading
 import time
 import unittest
 from unittest.mock import patch
 
-from supysonic.cache import Cache, CacheMiss, ProtectedError
+from supysonic.cache import INDEX_DIR, Cache, CacheMiss, ProtectedError
 
 
 class CacheTestCase(unittest.TestCase):
@@ -24,6 +25,21 @@ class CacheTestCase(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.__dir)
 
+    def __files(self):
+        files = []
+        for root, dirs, names in os.walk(self.__dir):
+            if INDEX_DIR in dirs:
+                dirs.remove(INDEX_DIR)
+            files.extend(names)
+        return files
+
+    @staticmethod
+    def __wait_generated(cache, key):
+        for _ in range(500):
+            if cache.has(key):
+                return
+            time.sleep(0.01)
+
     def test_makedirs_error_propagates(self):
         # An error other than "already exists" while creating the cache dir
         # must not be swallowed.
@@ -41,6 +57,7 @@ class CacheTestCase(unittest.TestCase):
         # file mtime is accurate to the second
         time.sleep(1)
         cache.get_value("key1")
+        cache.close()
 
         cache = Cache(self.__dir, 30, min_time=0)
         self.assertEqual(cache.size, 30)
@@ -55,6 +72,290 @@ class CacheTestCase(unittest.TestCase):
         self.assertTrue(cache.has("key3"))
         self.assertTrue(cache.has("key4"))
 
+    def test_index_reused(self):
+        cache = Cache(self.__dir, 30)
+        cache.set("key1", b"0123456789")
+        cache.set("key2", b"0123456789")
+        cache.close()
+
+        with patch("os.scandir", side_effect=AssertionError("scanned")):
+            cache = Cache(self.__dir, 30)
+        self.assertEqual(cache.size, 20)
+        self.assertTrue(cache.has("key1"))
+        self.assertTrue(cache.has("key2"))
+        cache.close()
+
+    def test_index_rebuilt(self):
+        cache = Cache(self.__dir, 30)
+        cache.set("key1", b"0123456789")
+        cache.set("key2", b"0123456789")
+        cache.close()
+
+        # Changes made behind the cache's back
+        time.sleep(0.01)
+        shutil.rmtree(os.path.dirname(os.path.dirname(cache._filepath("key1"))))
+        with open(os.path.join(self.__dir, "key3"), "wb") as f:
+            f.write(b"01234")
+
+        cache = Cache(self.__dir, 30)
+        self.assertEqual(cache.size, 15)
+        self.assertFalse(cache.has("key1"))
+        self.assertTrue(cache.has("key2"))
+        self.assertTrue(cache.has("key3"))
+        cache.close()
+
+    def test_sharded_layout(self):
+        cache = Cache(self.__dir, 30)
+        path = cache.set("key1", b"0123456789")
+        self.assertEqual(
+            os.path.relpath(path, self.__dir), os.path.join("10", "73", "key1")
+        )
+        self.assertEqual(cache.get_value("key1"), b"0123456789")
+
+    def test_flat_layout_migrated(self):
+        # As stored by older versions
+        for key in ("key1", "key2"):
+            with open(os.path.join(self.__dir, key), "wb") as f:
+                f.write(b"0123456789")
+
+        cache = Cache(self.__dir, 30)
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(cache.get_value("key1"), b"0123456789")
+        self.assertEqual(cache.get_value("key2"), b"0123456789")
+        self.assertEqual(
+            sorted(os.listdir(self.__dir)), sorted([INDEX_DIR, "10", "87"])
+        )
+        cache.close()
+
+    def test_missing_file_forgotten(self):
+        cache = Cache(self.__dir, 30)
+        cache.set("key1", b"0123456789")
+        os.remove(cache._filepath("key1"))
+
+        self.assertFalse(cache.has("key1"))
+        self.assertEqual(cache.size, 0)
+        self.assertRaises(CacheMiss, cache.get, "key1")
+
+    def test_shared_index(self):
+        # Two instances on the same directory, as in two worker processes
+        cache1 = Cache(self.__dir, 20, min_time=0)
+        cache2 = Cache(self.__dir, 20, min_time=0)
+
+        cache1.set("key1", b"0123456789")
+        self.assertTrue(cache2.has("key1"))
+        self.assertEqual(cache2.size, 10)
+
+        time.sleep(0.01)
+        cache2.set("key2", b"0123456789")
+        time.sleep(0.01)
+        cache2.get("key1")
+        cache2.flush()
+
+        # Evicts the entry least recently used by either instance
+        cache1.set("key3", b"0123456789")
+        self.assertEqual(cache1.size, 20)
+        self.assertEqual(cache2.size, 20)
+        self.assertTrue(cache2.has("key1"))
+        self.assertFalse(cache2.has("key2"))
+        self.assertTrue(cache2.has("key3"))
+
+        cache1.close()
+        cache2.close()
+
+    def test_shared_index_concurrent_writes(self):
+        caches = [Cache(self.__dir, 100, min_time=0) for _ in range(4)]
+
+        def fill(cache, n):
+            for i in range(20):
+                cache.set(f"key{n}-{i}", b"0123456789")
+
+        threads = [
+            threading.Thread(target=fill, args=(c, n)) for n, c in enumerate(caches)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # The limit held across all instances and they agree on the size
+        files = self.__files()
+        self.assertEqual(len(files), 10)
+        for cache in caches:
+            self.assertEqual(cache.size, 100)
+            self.assertTrue(all(cache.has(f) for f in files))
+            cache.close()
+
+    def test_background_prune(self):
+        cache = Cache(self.__dir, 30, min_time=0, background_prune=True)
+        evict = cache._evict
+        evicting = threading.Event()
+        go_on = threading.Event()
+
+        def slow_evict(target):
+            evicting.set()
+            go_on.wait(5)
+            evict(target)
+
+        cache._evict = slow_evict
+        val = b"0123456789"
+        for i in range(4):
+            cache.set(f"key{i}", val)
+            time.sleep(0.01)
+        self.assertTrue(evicting.wait(5))
+
+        # Writes go on while the pruner is busy
+        cache.set("key4", val)
+        self.assertEqual(cache.size, 50)
+
+        # Evicts below the low watermark
+        go_on.set()
+        for _ in range(50):
+            if cache.size <= 27:
+                break
+            time.sleep(0.1)
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(sorted(self.__files()), ["key3", "key4"])
+
+        cache.close()
+        self.assertFalse(cache._pruner.is_alive())
+
+    def test_memory_tier(self):
+        cache = Cache(self.__dir, 100, min_time=0, memory_size=25, memory_entry_size=10)
+        cache.set("key1", b"0123456789")
+        cache.set("key2", b"0123456789")
+        cache.set("big", b"0123456789a")
+
+        # Served from memory, no file access
+        with (
+            patch("builtins.open", side_effect=AssertionError("opened")),
+            patch("os.utime", side_effect=AssertionError("touched")),
+        ):
+            self.assertEqual(cache.get_value("key1"), b"0123456789")
+            self.assertEqual(cache.get_value("key2"), b"0123456789")
+        self.assertEqual(cache.memory_hits, 2)
+        self.assertEqual(cache.memory_misses, 0)
+
+        # Too big to be kept in memory
+        self.assertEqual(cache.get_value("big"), b"0123456789a")
+        self.assertEqual(cache.get_value("big"), b"0123456789a")
+        self.assertEqual(cache.memory_misses, 2)
+
+        # Over budget, the least recently used one is dropped
+        cache.set("key3", b"0123456789")
+        cache.get_value("key2")
+        self.assertEqual(cache.memory_hits, 3)
+        cache.get_value("key1")
+        self.assertEqual(cache.memory_misses, 3)
+
+        # Updated and deleted entries don't linger in memory
+        cache.set("key1", b"9876543210")
+        self.assertEqual(cache.get_value("key1"), b"9876543210")
+        with cache.set_fileobj("key1") as f:
+            f.write(b"0000")
+        self.assertEqual(cache.get_value("key1"), b"0000")
+        cache.delete("key1")
+        self.assertRaises(CacheMiss, cache.get_value, "key1")
+
+    def test_stats(self):
+        cache = Cache(self.__dir, 20, min_time=0)
+        cache.set("key1", b"0123456789")
+        cache.set("key2", b"0123456789")
+        cache.get("key1")
+        self.assertRaises(CacheMiss, cache.get, "nope")
+        cache.set("key3", b"01234")  # evicts key2
+
+        cache2 = Cache(self.__dir, 20, min_time=60, memory_size=100)
+        self.assertEqual(cache2.get_value("key3"), b"01234")
+        self.assertEqual(cache2.get_value("key3"), b"01234")  # from memory
+        cache2.set("key4", b"0123456789")  # key1 and key3 protected
+        cache2.close()
+
+        self.assertEqual(
+            cache.stats(),
+            {
+                "hits": 3,
+                "misses": 1,
+                "evictions": 1,
+                "protected_skips": 2,
+                "bytes_written": 35,
+                "bytes_served": 20,
+                "size": 25,
+                "max_size": 20,
+                "entries": 3,
+            },
+        )
+
+    def test_network_filesystem(self):
+        cache = Cache(self.__dir, 30)
+        mode = cache._index.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+        cache.close()
+
+        # No WAL on network filesystems, for directories already using it too
+        with patch("supysonic.cache.is_network_path", return_value=True):
+            cache = Cache(self.__dir, 30)
+        mode = cache._index.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "delete")
+        cache.set("key1", b"0123456789")
+        self.assertTrue(cache.has("key1"))
+        cache.close()
+
+    def test_hot_reads(self):
+        cache = Cache(self.__dir, 30)
+        path = cache.set("key1", b"0123456789")
+        cache.get("key1")
+
+        # While another thread holds the index, such as a writer waiting for
+        # another process
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with cache._lock:
+                locked.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        self.assertTrue(locked.wait(5))
+        try:
+            # Only checking that the file is still there
+            with patch("os.utime", side_effect=AssertionError):
+                for _ in range(10):
+                    self.assertEqual(cache.get("key1"), path)
+        finally:
+            release.set()
+            holder.join()
+
+        self.assertEqual(cache.stats()["hits"], 11)
+
+    def test_hot_read_evicted_elsewhere(self):
+        cache = Cache(self.__dir, 30)
+        cache.set("key1", b"0123456789")
+        cache.get("key1")
+
+        # Evicted by another process, not knowing about the recent read yet
+        other = Cache(self.__dir, 30, min_time=0)
+        other.delete("key1")
+        other.close()
+
+        self.assertRaises(CacheMiss, cache.get, "key1")
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_access_times_flushed(self):
+        cache = Cache(self.__dir, 30)
+        path = cache.set("key1", b"0123456789")
+        os.utime(path, (1000, 1000))
+        cache._index.execute("UPDATE entries SET atime = 1000")
+
+        cache.get("key1")
+        self.assertEqual(cache._entry("key1")[1], 1000)
+        self.assertEqual(os.stat(path).st_mtime, 1000)
+
+        cache.flush()
+        self.assertGreater(cache._entry("key1")[1], 1000)
+        self.assertGreater(os.stat(path).st_mtime, 1000)
+
     def test_missing(self):
         cache = Cache(self.__dir, 10)
         self.assertFalse(cache.has("missing"))
@@ -147,6 +448,27 @@ class CacheTestCase(unittest.TestCase):
         self.assertTrue(cache.has("key2"))
         self.assertTrue(cache.has("key3"))
 
+    def test_no_eviction_scan(self):
+        cache = Cache(self.__dir, 100, min_time=0)
+        for i in range(5):
+            cache.set(f"key{i}", b"0123456789")
+
+        statements = []
+        cache._index.set_trace_callback(statements.append)
+        cache.set("key5", b"0123456789")
+        self.assertFalse([s for s in statements if "ORDER BY atime" in s])
+
+    def test_eviction_batches(self):
+        cache = Cache(self.__dir, 100, min_time=0)
+        for i in range(10):
+            cache.set(f"key{i}", b"0123456789")
+
+        with patch("supysonic.cache.EVICTION_BATCH", 3):
+            cache._make_space(75)
+        self.assertEqual(cache.size, 20)
+        self.assertTrue(cache.has("key8"))
+        self.assertTrue(cache.has("key9"))
+
     def test_delete(self):
         cache = Cache(self.__dir, 25, min_time=0)
         val = b"0123456789"
@@ -171,28 +493,28 @@ class CacheTestCase(unittest.TestCase):
                 pass
 
         # Make sure no partial files are left after the error
-        self.assertEqual(list(os.listdir(self.__dir)), list())
+        self.assertEqual(self.__files(), list())
 
     def test_parallel_generation(self):
         cache = Cache(self.__dir, 20)
+        calls = []
 
         def gen():
+            calls.append(None)
             yield from [b"0", b"12", b"345", b"6789"]
 
         g1 = cache.set_generated("key", gen)
         g2 = cache.set_generated("key", gen)
 
-        next(g1)
-        files = os.listdir(self.__dir)
+        self.assertEqual(next(g1), b"0")
+        files = self.__files()
         self.assertEqual(len(files), 1)
         for x in files:
             self.assertTrue(x.endswith(".part"))
 
-        next(g2)
-        files = os.listdir(self.__dir)
-        self.assertEqual(len(files), 2)
-        for x in files:
-            self.assertTrue(x.endswith(".part"))
+        # The second one reads what the first one wrote
+        self.assertEqual(next(g2), b"0")
+        self.assertEqual(len(self.__files()), 1)
 
         self.assertEqual(cache.size, 0)
         for x in g1:
@@ -200,14 +522,164 @@ class CacheTestCase(unittest.TestCase):
         self.assertEqual(cache.size, 10)
         self.assertTrue(cache.has("key"))
 
-        # Replace the file - size should stay the same
-        for x in g2:
+        self.assertEqual(b"".join(g2), b"123456789")
+        self.assertEqual(len(calls), 1)
+
+        # Only a single file
+        self.assertEqual(len(self.__files()), 1)
+
+        # Generated again once done
+        for x in cache.set_generated("key", gen):
             pass
+        self.assertEqual(len(calls), 2)
         self.assertEqual(cache.size, 10)
-        self.assertTrue(cache.has("key"))
 
-        # Only a single file
-        self.assertEqual(len(os.listdir(self.__dir)), 1)
+    def test_read_generated(self):
+        cache = Cache(self.__dir, 20)
+
+        def gen():
+            yield from [b"0", b"12", b"345", b"6789"]
+
+        with self.assertRaises(CacheMiss):
+            cache.read_generated("key", 0)
+
+        g = cache.set_generated("key", gen)
+        next(g)
+        next(g)
+        stop, data = cache.read_generated("key", 1)
+        self.assertEqual(stop, 3)
+        self.assertEqual(b"".join(data), b"12")
+        stop, data = cache.read_generated("key", 0, 2)
+        self.assertEqual(stop, 2)
+        self.assertEqual(b"".join(data), b"01")
+        with self.assertRaises(CacheMiss):
+            cache.read_generated("key", 3)  # not written yet
+
+        # Readers keep the generation going
+        stop, data = cache.read_generated("key", 2)
+        g.close()
+        self.assertEqual(b"".join(data), b"2")
+        self.__wait_generated(cache, "key")
+        self.assertEqual(cache.get_value("key"), b"0123456789")
+
+        with self.assertRaises(CacheMiss):
+            cache.read_generated("key", 0)
+
+    def test_reconnect_generation(self):
+        cache = Cache(self.__dir, 20, reconnect_time=0.2)
+
+        def gen():
+            yield from [b"0", b"12", b"345", b"6789"]
+
+        # The only reader left, what was generated is kept for a while
+        g = cache.set_generated("key", gen)
+        next(g)
+        g.close()
+        stop, data = cache.read_generated("key", 0)
+        self.assertEqual(b"".join(data), b"0")
+
+        # Then given up on
+        time.sleep(0.5)
+        with self.assertRaises(CacheMiss):
+            cache.read_generated("key", 0)
+        self.assertFalse(cache.has("key"))
+        self.assertEqual(self.__files(), [])
+
+    def test_follow_generation(self):
+        cache = Cache(self.__dir, 20)
+        produce = threading.Semaphore(0)
+
+        def gen():
+            for chunk in [b"0", b"12", b"345", b"6789"]:
+                produce.acquire()
+                yield chunk
+
+        owner = cache.set_generated("key", gen)
+        produce.release()
+        self.assertEqual(next(owner), b"0")
+
+        followed = []
+        following = threading.Event()
+
+        def follow():
+            for data in cache.set_generated("key", gen):
+                followed.append(data)
+                following.set()
+
+        follower = threading.Thread(target=follow)
+        follower.start()
+        self.assertTrue(following.wait(5))
+
+        # The first caller leaves, generation goes on for the follower
+        for _ in range(3):
+            produce.release()
+        owner.close()
+        follower.join(5)
+
+        self.assertFalse(follower.is_alive())
+        self.assertEqual(b"".join(followed), b"0123456789")
+        self.assertEqual(cache.get_value("key"), b"0123456789")
+
+    def test_follow_after_owner_left(self):
+        cache = Cache(self.__dir, 20)
+        calls = []
+
+        def gen():
+            calls.append(None)
+            yield from [b"0", b"12", b"345", b"6789"]
+
+        owner = cache.set_generated("key", gen)
+        self.assertEqual(next(owner), b"0")
+        follower = cache.set_generated("key", gen)
+        self.assertEqual(next(follower), b"0")
+
+        # Still going for the follower, later callers join it
+        owner.close()
+        late = cache.set_generated("key", gen)
+        self.assertEqual(b"".join(late), b"0123456789")
+        self.assertEqual(b"".join(follower), b"123456789")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get_value("key"), b"0123456789")
+
+    def test_follow_stalled_owner(self):
+        cache = Cache(self.__dir, 20)
+
+        def gen():
+            yield from [b"0", b"12", b"345", b"6789"]
+
+        owner = cache.set_generated("key", gen)
+        self.assertEqual(next(owner), b"0")
+
+        # The first caller not reading anymore doesn't hold back the others
+        followed = []
+        follower = threading.Thread(
+            target=lambda: followed.extend(cache.set_generated("key", gen))
+        )
+        follower.start()
+        follower.join(5)
+        self.assertFalse(follower.is_alive())
+        self.assertEqual(b"".join(followed), b"0123456789")
+
+        self.assertEqual(b"".join(owner), b"123456789")
+        self.assertEqual(cache.get_value("key"), b"0123456789")
+
+    def test_follow_failed_generation(self):
+        cache = Cache(self.__dir, 20)
+
+        def gen():
+            yield b"0"
+            raise ValueError()
+
+        owner = cache.set_generated("key", gen)
+        next(owner)
+        follower = cache.set_generated("key", gen)
+        self.assertEqual(next(follower), b"0")
+
+        # Everyone gets the error, not just the end of the data
+        self.assertRaises(ValueError, next, owner)
+        self.assertRaises(ValueError, next, follower)
+        self.assertFalse(cache.has("key"))
+        self.assertEqual(self.__files(), [])
 
     def test_replace(self):
         cache = Cache(self.__dir, 20)
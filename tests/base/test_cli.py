@@ -79,6 +79,7 @@ class CLITestCase(unittest.TestCase):
             with tempfile.NamedTemporaryFile(dir=d):
                 self.__invoke("folder scan")
                 self.__invoke("folder scan tmpfolder nonexistent")
+                self.__invoke("folder scan --no-resume tmpfolder")
 
     def test_folder_scan_extensions(self):
         # A configured extension whitelist is parsed into a list before scanning
@@ -87,6 +88,21 @@ class CLITestCase(unittest.TestCase):
             self.__add_folder("tmpfolder", d)
             self.__invoke("folder scan")
 
+    def test_cache_stats(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.__conf.WEBAPP["cache_dir"] = d
+            rv = self.__invoke("cache stats")
+            self.assertIn("cache\n", rv.output)
+            self.assertIn("transcodes\n", rv.output)
+            self.assertIn("hits: 0, misses: 0", rv.output)
+
+    def test_cache_warm(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.__conf.WEBAPP["cache_dir"] = d
+            rv = self.__invoke("cache warm -s 100 -s 200 -t 10 -j 2")
+            self.assertIn("Generated 0 thumbnails and 0 transcodes", rv.output)
+            self.__invoke("cache warm -s 0", True)
+
     def test_user_add(self):
         self.__invoke("user add -p Alic3 alice")
         self.__invoke("user add -p alice alice", True)
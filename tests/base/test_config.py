@@ -54,14 +54,18 @@ class ConfigTestCase(unittest.TestCase):
 
     def test_typed_keys(self):
         path = self.__write_config(
-            "[base]\nfollow_symlinks = yes\n"
+            "[base]\nfollow_symlinks = yes\nscanner_workers = 4\n"
+            "scanner_batch_size = 100\n"
             "[webapp]\ncache_size = 512\ntranscode_cache_size = 1024\n"
             "mount_api = off\nmount_webui = 1\nlog_rotate = no\n"
             "[daemon]\nrun_watcher = true\nwait_delay = 0.5\n"
+            "[transcoding]\nmax_transcodes = 2\ntranscode_queue_timeout = 1.5\n"
         )
         conf = IniConfig(path)
 
         self.assertIs(conf.BASE["follow_symlinks"], True)
+        self.assertEqual(conf.BASE["scanner_workers"], 4)
+        self.assertEqual(conf.BASE["scanner_batch_size"], 100)
         self.assertEqual(conf.WEBAPP["cache_size"], 512)
         self.assertEqual(conf.WEBAPP["transcode_cache_size"], 1024)
         self.assertIs(conf.WEBAPP["mount_api"], False)
@@ -69,6 +73,9 @@ class ConfigTestCase(unittest.TestCase):
         self.assertIs(conf.WEBAPP["log_rotate"], False)
         self.assertIs(conf.DAEMON["run_watcher"], True)
         self.assertEqual(conf.DAEMON["wait_delay"], 0.5)
+        self.assertEqual(conf.TRANSCODING["max_transcodes"], 2)
+        self.assertEqual(conf.TRANSCODING["transcode_queue_size"], 32)
+        self.assertEqual(conf.TRANSCODING["transcode_queue_timeout"], 1.5)
 
     def test_string_keys_arent_coerced(self):
         # Regression: string values that look like numbers or booleans used to be
@@ -95,6 +102,7 @@ class ConfigTestCase(unittest.TestCase):
             ("daemon", "run_watcher = maybe"),
             ("daemon", "wait_delay = soon"),
             ("daemon", "wait_delay = nan"),
+            ("transcoding", "max_transcodes = -1"),
         ):
             path = self.__write_config(f"[{section}]\n{option}\n")
             key = option.split(" ", 1)[0]
@@ -9,8 +9,16 @@ import os.path
 import shutil
 import tempfile
 import unittest
+from types import SimpleNamespace
 
-from supysonic.covers import CoverFile, find_cover_in_folder, is_valid_cover
+from supysonic.cache import Cache
+from supysonic.covers import (
+    CoverFile,
+    cached_cover_id,
+    extract_cover,
+    find_cover_in_folder,
+    is_valid_cover,
+)
 
 COVER = os.path.abspath("tests/assets/cover.jpg")
 
@@ -94,6 +102,27 @@ class CoversTestCase(unittest.TestCase):
         cover = find_cover_in_folder(self.dir, "Greatest Hits")
         self.assertEqual(cover.name, "Greatest Hits.jpg")
 
+    def test_extract_cover_shared(self):
+        cache = Cache(os.path.join(self.dir, "cache"), 1024**2, min_time=0)
+        tracks = [
+            SimpleNamespace(id=i, path=f"tests/assets/formats/silence.{fmt}")
+            for i, fmt in enumerate(("mp3", "ogg", "flac"))
+        ]
+
+        mp3, ogg, flac = (extract_cover(t, cache) for t in tracks)
+        self.assertEqual(mp3, ogg)  # same image, stored once
+        self.assertNotEqual(mp3[0], flac[0])
+        self.assertEqual(cached_cover_id(1, cache), mp3[0])
+        self.assertEqual(cache.stats()["entries"], 5)  # 2 images, 3 references
+
+        # Extracted again if evicted before its references
+        cache.delete(flac[0])
+        self.assertEqual(extract_cover(tracks[2], cache), flac)
+
+        no_art = SimpleNamespace(id=3, path=os.path.abspath("tests/assets/23bytes"))
+        self.assertEqual(extract_cover(no_art, cache), (None, None))
+        cache.close()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -64,6 +64,7 @@ class DaemonCommandTestCase(unittest.TestCase):
             RemoveWatchedFolder("/music"),
             ScannerProgressCommand(),
             ScannerStartCommand(["Music"], True),
+            ScannerStartCommand(["Music"], False, False),
             StopCommand(),
             ScannerProgressResult(7),
             ScannerProgressResult(None),
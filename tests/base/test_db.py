@@ -12,7 +12,7 @@ from collections import namedtuple
 from hashlib import sha1
 from unittest.mock import patch
 
-from peewee import IntegrityError
+from peewee import IntegrityError, SqliteDatabase
 
 from supysonic import db
 
@@ -391,6 +391,71 @@ class DbTestCase(unittest.TestCase):
         info = album.as_subsonic_album(self._ctx(self.create_user(), albums=[album]))
         self.assertEqual(info["coverArt"], str(folder_art.id))
 
+    def create_empty_hierarchy(self, parent):
+        # parent/empty/nested/deeper, without any track
+        folders = [parent]
+        for name in ("empty", "nested", "deeper"):
+            folders.append(
+                db.Folder.create(
+                    root=False,
+                    name=name,
+                    path=folders[-1].path + "/" + name,
+                    parent=folders[-1],
+                )
+            )
+        return folders[1:]
+
+    def test_folder_prune(self):
+        self.check_folder_prune()
+
+    def test_folder_prune_without_cte(self):
+        # What's done with MySQL
+        with patch.object(db, "MySQLDatabase", SqliteDatabase):
+            self.check_folder_prune()
+
+    def check_folder_prune(self):
+        root, child, child_2 = self.create_some_folders()
+        self.create_track_in(child, root)
+        _, _, deeper = self.create_empty_hierarchy(child)
+        db.StarredFolder.create(user=self.create_user(), starred=deeper)
+        db.Folder.update(last_modification=1234).execute()
+
+        self.assertEqual(db.Folder.prune(), 4)
+        self.assertEqual({f.id for f in db.Folder.select()}, {root.id, child.id})
+        self.assertEqual(db.StarredFolder.select().count(), 0)
+        self.assertEqual(db.Folder[child.id].last_modification, 0)
+        self.assertEqual(db.Folder[root.id].last_modification, 0)
+
+        self.assertEqual(db.Folder.prune(), 0)
+
+    def test_folder_prune_scoped(self):
+        root, child, child_2 = self.create_some_folders()
+        self.create_track_in(child, root)
+        _, _, deeper = self.create_empty_hierarchy(child)
+
+        # Only the given folders and their ancestors are considered
+        self.assertEqual(db.Folder.prune([child.id]), 0)
+        self.assertEqual(db.Folder.prune([deeper.id]), 3)
+        self.assertEqual(
+            {f.id for f in db.Folder.select()}, {root.id, child.id, child_2.id}
+        )
+        self.assertEqual(db.Folder.prune([]), 0)
+
+    def test_album_artist_prune_scoped(self):
+        artist = db.Artist.create(name="Lonely artist")
+        album = db.Album.create(artist=artist, name="Empty album")
+        other_artist = db.Artist.create(name="Other artist")
+        other_album = db.Album.create(artist=other_artist, name="Other album")
+
+        self.assertEqual(db.Album.prune([album.id]), 1)
+        self.assertEqual(db.Artist.prune([artist.id]), 1)
+        self.assertEqual(db.Album.select().count(), 1)
+        self.assertEqual(db.Artist.select().count(), 1)
+
+        self.assertEqual(db.Album.prune(), 1)
+        self.assertEqual(db.Artist.prune(), 1)
+        self.assertIsNone(db.Album.get_or_none(id=other_album.id))
+
     def test_list_migrations(self):
         migrations = list(db.list_migrations("sqlite"))
         self.assertTrue(migrations)
@@ -6,9 +6,12 @@
 # Distributed under terms of the GNU AGPLv3 license.
 
 import os.path
+import shutil
+import sys
+import tempfile
 import unittest
 
-from supysonic.pathutils import is_subpath
+from supysonic.pathutils import is_network_path, is_subpath
 
 
 # Written with forward slashes for readability, turned into whatever the
@@ -56,5 +59,37 @@ class IsSubpathTestCase(unittest.TestCase):
         self.assertTrue(is_subpath(_p("/music"), os.sep))
 
 
+@unittest.skipIf(sys.platform == "win32", "Mount tables are only read on Linux")
+class IsNetworkPathTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__dir = tempfile.mkdtemp()
+        self.__mounts = os.path.join(self.__dir, "mounts")
+        with open(self.__mounts, "w") as f:
+            f.write(
+                "/dev/sda1 / ext4 rw 0 0\n"
+                "server:/music /mnt/music nfs4 rw 0 0\n"
+                "/dev/sdb1 /mnt/music/local ext4 rw 0 0\n"
+                "//server/share /mnt/my\\040share cifs rw 0 0\n"
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.__dir)
+
+    def test_network_paths(self):
+        self.assertTrue(is_network_path("/mnt/music", self.__mounts))
+        self.assertTrue(is_network_path("/mnt/music/cache", self.__mounts))
+        self.assertTrue(is_network_path("/mnt/my share/cache", self.__mounts))
+
+    def test_local_paths(self):
+        self.assertFalse(is_network_path("/var/cache", self.__mounts))
+        self.assertFalse(is_network_path("/mnt/musical", self.__mounts))
+        # Most specific mount point
+        self.assertFalse(is_network_path("/mnt/music/local/cache", self.__mounts))
+
+    def test_unknown_mounts(self):
+        missing = os.path.join(self.__dir, "missing")
+        self.assertFalse(is_network_path("/mnt/music", missing))
+
+
 if __name__ == "__main__":
     unittest.main()
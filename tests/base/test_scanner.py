@@ -9,6 +9,7 @@ import os
 import os.path
 import shutil
 import tempfile
+import time
 import unittest
 from contextlib import contextmanager
 from types import SimpleNamespace
@@ -18,7 +19,7 @@ import mutagen
 
 from supysonic import db
 from supysonic.managers.folder import FolderManager
-from supysonic.scanner import Scanner
+from supysonic.scanner import Scanner, read_tags
 
 from ..testbase import get_test_db_uri, teardown_test_db
 
@@ -91,6 +92,51 @@ class ScannerTestCase(unittest.TestCase):
         self.__scan(True)
         self.assertEqual(db.Track.select().count(), 1)
 
+    def test_scan_with_workers(self):
+        with tempfile.TemporaryDirectory() as d:
+            for f in os.listdir("tests/assets/formats"):
+                shutil.copyfile(
+                    os.path.join("tests/assets/formats", f), os.path.join(d, f)
+                )
+            FolderManager.add("formats", d)
+
+            scanner = Scanner(workers=2)
+            scanner.queue_folder("formats")
+            scanner.run()
+
+            self.assertEqual(scanner.stats().added.tracks, 4)
+            self.assertEqual(db.Track.select().count(), 5)
+            for track in db.Track.select().where(db.Track.path.startswith(d)):
+                # Same as what reading the tags in this process gives
+                self.assertEqual(track.title, read_tags(track.path).title)
+                self.assertEqual(track.size, os.path.getsize(track.path))
+
+    def test_rescan_doesnt_query_each_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            for f in os.listdir("tests/assets/formats"):
+                shutil.copyfile(
+                    os.path.join("tests/assets/formats", f), os.path.join(d, f)
+                )
+            FolderManager.add("formats", d)
+
+            scanner = Scanner()
+            scanner.queue_folder("formats")
+            scanner.run()
+
+            database = db.db.obj
+            with patch.object(
+                database, "execute_sql", wraps=database.execute_sql
+            ) as execute_sql:
+                scanner = Scanner()
+                scanner.queue_folder("formats")
+                scanner.run()
+
+            self.assertEqual(scanner.stats().scanned, 4)
+            queries = [c.args[0] for c in execute_sql.call_args_list]
+            self.assertFalse(
+                any('FROM "track"' in q and '"path_hash" = ' in q for q in queries)
+            )
+
     def test_scan_file(self):
         self.scanner.scan_file("/some/inexistent/path")
         self.assertEqual(db.Track.select().count(), 1)
@@ -139,6 +185,8 @@ class ScannerTestCase(unittest.TestCase):
         # doesn't touch them otherwise, so it has to fix the size up.
         track = db.Track.select().first()
         db.Track.update(size=0).where(db.Track.id == track.id).execute()
+        # Folders are migrated along with the tracks, without a known mtime
+        db.Folder.update(last_modification=0).execute()
 
         self.__scan()
 
@@ -159,6 +207,20 @@ class ScannerTestCase(unittest.TestCase):
         self.assertEqual(db.Album.select().count(), 0)
         self.assertEqual(db.Artist.select().count(), 0)
 
+    def test_prune_after_remove_file_is_scoped(self):
+        track = db.Track.select().first()
+        unrelated = db.Artist.create(name="Unrelated")
+
+        self.scanner.remove_file(track.path)
+        self.scanner.prune()
+        self.assertEqual(db.Album.select().count(), 0)
+        self.assertEqual(list(db.Artist.select()), [unrelated])
+
+        # Scanning a whole folder prunes everything
+        self.__scan()
+        self.assertEqual(db.Artist.select().count(), 1)
+        self.assertIsNone(db.Artist.get_or_none(id=unrelated.id))
+
     def test_move_file(self):
         track = db.Track.select().first()
         self.assertRaises(TypeError, self.scanner.move_file, None, "string")
@@ -321,21 +383,243 @@ class ScannerTestCase(unittest.TestCase):
         # Create path
         with (
             patch("supysonic.scanner.mediafile.MediaFile", return_value=_fake_tag()),
-            patch("supysonic.scanner.Track.create", side_effect=ValueError),
+            patch("supysonic.scanner.Track.insert_many", side_effect=ValueError),
         ):
             scanner = Scanner()
             scanner.scan_file(newpath)
             self.assertIn(newpath, scanner.stats().errors)
+            self.assertEqual(scanner.stats().added.tracks, 0)
 
-        # Update path (existing track re-scanned, save fails validation)
+        # Update path (existing track re-scanned, update fails validation)
         existing = db.Track.select().first().path
         with (
             patch("supysonic.scanner.mediafile.MediaFile", return_value=_fake_tag()),
-            patch("supysonic.scanner.Track.save", side_effect=ValueError),
+            patch("supysonic.scanner.Track.bulk_update", side_effect=ValueError),
         ):
             scanner = Scanner(force=True)
             scanner.scan_file(existing)
             self.assertIn(existing, scanner.stats().errors)
+        self.assertEqual(db.Track.get(path=existing).title, "[silence]")
+
+    def test_batched_writes_isolate_invalid_tracks(self):
+        # An invalid track in a batch doesn't prevent the others from being
+        # written
+        with tempfile.TemporaryDirectory() as d:
+            for f in os.listdir("tests/assets/formats"):
+                shutil.copyfile(
+                    os.path.join("tests/assets/formats", f), os.path.join(d, f)
+                )
+            FolderManager.add("formats", d)
+
+            insert_many = db.Track.insert_many
+
+            def reject_flac(rows):
+                if any(row["path"].endswith(".flac") for row in rows):
+                    raise ValueError()
+                return insert_many(rows)
+
+            with patch("supysonic.scanner.Track.insert_many", side_effect=reject_flac):
+                scanner = Scanner(batch_size=10)
+                scanner.queue_folder("formats")
+                scanner.run()
+
+            self.assertEqual(scanner.stats().added.tracks, 3)
+            self.assertEqual(scanner.stats().errors, [os.path.join(d, "silence.flac")])
+            self.assertEqual(db.Track.select().count(), 4)
+
+
+class ScannerIncrementalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__dir = tempfile.mkdtemp()
+        uri, self.__tmp = get_test_db_uri(memory=True)
+        db.init_database(uri)
+        FolderManager.add("folder", self.__dir)
+
+        self.__mtime = int(time.time()) - 1000
+
+    def tearDown(self):
+        teardown_test_db(self.__tmp)
+        shutil.rmtree(self.__dir)
+
+    def _path(self, *parts):
+        return os.path.join(self.__dir, *parts)
+
+    def _add_track(self, *parts):
+        path = self._path(*parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile("tests/assets/folder/silence.mp3", path)
+
+    def _age_directories(self):
+        # Make sure every directory looks modified in the past, and differently
+        # from last time
+        self.__mtime += 1
+        for dirpath, _, _ in os.walk(self.__dir):
+            os.utime(dirpath, (self.__mtime, self.__mtime))
+
+    def _scan(self, force=False):
+        scanner = Scanner(force=force)
+        scanner.queue_folder("folder")
+        scanner.run()
+        return scanner.stats()
+
+    def test_unchanged_directories_skipped(self):
+        self._add_track("artist", "album", "track.mp3")
+        self._age_directories()
+        self.assertEqual(self._scan().added.tracks, 1)
+
+        stats = self._scan()
+        self.assertEqual(stats.scanned, 0)
+        self.assertEqual(db.Track.select().count(), 1)
+
+        stats = self._scan(force=True)
+        self.assertEqual(stats.scanned, 1)
+
+    def test_changes_in_nested_directory(self):
+        self._add_track("artist", "album", "track.mp3")
+        self._age_directories()
+        self._scan()
+
+        # Only the album directory changes, not its parents
+        self._add_track("artist", "album", "other.mp3")
+        os.utime(self._path("artist", "album"), (self.__mtime + 1,) * 2)
+
+        stats = self._scan()
+        self.assertEqual(stats.added.tracks, 1)
+        self.assertEqual(db.Track.select().count(), 2)
+
+    def test_directory_without_tracks(self):
+        self._add_track("artist", "album", "track.mp3")
+        os.makedirs(self._path("artist", "scans"))
+        self._age_directories()
+        self._scan()
+
+        self._add_track("artist", "scans", "track.mp3")
+        os.utime(self._path("artist", "scans"), (self.__mtime + 1,) * 2)
+
+        self.assertEqual(self._scan().added.tracks, 1)
+
+    def test_pruned_directory(self):
+        self._add_track("artist", "album", "track.mp3")
+        self._add_track("artist", "other", "track.mp3")
+        self._age_directories()
+        self._scan()
+
+        os.remove(self._path("artist", "other", "track.mp3"))
+        self._age_directories()
+        self._scan()
+        self.assertIsNone(db.Folder.get_or_none(path=self._path("artist", "other")))
+
+        self._add_track("artist", "other", "track.mp3")
+        os.utime(self._path("artist", "other"), (self.__mtime + 1,) * 2)
+        self.assertEqual(self._scan().added.tracks, 1)
+
+    def test_lookups_cached(self):
+        for name in ("one.mp3", "two.mp3", "three.mp3"):
+            self._add_track("artist", "album", name)
+
+        database = db.db.obj
+        with patch.object(
+            database, "execute_sql", wraps=database.execute_sql
+        ) as execute_sql:
+            self.assertEqual(self._scan().added.tracks, 3)
+
+        # Same artist and album for every track, each looked up once
+        queries = [c.args[0] for c in execute_sql.call_args_list]
+        for table in ("artist", "album"):
+            lookups = [
+                q
+                for q in queries
+                if q.startswith("SELECT")
+                and f'FROM "{table}"' in q
+                and '"name" = ' in q
+            ]
+            self.assertEqual(len(lookups), 1, table)
+
+    def test_covers_of_changed_directories(self):
+        self._add_track("artist", "album", "track.mp3")
+        self._add_track("artist", "other", "track.mp3")
+        self._age_directories()
+        self._scan()
+
+        self._add_track("artist", "other", "new.mp3")
+        os.utime(self._path("artist", "other"), (self.__mtime + 1,) * 2)
+
+        with patch(
+            "supysonic.scanner.find_cover_in_folder", return_value=None
+        ) as find_cover:
+            self._scan()
+        find_cover.assert_called_once()
+        self.assertEqual(find_cover.call_args.args[0], self._path("artist", "other"))
+
+        with patch(
+            "supysonic.scanner.find_cover_in_folder", return_value=None
+        ) as find_cover:
+            self._scan(force=True)
+        self.assertEqual(find_cover.call_count, 4)
+
+    def _interrupted_scan(self, force=False):
+        for i in range(20):
+            self._add_track(f"album{i:02}", "track.mp3")
+
+        def progress(folder_name, scanned):
+            if scanned == 18:
+                scanner.stop()
+
+        # Tags are read 16 files at a time, stop while gathering the second
+        # chunk. Only the directories of the first one (and the root) are done.
+        scanner = Scanner(batch_size=1, progress=progress, force=force)
+        scanner.queue_folder("folder")
+        scanner.run()
+        self.assertEqual(db.Track.select().count(), 16)
+        self.assertEqual(db.ScanCheckpoint.select().count(), 17)
+
+    def test_resume_interrupted_scan(self):
+        self._interrupted_scan(force=True)
+
+        stats = self._scan(force=True)
+        self.assertEqual(stats.scanned, 4)
+        self.assertEqual(db.Track.select().count(), 20)
+        self.assertEqual(db.ScanCheckpoint.select().count(), 0)
+
+    def test_force_after_interrupted_scan(self):
+        self._interrupted_scan()
+
+        # What the interrupted scan skipped still has to be scanned
+        stats = self._scan(force=True)
+        self.assertEqual(stats.scanned, 20)
+        self.assertEqual(db.Track.select().count(), 20)
+        self.assertEqual(db.ScanCheckpoint.select().count(), 0)
+
+    def test_discard_interrupted_scan(self):
+        self._interrupted_scan()
+
+        scanner = Scanner(force=True, resume=False)
+        scanner.queue_folder("folder")
+        scanner.run()
+        self.assertEqual(scanner.stats().scanned, 20)
+        self.assertEqual(db.Track.select().count(), 20)
+        self.assertEqual(db.ScanCheckpoint.select().count(), 0)
+
+    def test_deletions_found_while_walking(self):
+        self._add_track("artist", "album", "track.mp3")
+        self._add_track("artist", "album", "other.mp3")
+        self._add_track("artist", "gone", "track.mp3")
+        self._age_directories()
+        self._scan()
+
+        os.remove(self._path("artist", "album", "other.mp3"))
+        shutil.rmtree(self._path("artist", "gone"))
+        self._age_directories()
+
+        with patch("os.path.exists", side_effect=os.path.exists) as exists:
+            stats = self._scan()
+
+        self.assertEqual(stats.deleted.tracks, 2)
+        self.assertEqual(db.Track.select().count(), 1)
+        self.assertIsNone(db.Folder.get_or_none(path=self._path("artist", "gone")))
+        # No second pass checking each track's file
+        checked = [c.args[0] for c in exists.call_args_list]
+        self.assertFalse(any(p.endswith(".mp3") for p in checked))
 
 
 class ScannerDeletionsTestCase(unittest.TestCase):
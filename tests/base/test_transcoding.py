@@ -0,0 +1,161 @@
+# This file is part of Supysonic.
+# Supysonic is a Python implementation of the Subsonic server API.
+#
+# Copyright (C) 2026 Alban 'spl0k' Féron
+#
+# Distributed under terms of the GNU AGPLv3 license.
+
+import os.path
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import closing
+
+from supysonic.transcoding import TranscoderPool, TranscodersBusy
+
+
+class TranscoderPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__dir = tempfile.mkdtemp()
+        self.__pools = []
+
+    def tearDown(self):
+        for pool in self.__pools:
+            pool.close()
+        shutil.rmtree(self.__dir)
+
+    def __pool(self, *args, **kwargs):
+        pool = TranscoderPool(
+            os.path.join(self.__dir, "transcoding.sqlite"), *args, **kwargs
+        )
+        self.__pools.append(pool)
+        return pool
+
+    def __wait_queued(self, count):
+        with closing(
+            sqlite3.connect(os.path.join(self.__dir, "transcoding.sqlite"))
+        ) as queue:
+            while (
+                queue.execute(
+                    "SELECT COUNT(*) FROM transcodes WHERE NOT running"
+                ).fetchone()[0]
+                < count
+            ):
+                time.sleep(0.01)
+
+    def __acquire_later(self, pool, user, started):
+        """Wait for a slot from another thread, appending user to started once
+        it got one. Returns an event releasing the slot and the thread."""
+
+        release = threading.Event()
+
+        def run():
+            with pool.slot(user):
+                started.append(user)
+                release.wait()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return release, thread
+
+    def test_unlimited(self):
+        pool = self.__pool(0)
+        with pool.slot("alice"), pool.slot("alice"):
+            pass
+        self.assertFalse(os.path.exists(os.path.join(self.__dir, "transcoding.sqlite")))
+
+    def test_limit(self):
+        pool = self.__pool(2, queue_size=0, timeout=0)
+        with pool.slot("alice"), pool.slot("bob"):
+            with self.assertRaises(TranscodersBusy), pool.slot("carol"):
+                pass
+
+        # Slots are released when leaving the context
+        with pool.slot("alice"), pool.slot("carol"):
+            pass
+
+    def test_queue(self):
+        pool = self.__pool(1, queue_size=1, timeout=5)
+        started = []
+        with pool.slot("alice"):
+            release, thread = self.__acquire_later(pool, "bob", started)
+            self.__wait_queued(1)
+
+            # Queue full
+            with self.assertRaises(TranscodersBusy), pool.slot("carol"):
+                pass
+            self.assertEqual(started, [])
+
+        release.set()
+        thread.join()
+        self.assertEqual(started, ["bob"])
+
+    def test_timeout(self):
+        pool = self.__pool(1, queue_size=1, timeout=0.1)
+        with pool.slot("alice"):
+            with self.assertRaises(TranscodersBusy), pool.slot("bob"):
+                pass
+
+            # Timed out requests leave the queue
+            with self.assertRaises(TranscodersBusy), pool.slot("bob"):
+                pass
+
+    def test_fair_order(self):
+        pool = self.__pool(1, queue_size=10, timeout=5)
+        started = []
+        threads = []
+        with pool.slot("alice"):
+            for user in ("bob", "carol", "dave"):
+                threads.append(self.__acquire_later(pool, user, started))
+                self.__wait_queued(len(threads))  # queued in this order
+
+        for release, thread in threads:
+            release.set()
+            thread.join()
+        self.assertEqual(started, ["bob", "carol", "dave"])
+
+    def test_per_user_limit(self):
+        pool = self.__pool(2, max_per_user=1, queue_size=10, timeout=5)
+        started = []
+        with pool.slot("alice"):
+            release, thread = self.__acquire_later(pool, "alice", started)
+            self.__wait_queued(1)
+
+            # Not held back by alice's second transcode, queued first
+            with pool.slot("bob"):
+                self.assertEqual(started, [])
+
+        release.set()
+        thread.join()
+        self.assertEqual(started, ["alice"])
+
+    def test_shared(self):
+        pool1 = self.__pool(1, queue_size=0, timeout=0)
+        pool2 = self.__pool(1, queue_size=0, timeout=0)
+        with pool1.slot("alice"):
+            with self.assertRaises(TranscodersBusy), pool2.slot("bob"):
+                pass
+        with pool2.slot("bob"):
+            pass
+
+    @unittest.skipIf(sys.platform == "win32", "Processes aren't checked on Windows")
+    def test_dead_processes_forgotten(self):
+        proc = subprocess.Popen([sys.executable, "-c", ""])
+        proc.wait()
+
+        pool = self.__pool(1, queue_size=0, timeout=0)
+        pool._queue.execute(
+            "INSERT INTO transcodes (pid, user, running) VALUES (?, 'alice', 1)",
+            (proc.pid,),
+        )
+        with pool.slot("bob"):
+            pass
+
+
+if __name__ == "__main__":
+    unittest.main()
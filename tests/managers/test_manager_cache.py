@@ -0,0 +1,128 @@
+# This file is part of Supysonic.
+# Supysonic is a Python implementation of the Subsonic server API.
+#
+# Copyright (C) 2026 Alban 'spl0k' Féron
+#
+# Distributed under terms of the GNU AGPLv3 license.
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from supysonic.covers import cached_cover_id
+from supysonic.db import Album, Artist, Folder, Track, init_database
+from supysonic.managers.cache import CacheManager
+
+from ..testbase import TestConfig, get_test_db_uri, teardown_test_db
+
+
+class CacheManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        uri, self.__tmp = get_test_db_uri(memory=True)
+        init_database(uri)
+
+        self.__dir = tempfile.mkdtemp()
+        self.config = TestConfig(False, False)
+        self.config.WEBAPP["cache_dir"] = os.path.join(self.__dir, "cache")
+        self.config.TRANSCODING["default_transcode_target"] = "rnd"
+        self.caches = CacheManager.open_caches(self.config)
+
+        music = os.path.join(self.__dir, "music")
+        shutil.copytree("tests/assets/formats", os.path.join(music, "embedded"))
+        os.mkdir(os.path.join(music, "cover"))
+        shutil.copy("tests/assets/cover.jpg", os.path.join(music, "cover"))
+
+        root = Folder.create(root=True, name="Music", path=music)
+        self.covered = Folder.create(
+            root=False,
+            parent=root,
+            name="cover",
+            path=os.path.join(music, "cover"),
+            cover_art="cover.jpg",
+        )
+        embedded = Folder.create(
+            root=False,
+            parent=root,
+            name="embedded",
+            path=os.path.join(music, "embedded"),
+        )
+        artist = Artist.create(name="Artist")
+        album = Album.create(name="Album", artist=artist)
+        self.tracks = [
+            Track.create(
+                title=f"Track {i}",
+                number=i,
+                disc=1,
+                artist=artist,
+                album=album,
+                path=os.path.join(music, "embedded", name),
+                root_folder=root,
+                folder=embedded,
+                duration=2,
+                bitrate=bitrate,
+                has_art=True,
+                play_count=plays,
+                last_modification=0,
+            )
+            for i, (name, bitrate, plays) in enumerate(
+                [
+                    ("silence.mp3", 320, 1),
+                    ("silence.flac", 900, 3),
+                    ("silence.ogg", 96, 2),
+                ]
+            )
+        ]
+
+    def tearDown(self):
+        for cache in self.caches.values():
+            cache.close()
+        teardown_test_db(self.__tmp)
+        shutil.rmtree(self.__dir)
+
+    def test_covers(self):
+        covers = dict(CacheManager.covers())
+        self.assertEqual(len(covers), 2)
+        self.assertEqual(covers[str(self.covered.id)], self.covered)
+        # A single track stands for both the album and the folder
+        self.assertIn(str(self.tracks[0].id), covers)
+
+    def test_warm(self):
+        done = CacheManager.warm(
+            self.config, self.caches, sizes=[100, 1000], tracks=10, jobs=2
+        )
+        self.assertEqual(done, {"thumbnails": 2, "transcodes": 1, "errors": 0})
+
+        cache = self.caches["cache"]
+        self.assertTrue(cache.has(f"{self.covered.id}-cover-100"))
+        cover_id = cached_cover_id(self.tracks[0].id, cache)
+        self.assertTrue(cache.has(f"{cover_id}-cover-100"))
+        self.assertFalse(cache.has(f"{self.covered.id}-cover-1000"))  # too small
+
+        # Only the played mp3 goes over the bitrate and has a transcoder
+        transcodes = self.caches["transcodes"]
+        self.assertEqual(
+            len(transcodes.get_value(f"{self.tracks[0].id}-128.rnd")), 52000
+        )
+
+        # Everything is already there
+        done = CacheManager.warm(
+            self.config, self.caches, sizes=[100, 1000], tracks=10, jobs=2
+        )
+        self.assertEqual(done, {"thumbnails": 0, "transcodes": 0, "errors": 0})
+
+    def test_warm_format(self):
+        done = CacheManager.warm(
+            self.config, self.caches, tracks=1, dst_suffix="rnd", dst_bitrate=320
+        )
+        self.assertEqual(done, {"thumbnails": 0, "transcodes": 0, "errors": 0})
+
+        done = CacheManager.warm(
+            self.config, self.caches, tracks=3, dst_suffix="rnd", dst_bitrate=320
+        )
+        self.assertEqual(done, {"thumbnails": 0, "transcodes": 1, "errors": 0})
+        self.assertTrue(self.caches["transcodes"].has(f"{self.tracks[0].id}-320.rnd"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+# This file is part of Supysonic.
+# Supysonic is a Python implementation of the Subsonic server API.
+#
+# Copyright (C) 2026 Alban 'spl0k' Féron
+#
+# Distributed under terms of the GNU AGPLv3 license.
+
+# Scanner benchmark. Generates a synthetic library of tagged files from the
+# assets in tests/assets/formats, then times full, incremental, forced and
+# deletion-heavy scans of it against an SQLite database.
+# Not part of the test suite, run it with:
+#   python -m tests.scanner_benchmark --help
+
+import argparse
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import mediafile
+
+try:
+    import resource
+except ImportError:  # pragma: nocover
+    resource = None  # Windows
+
+from supysonic import db
+from supysonic.scanner import Scanner
+
+ASSETS = os.path.join(os.path.dirname(__file__), "assets", "formats")
+
+
+def generate_library(dest, artists, albums, tracks, depth, fanout, seed):
+    """Create artists * albums * tracks tagged files in dest
+
+    Artist directories are nested under depth levels of fanout directories
+    each. Returns the paths of the album directories.
+    """
+
+    rnd = random.Random(seed)
+    templates = sorted(os.path.join(ASSETS, f) for f in os.listdir(ASSETS))
+    album_dirs = []
+
+    for ar in range(artists):
+        groups = [f"group{(ar // fanout**level) % fanout}" for level in range(depth)]
+        artist = f"Artist {ar:04}"
+        for al in range(albums):
+            album = f"Album {al:03}"
+            album_dir = os.path.join(dest, *groups, artist, album)
+            os.makedirs(album_dir)
+            album_dirs.append(album_dir)
+
+            for tr in range(tracks):
+                template = rnd.choice(templates)
+                path = os.path.join(
+                    album_dir, f"{tr + 1:02} - Track{os.path.splitext(template)[1]}"
+                )
+                shutil.copyfile(template, path)
+
+                tag = mediafile.MediaFile(path)
+                tag.artist = tag.albumartist = artist
+                tag.album = album
+                tag.title = f"Track {tr + 1} of {album} by {artist}"
+                tag.track = tr + 1
+                tag.year = 1970 + rnd.randrange(50)
+                tag.save()
+
+    return album_dirs
+
+
+class QueryCounter:
+    """Counts the statements run on the database"""
+
+    def __init__(self, database):
+        self.__database = database
+        self.__execute_sql = database.execute_sql
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+        return self.__execute_sql(*args, **kwargs)
+
+    @contextmanager
+    def installed(self):
+        self.__database.execute_sql = self
+        try:
+            yield self
+        finally:
+            del self.__database.execute_sql
+
+
+def peak_rss():
+    """Peak resident set size of this process and its (worker) children, in
+    KiB. None if it can't be known on this platform."""
+
+    if resource is None:  # pragma: nocover
+        return None
+
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    if sys.platform == "darwin":  # bytes rather than KiB
+        rss //= 1024
+    return rss
+
+
+def run_scan(name, files, force=False, workers=1, batch_size=500):
+    counter = QueryCounter(db.db.obj)
+    scanner = Scanner(force=force, workers=workers, batch_size=batch_size)
+    scanner.queue_folder("benchmark")
+
+    with counter.installed():
+        start = time.perf_counter()
+        scanner.run()
+        elapsed = time.perf_counter() - start
+
+    rss = peak_rss()
+    stats = scanner.stats()
+    print(
+        f"{name:<12} {files:>8} {elapsed:>9.2f} {files / elapsed:>10.1f} "
+        f"{stats.scanned:>8} {counter.count:>8} "
+        f"{rss // 1024 if rss is not None else '?':>9}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.scanner_benchmark", description="Benchmark the scanner"
+    )
+    parser.add_argument("--artists", type=int, default=20)
+    parser.add_argument("--albums", type=int, default=5, help="albums per artist")
+    parser.add_argument("--tracks", type=int, default=10, help="tracks per album")
+    parser.add_argument(
+        "--depth", type=int, default=1, help="directory levels above the artists"
+    )
+    parser.add_argument(
+        "--fanout", type=int, default=4, help="directories per level above artists"
+    )
+    parser.add_argument(
+        "--delete",
+        type=float,
+        default=0.5,
+        help="ratio of albums removed before the deletion scan",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--dir",
+        help="where to create the temporary library and database, to benchmark a "
+        "specific storage",
+    )
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.dir)
+    library = os.path.join(tmpdir, "library")
+    try:
+        print(f"Generating the library in {library}...", flush=True)
+        album_dirs = generate_library(
+            library,
+            args.artists,
+            args.albums,
+            args.tracks,
+            args.depth,
+            args.fanout,
+            args.seed,
+        )
+        files = len(album_dirs) * args.tracks
+
+        db.init_database("sqlite:///" + os.path.join(tmpdir, "benchmark.db"))
+        db.Folder.create(root=True, name="benchmark", path=os.path.abspath(library))
+        db.close_connection()
+
+        # Directory mtimes of the current second are never trusted by the
+        # scanner, make sure the incremental scan can skip them
+        time.sleep(1.1 - time.time() % 1)
+
+        print(
+            f"{'scan':<12} {'files':>8} {'time (s)':>9} {'files/s':>10} "
+            f"{'scanned':>8} {'queries':>8} {'RSS (MiB)':>9}"
+        )
+        kwargs = {"workers": args.workers, "batch_size": args.batch_size}
+        run_scan("full", files, **kwargs)
+        run_scan("incremental", files, **kwargs)
+        run_scan("forced", files, force=True, **kwargs)
+
+        rnd = random.Random(args.seed)
+        deleted = rnd.sample(album_dirs, int(len(album_dirs) * args.delete))
+        for album_dir in deleted:
+            shutil.rmtree(album_dir)
+        run_scan("deletion", files - len(deleted) * args.tracks, **kwargs)
+
+        db.release_database()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
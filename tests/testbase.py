@@ -104,6 +104,7 @@ class TestConfig(DefaultConfig):
     WTF_CSRF_ENABLED = False
     MIMETYPES = {"mp3": "audio/mpeg", "weirdextension": "application/octet-stream"}
     TRANSCODING = {
+        **DefaultConfig.TRANSCODING,
         "transcoder_mp3_mp3": _tool_cmd("echo", "%srcpath", "%outrate"),
         "transcoder_mp3_rnd": _tool_cmd("urandom", "52000"),
         "decoder_mp3": _tool_cmd("decode"),